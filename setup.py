@@ -5,7 +5,9 @@ from numpy.distutils.core import setup, Extension
 ext1 = Extension(name = 'cu',
                  sources = ['wmf/cuencas.f90'])
 ext2 = Extension(name = 'models',
-                 sources = ['wmf/modelosv2.f90'])
+                 sources = ['wmf/modelosv2.f90'],
+                 extra_f90_compile_args = ['-fopenmp'],
+                 extra_link_args = ['-fopenmp'])
 
 setup(
     name='wmf',
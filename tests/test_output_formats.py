@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#Pruebas de ida y vuelta de las salidas de run_shia: series y estados de
+#ShiaWriter (WMFO), historia de estados de SnapshotStore (WMFZ) y checkpoints
+#(npz), incluida la continuacion de una simulacion desde un checkpoint.
+#Se ejecutan con: python -m unittest discover tests
+import os
+import new
+import shutil
+import tempfile
+import unittest
+import datetime
+import numpy as np
+#Sin models, cu o las dependencias de wmf las pruebas se saltan
+try:
+	from wmf import wmf
+except ImportError:
+	wmf = None
+
+N = 30
+FECHA = datetime.datetime(2020,1,1)
+
+def __Cuenca__():
+	#Cuenca minima para los escritores: solo el tipo y la cantidad de elementos
+	return new.instance(wmf.SimuBasin,{'modelType' : 'cells','ncells' : N,'nhills' : N,
+		'modelVars' : {'dt' : 300.0,'sim_sediments' : 0,'sim_slides' : 0}})
+
+def __Simulacion__(Nreg,semilla=0):
+	#Series y estados de una simulacion: Qsim [2,Nreg], Storage [Nreg,5,N]
+	#y Speed [Nreg,4,N] al final de cada intervalo
+	rs = np.random.RandomState(semilla)
+	Series = {'Qsim' : rs.rand(2,Nreg).astype(np.float32),
+		'Humedad' : rs.rand(2,Nreg).astype(np.float32)}
+	Estados = {'Storage' : rs.rand(Nreg,5,N).astype(np.float32),
+		'Speed' : rs.rand(Nreg,4,N).astype(np.float32)}
+	return Series,Estados
+
+def __Bloques__(sink,Series,Estados,cortes):
+	#Entrega la simulacion al sink por bloques, como run_shia
+	for i,j in zip(cortes[:-1],cortes[1:]):
+		sink.write_block(dict([(k,v[...,i:j]) for k,v in Series.iteritems()]),j-i,
+			dict([(k,v[j-1]) for k,v in Estados.iteritems()]))
+
+@unittest.skipIf(wmf is None,'wmf (models, cu y sus dependencias) no esta disponible')
+class OutputFormatsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_shia_writer(self):
+		Series,Estados = __Simulacion__(24)
+		ruta = os.path.join(self.dir,'salida')
+		#Dos ejecuciones seguidas con el mismo escritor continuan las series,
+		#buffer pequeno para que se escriban varios bloques
+		w = wmf.ShiaWriter(ruta,{'Qsim' : 1,'Humedad' : 4,'Storage' : 6},buffer_mb=1e-4)
+		__Bloques__(w,Series,Estados,[0,6,12])
+		__Bloques__(w,Series,Estados,[12,18,24])
+		w.close()
+		for nombre,cada in [('Qsim',1),('Humedad',4)]:
+			Datos,c = wmf.read_shia_output(ruta+'_'+nombre+'.bin')
+			self.assertEqual(c,cada)
+			np.testing.assert_array_equal(Datos,Series[nombre][:,cada-1::cada].T)
+		Datos,c = wmf.read_shia_output(ruta+'_Storage.bin')
+		self.assertEqual(c,6)
+		np.testing.assert_array_equal(Datos,Estados['Storage'][5::6])
+		self.assertFalse(os.path.exists(ruta+'_Speed.bin'))
+		#Un binario que no es de ShiaWriter no se acepta
+		otro = os.path.join(self.dir,'otro.bin')
+		f = open(otro,'wb')
+		f.write('WMFI'+np.zeros(4,dtype=np.int32).tostring())
+		f.close()
+		self.assertRaises(ValueError,wmf.read_shia_output,otro)
+
+	def test_snapshot_store(self):
+		Series,Estados = __Simulacion__(20)
+		ruta = os.path.join(self.dir,'estados.bin')
+		celdas = np.arange(N) % 3 <> 0
+		#Bloques de 3 registros y de 4 celdas, el ultimo de cada uno incompleto
+		s = wmf.SnapshotStore(ruta,{'Storage' : [1,3],'Speed' : [2]},cada=2,celdas=celdas,
+			Nchunk=3,Ncells_chunk=4)
+		__Bloques__(s,Series,Estados,range(0,21,2))
+		s.close()
+		cuenca = __Cuenca__()
+		for paso in [2,8,20]:
+			Mapas = cuenca.read_snapshot_step(ruta,paso)
+			for nombre,v,t in [('Storage_1','Storage',1),('Storage_3','Storage',3),
+				('Speed_2','Speed',2)]:
+				esperado = np.zeros(N,dtype=np.float32) * np.nan
+				esperado[celdas] = Estados[v][paso-1,t-1,celdas]
+				np.testing.assert_array_equal(Mapas[nombre],esperado)
+		self.assertRaises(ValueError,cuenca.read_snapshot_step,ruta,3)
+		Serie = cuenca.read_snapshot_series(ruta,7)
+		np.testing.assert_array_equal(Serie.index,np.arange(2,21,2))
+		np.testing.assert_array_equal(Serie['Storage_3'].values,Estados['Storage'][1::2,2,7])
+		self.assertRaises(ValueError,cuenca.read_snapshot_series,ruta,6)
+
+	def test_checkpoint(self):
+		ruta = os.path.join(self.dir,'estado.npz')
+		Estado = {'version' : 1,'N' : N,'intervalo' : 11,'fecha' : -1,
+			'storage' : np.random.rand(1,5,N).astype(np.float32),
+			'calibracion' : np.ones((1,10))}
+		wmf.write_checkpoint(ruta,Estado)
+		Leido = wmf.read_checkpoint(ruta)
+		self.assertEqual(sorted(Leido),sorted(Estado))
+		self.assertEqual(Leido['intervalo'],11)
+		np.testing.assert_array_equal(Leido['storage'],Estado['storage'])
+		#El guardado se hace con un temporal que se renombra
+		self.assertEqual(os.listdir(self.dir),['estado.npz'])
+		#Un npz que no es checkpoint no se acepta
+		otro = os.path.join(self.dir,'otro.npz')
+		wmf.write_checkpoint(otro,{'storage' : Estado['storage']})
+		self.assertRaises(ValueError,wmf.read_checkpoint,otro)
+
+	def test_resume_from_checkpoint(self):
+		#Lluvia con fechas y un pedazo virtual de ella que empieza en otro intervalo
+		cuenca = __Cuenca__()
+		lluvia = os.path.join(self.dir,'lluvia')
+		fechas = [FECHA + datetime.timedelta(minutes=5*i) for i in range(40)]
+		w = wmf.RainWriter(cuenca,lluvia,umbral=0.0)
+		for f in fechas:
+			w.write(np.ones(N),f)
+		w.close()
+		pedazo = os.path.join(self.dir,'pedazo.idx')
+		wmf.slice_rain_index(lluvia+'.idx',pedazo,fechaI=fechas[10])
+		#El checkpoint guarda el intervalo en que sigue y su fecha
+		ruta = os.path.join(self.dir,'estado.npz')
+		Estado = {'storage' : np.random.rand(1,5,N).astype(np.float32)}
+		cuenca.__WriteCheckpoint__(ruta,np.ones(10),25,lluvia+'.idx',Estado)
+		Leido = wmf.read_checkpoint(ruta)
+		self.assertEqual(Leido['intervalo'],25)
+		self.assertEqual(Leido['fecha'],np.array(fechas[24],dtype='datetime64[s]').astype(np.int64))
+		#Sobre la misma lluvia continua en el intervalo, sobre el pedazo en la fecha
+		for tabla,esperado in [(lluvia+'.idx',25),(pedazo,15)]:
+			Leido,inicio = cuenca.__ResumeState__(ruta,N,tabla,1,None)
+			self.assertEqual(inicio,esperado)
+			np.testing.assert_array_equal(Leido['storage'],Estado['storage'])
+		#Sin fechas en la lluvia continua en el intervalo guardado
+		Leido,inicio = cuenca.__ResumeState__(ruta,N,lluvia+'.hdr',1,None)
+		self.assertEqual(inicio,25)
+		#El checkpoint debe ser de una cuenca del mismo tamano
+		self.assertRaises(ValueError,cuenca.__ResumeState__,ruta,N+1,pedazo,1,None)
+
+if __name__ == '__main__':
+	unittest.main()
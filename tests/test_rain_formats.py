@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#Pruebas de ida y vuelta de los binarios de lluvia (denso, WMFS y WMFQ) y de su
+#indice (WMFI): escritura, lectura desde python y desde models, y continuacion
+#de un binario despues de una caida.
+#Se ejecutan con: python -m unittest discover tests
+import os
+import new
+import shutil
+import tempfile
+import unittest
+import datetime
+import numpy as np
+#Sin models, cu o las dependencias de wmf las pruebas se saltan
+try:
+	from wmf import wmf
+except ImportError:
+	wmf = None
+
+N = 40
+FECHA = datetime.datetime(2020,1,1)
+FORMATOS = {'dense' : None,'sparse' : 'WMFS','uint16' : 'WMFQ'}
+
+def __Cuenca__():
+	#Cuenca minima para los escritores: solo el tipo y la cantidad de elementos
+	return new.instance(wmf.SimuBasin,{'modelType' : 'cells','ncells' : N,'nhills' : N,
+		'modelVars' : {'dt' : 300.0,'sim_sediments' : 0,'sim_slides' : 0}})
+
+def __Campos__(Nreg,semilla=0):
+	#Campos de lluvia [mm] con celdas secas e intervalos secos
+	rs = np.random.RandomState(semilla)
+	Campos = rs.rand(Nreg,N)*5*(rs.rand(Nreg,N) < 0.5)
+	Campos[::4] = 0.0
+	return Campos
+
+def __Fechas__(Nreg,inicio=0):
+	return [FECHA + datetime.timedelta(minutes=5*(inicio+i)) for i in range(Nreg)]
+
+def __Escribe__(ruta,formato,Campos,fechas,**kwargs):
+	#Escribe los campos con un RainWriter y entrega los records
+	w = wmf.RainWriter(__Cuenca__(),ruta,umbral=0.0,formato=formato,**kwargs)
+	records = [w.write(c,f) for c,f in zip(Campos,fechas)]
+	w.close()
+	return np.array(records)
+
+def __LeeModels__(ruta,inicio,Nreg):
+	#Lee la lluvia con models igual que run_shia (tabla, binario e intervalos),
+	#con un indice virtual los binarios se abren a medida que se necesitan
+	models = wmf.models
+	models.rain_first_point = inicio
+	models.rain_read_table((ruta+'.idx').ljust(500),Nreg)
+	models.rain_arch_actual = 0
+	if models.rain_narch == 0:
+		models.rain_open_bin((ruta+'.bin').ljust(500),N)
+	Rain = np.array([models.rain_read_interval(t+1,N) for t in range(Nreg)])
+	models.rain_close_bin()
+	return Rain
+
+def __Lee__(ruta,inicio,Nreg):
+	#Lee la lluvia con RainReader
+	lector = wmf.RainReader(ruta+'.bin',ruta+'.idx',N)
+	Rain = lector.read(inicio,Nreg).T
+	lector.close()
+	return Rain
+
+@unittest.skipIf(wmf is None,'wmf (models, cu y sus dependencias) no esta disponible')
+class RainFormatsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_round_trip(self):
+		Campos = __Campos__(30)
+		fechas = __Fechas__(30)
+		for formato,marca in FORMATOS.iteritems():
+			ruta = os.path.join(self.dir,formato)
+			records = __Escribe__(ruta,formato,Campos,fechas)
+			#Marca del binario
+			f = open(ruta+'.bin','rb')
+			inicio = f.read(4)
+			f.close()
+			if marca is not None:
+				self.assertEqual(inicio,marca)
+			#Indice: record, lluvia y fecha de cada intervalo
+			Data = wmf.read_rain_index(ruta+'.idx')
+			secos = Campos.sum(axis=1) == 0
+			np.testing.assert_array_equal(Data['Record'].values,records)
+			self.assertTrue((records[secos] == 1).all())
+			self.assertTrue((records[~secos] > 1).all())
+			np.testing.assert_allclose(Data['Lluvia'].values,Campos.mean(axis=1),atol=1e-6)
+			self.assertEqual(list(Data.index.to_pydatetime()),fechas)
+			#Campos: cuantizados a 0.001 mm o a la escala del formato uint16
+			tolerancia = 0.001
+			if formato == 'uint16':
+				tolerancia = Campos.max()/65535.0
+			Rain = __Lee__(ruta,1,30)
+			self.assertTrue(np.abs(Rain - Campos).max() <= tolerancia)
+			#models lee lo mismo que RainReader
+			np.testing.assert_array_equal(__LeeModels__(ruta,1,30),Rain)
+			np.testing.assert_array_equal(__LeeModels__(ruta,11,20),Rain[10:])
+
+	def test_dedupe(self):
+		Campos = __Campos__(12)
+		Campos[6:] = Campos[:6]
+		for formato in FORMATOS:
+			ruta = os.path.join(self.dir,formato)
+			records = __Escribe__(ruta,formato,Campos,__Fechas__(12),dedupe=True)
+			np.testing.assert_array_equal(records[6:],records[:6])
+			np.testing.assert_array_equal(__Lee__(ruta,7,6),__Lee__(ruta,1,6))
+
+	def test_resume(self):
+		Campos = __Campos__(40)
+		fechas = __Fechas__(40)
+		for formato in FORMATOS:
+			completo = os.path.join(self.dir,formato+'_completo')
+			ruta = os.path.join(self.dir,formato)
+			__Escribe__(completo,formato,Campos,fechas,Nbuffer=8)
+			#Caida: quedan en disco los bloques escritos, el que estaba en
+			#memoria se pierde
+			w = wmf.RainWriter(__Cuenca__(),ruta,umbral=0.0,formato=formato,Nbuffer=8)
+			for c,f in zip(Campos[:20],fechas[:20]):
+				w.write(c,f)
+			w.cola.join()
+			w.fbin.close(); w.fidx.close()
+			self.assertEqual(wmf.read_rain_index(ruta+'.idx').shape[0],16)
+			#Continua desde el ultimo bloque completo
+			w = wmf.RainWriter(__Cuenca__(),ruta,umbral=0.0,status='old',Nbuffer=8)
+			for c,f in zip(Campos[16:],fechas[16:]):
+				w.write(c,f)
+			w.close()
+			for ext in ['.bin','.idx']:
+				self.assertEqual(open(ruta+ext,'rb').read(),open(completo+ext,'rb').read())
+
+	def test_virtual_index(self):
+		Campos = __Campos__(30)
+		fechas = __Fechas__(30)
+		for formato in FORMATOS:
+			#Dos fuentes mensuales y su union virtual
+			partes = []
+			for i in range(2):
+				ruta = os.path.join(self.dir,'%s_%d' % (formato,i))
+				__Escribe__(ruta,formato,Campos[15*i:15*(i+1)],fechas[15*i:15*(i+1)])
+				partes.append(ruta)
+			union = os.path.join(self.dir,formato+'_union')
+			wmf.concat_rain_index([p+'.idx' for p in partes],union+'.idx')
+			Rain = np.vstack([__Lee__(p,1,15) for p in partes])
+			np.testing.assert_array_equal(__Lee__(union,1,30),Rain)
+			np.testing.assert_array_equal(__LeeModels__(union,1,30),Rain)
+			#Periodo de la union
+			pedazo = os.path.join(self.dir,formato+'_pedazo')
+			wmf.slice_rain_index(union+'.idx',pedazo+'.idx',fechaI=fechas[10],fechaF=fechas[24])
+			np.testing.assert_array_equal(__LeeModels__(pedazo,1,15),Rain[10:25])
+			self.assertEqual(wmf.find_rain_index(pedazo+'.idx',fechas[12]),3)
+			#A un indice virtual no se le agregan campos
+			self.assertRaises(ValueError,wmf.RainWriter,__Cuenca__(),union,status='old')
+
+	def test_find_rain_index(self):
+		Campos = __Campos__(20)
+		regulares = __Fechas__(20)
+		irregulares = regulares[:10] + __Fechas__(10,inicio=15)
+		for nombre,fechas in [('regular',regulares),('irregular',irregulares)]:
+			ruta = os.path.join(self.dir,nombre)
+			__Escribe__(ruta,'dense',Campos,fechas)
+			for pos in [1,7,20]:
+				self.assertEqual(wmf.find_rain_index(ruta+'.idx',fechas[pos-1]),pos)
+			self.assertRaises(ValueError,wmf.find_rain_index,ruta+'.idx',
+				FECHA - datetime.timedelta(minutes=5))
+
+	def test_unknown_index_version(self):
+		ruta = os.path.join(self.dir,'lluvia')
+		__Escribe__(ruta,'dense',__Campos__(5),__Fechas__(5))
+		f = open(ruta+'.idx','r+b')
+		f.seek(4)
+		f.write(np.array([2],dtype=np.int32).tostring())
+		f.close()
+		self.assertRaises(ValueError,wmf.read_rain_index,ruta+'.idx')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -42,6 +42,18 @@ integer, allocatable :: idEvento(:), posEvento(:) !Id del evento y pos al interi
 character*500 rute_speed !Escritura de mapas de velocidad [N_reg,4,Nceldas]
 character*500 rute_storage !Escritura de mapas de almacenamiento [N_reg,5,Nceldas]
 
+!Variables del lector de lluvia, el binario se abre una sola vez por ejecucion
+integer, parameter :: rain_unit = 21 !Unidad en la que permanece abierto el binario de lluvia
+integer rain_format !Formato del binario abierto: 1. denso (int32 por celda), 2. disperso (indices y valores), 3. uint16 con escala
+real, allocatable :: escEvento(:) !Escala [mm] de cada intervalo en el formato uint16 (viene del indice)
+character*500 rain_ruta_virtual !Indice virtual que tiene las rutas de los binarios
+integer rain_narch !Cantidad de binarios del indice virtual (0: el indice no es virtual)
+integer, allocatable :: arcEvento(:) !Binario del indice virtual que tiene el record de cada intervalo
+integer rain_arch_actual !Binario del indice virtual que se encuentra abierto (0: ninguno)
+integer rain_pos_actual !Record que se encuentra cargado en rain_buffer (1: campo de ceros)
+integer, allocatable :: rain_buffer(:) !Ultimo campo leido del binario
+integer(kind=8), allocatable :: rain_offsets(:) !Posicion en bytes de cada record en el formato disperso
+
 !Variables de propiedades geomorfologicas
 integer, allocatable :: drena(:,:) !Indicador de la topologia de la cuenca 
 integer, allocatable :: unit_type(:,:) !Tipo de celda: 1. ladera, 2. Carcava, 3. Cauce fijo
@@ -69,16 +81,25 @@ integer sim_slides !Simula (1) o no (0) deslizamientos
 integer save_storage !Guarda (1) o no (0) almacenamiento de los tanques en cada intervalo.
 integer save_speed !Guarda (1) o no (0) las velocidades en cada intervalo
 integer separate_fluxes !Separa (1) o no (0) los flujos que componen el caudal (base, sub-superficial y runoff)
+integer continuar_estado !Si es 1 shia_v1 continua desde el estado del modulo (velocidades, retorno, flujos, sedimentos y deslizamientos) en vez de reiniciarlo
+integer paso_inicio !Numero de intervalos ya simulados antes de esta llamada, desplaza los registros de ruta_storage y rute_speed
+real recession_tol !Almacenamiento [mm] bajo el cual un tanque no lineal de una celda seca se vacia en el intervalo (0: modelo completo)
+integer speed_solver !Solucion de la onda cinematica: 1 (o 0): 4 iteraciones de punto fijo, 2: Newton hasta speed_tol
+real speed_tol !Cambio relativo de la velocidad en que para Newton (speed_solver = 2)
 integer speed_type(3) !Tipo de velocidad para tanque 1, 2 y 3: 1: lineal, 2: Cinematica Potencial, de momento no hay mas implementadas 
 integer, allocatable :: control(:,:) !Celdas de la cuenca que tienen puntos de control
 integer, allocatable :: control_h(:,:) !Celdas de la cuenca que son puntos de control de humedad
 integer, allocatable :: guarda_cond(:,:) !Intervalos de tiempo en que se hace guardado de condiciones
+integer medir_fases !Mide los tiempos de shia_v1: 0 no mide, 1 lluvia, celdas y escritura, 2 ademas cada fase de las celdas
+real*8 fases_tiempo(9) !Tiempo acumulado [s]: 1. lectura de lluvia, 2. ciclo de celdas, 3. flujo vertical, 4. velocidad en ladera, 5. canal, 6. sedimentos, 7. deslizamientos, 8. escritura de mapas, 9. total
+integer(kind=8) fases_conteo(6) !Conteos acumulados: 1. lecturas de lluvia, 2. bytes de lluvia leidos, 3. escrituras de mapas, 4. bytes escritos, 5. intervalos secos, 6. intervalos con lluvia
 
 !Variables de resultados globales (siempre van a estar ahi)
 real, allocatable :: Storage(:,:) !Almacenamiento de los 5 tanques del modelo
 real, allocatable :: Speed_map(:,:) !Mapa de velocidades en los tanques, solo se activa si se da la opcion save_speed
 real, allocatable :: Mean_Rain(:,:) !Serie de lluvia promedio en la cuenca [mm]
 real, allocatable :: Fluxes(:,:) !Matriz de flujos separados (3,nelem), 1: Superficial, 2: sub-superficial, 3: subterraneo
+real, allocatable :: hspeed_estado(:,:) !Velocidades horizontales al final de la ultima ejecucion de shia_v1 (4,nelem)
 
 !variables de sedimentos Par aalojar volumens y demas
 real sed_factor !factor para calibrar el modelo de sedimentos
@@ -128,8 +149,6 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,N_cel,N_cont,N_contH,N_reg,Q,&
      
 	!Variables de la lluvia
 	real Rain(N_cel) !Lluvia leida en el intervalo de tiempo [mm] [1,N_cel]
-	integer RainInt(N_cel)
-	integer Res !Dice si se leyo bien o no la lluvia 
 	real rain_sum
 	!Variables de iteracion
 	integer celda,tiempo !Iteradores para la cantidad de celdas y los intervalos de tiempo
@@ -151,14 +170,23 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,N_cel,N_cont,N_contH,N_reg,Q,&
 	real vspeed(4,N_cel) !Velocidad vertical [cm/h]
 	real hspeed(4,N_cel) !Velocidad horizontal [cm/h] o [m/s]
 	real section_area !Area de la seccion resuleta en ladera o en el canal 
+	logical vacia !El tanque se resuelve con la recesion rapida (calc_recession)
 	!Variables Max storage en tanques 1 y 3
 	real H(2,N_cel)
 	!Variables sub-modelo de sedimentos
 	real Area_coef(nceldas) !Coeficiente para el calculo del lateral en cada celda del tanque 2 para calcuo de sedimentos
     real Vsal_sed(3) !Volumen de salida de cada fraccion de sedimentos [m3/seg]
+	!Variables de medicion de tiempos (solo si medir_fases > 0)
+	real*8 t_ini,t_paso,t_fase,t_ahora
+	integer Nciclo !Intervalos que se simulan en el ciclo de abajo (solo con sedimentos o deslizamientos)
 	
-	!Lee los vectores de estructura de guardado de la lluvia 
-	call rain_read_ascii_table(ruta_hdr,N_reg)
+	if (medir_fases .gt. 0) t_ini = reloj()
+	!Lee los vectores de estructura de guardado de la lluvia (.hdr o .idx)
+	call rain_read_table(ruta_hdr,N_reg)
+	!Abre el binario de lluvia una sola vez para toda la ejecucion, con un
+	!indice virtual los binarios se abren a medida que se necesitan
+	rain_arch_actual = 0
+	if (rain_narch .eq. 0) call rain_open_bin(ruta_bin,N_cel)
 	!Inicia la variable global de lluvia promedio sobre la cuenca
 	if (allocated(Mean_Rain)) deallocate(Mean_Rain)
 	allocate(Mean_Rain(1,N_reg))
@@ -179,12 +207,16 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,N_cel,N_cont,N_contH,N_reg,Q,&
 		vspeed(i,:)=v_coef(i,:)*Calib(i)*dt ! Cantidad [mm] que baja de tanque a tanque
 		hspeed(i,:)=h_coef(i,:)*Calib(i+4) ! Velocidad [mm/seg] que se mueve
 	enddo
+	!Si continua una ejecucion anterior parte de las velocidades en que esta quedo
+	if (continuar_estado .eq. 1 .and. allocated(hspeed_estado)) then
+		if (size(hspeed_estado,2) .eq. N_cel) hspeed = hspeed_estado
+	endif
 	!Calcula parametros estaticos en el tiempo
 	H(1,:)=Max_capilar(1,:)*Calib(9)
 	H(2,:)=Max_gravita(1,:)*Calib(10)
 	
 	!Si hay retorno aloja la matriz donde guarda cuando ocurren los retornos
-	if (retorno .eq. 1) then 
+	if (retorno .eq. 1 .and. (continuar_estado .eq. 0 .or. .not. allocated(Retorned))) then 
 		if (allocated(Retorned)) deallocate(Retorned)
 		allocate(Retorned(1,N_cel))
 		Retorned = 0.0
@@ -204,14 +236,24 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,N_cel,N_cont,N_contH,N_reg,Q,&
 		call slide_allocate
 	endif
 	!Si va a registrar flujos por separado:
-	if (separate_fluxes .eq. 1) then
+	if (separate_fluxes .eq. 1 .and. (continuar_estado .eq. 0 .or. .not. allocated(Fluxes))) then
 		if (allocated(Fluxes)) deallocate(Fluxes)
 		allocate(Fluxes(3,N_cel))
 		Fluxes = 0.0
 	endif
 	
+	!Sin sedimentos ni deslizamientos la fisica es la de shia_core, se simula por
+	!bloques de intervalos y el ciclo de abajo no se ejecuta
+	Nciclo = N_reg
+	if (sim_sediments .eq. 0 .and. sim_slides .eq. 0) then
+		call shia_v1_bloques(calib,N_cel,N_cont,N_contH,N_reg,hspeed,StoOut,Q,&
+			& Qseparated,Hum,balance,ruta_storage)
+		Qsed = 0.0
+		Nciclo = 0
+	endif
+	
 	!Iter in the time
-	do tiempo=1,N_reg
+	do tiempo=1,Nciclo
 		
 		!Actualiza contadores 
 		control_cont=2
@@ -221,19 +263,19 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,N_cel,N_cont,N_contH,N_reg,Q,&
 		StoAtras = sum(StoOut)
 		
 		!Lee la lluvia 
-		if (posEvento(tiempo) .eq. 1) then
-			Rain = 0.0
-		else
-			call read_int_basin(ruta_bin, posEvento(tiempo),&
-				& N_cel, RainInt, Res) 
-			Rain = RainInt / 1000.0
-		endif
+		if (medir_fases .gt. 0) t_paso = reloj()
+		call rain_read_interval(tiempo,N_cel,Rain)
 		rain_sum = 0.0
-		
+		if (medir_fases .gt. 0) then
+			t_ahora = reloj()
+			fases_tiempo(1) = fases_tiempo(1) + t_ahora - t_paso
+			t_paso = t_ahora
+		endif
 		
 		!Iter around the cells or hills
 		do celda=1,N_cel
 			
+			if (medir_fases .gt. 1) t_fase = reloj()
 			!determina el elemento objetivo y realiza balance de lluvia
 			drenaid = N_cel-drena(1,celda)+1
 			entradas = entradas+Rain(celda)
@@ -242,8 +284,9 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,N_cel,N_cont,N_contH,N_reg,Q,&
 			!Determina el flujo vertical entre tanques
 			vflux(1) = max(0.0, Rain(celda)-H(1,celda)+StoOut(1,celda)) ![mm]
 			StoOut(1,celda)=StoOut(1,celda)+Rain(celda)-vflux(1) ![mm]
-			Evp_loss=min(vspeed(1,celda)*(StoOut(1,celda)/H(1,celda))**0.6,&
-				&StoOut(1,celda)) ![mm]
+			Evp_loss=0.0
+			if (StoOut(1,celda) .ne. 0.0) Evp_loss=min(vspeed(1,celda)*&
+				&(StoOut(1,celda)/H(1,celda))**0.6,StoOut(1,celda)) ![mm]
 			StoOut(1,celda)=StoOut(1,celda)-Evp_loss ![mm]			
 			do i=1,3
 				vflux(i+1)=min(vflux(i),vspeed(i+1,celda)) ![mm]
@@ -258,6 +301,7 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,N_cel,N_cont,N_contH,N_reg,Q,&
 			endif
 			!Actualiza la salida del balance por evaporacion y perdidas
 			salidas=salidas+vflux(4)+Evp_loss ![mm]			
+			if (medir_fases .gt. 1) call medir_fase(3,t_fase)
 			
 			!Calcula el flujo que sale de los tanques 2 a 4
 			do i=1,3
@@ -269,14 +313,21 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,N_cel,N_cont,N_contH,N_reg,Q,&
 							& hill_long(1,celda)))*StoOut(i+1,celda)						
 					!Caso no lineal potencial 
 					case(2)	
-						call calc_speed(StoOut(i+1,celda)*m3_mmHill(celda), h_coef(i,celda),&
-							& h_exp(i,celda), hill_long(1,celda), hspeed(i,celda), section_area)
-						hflux(i)=min(Calib(i+4)*section_area*hspeed(i,celda)*dt/m3_mmHill(celda),&
-							& StoOut(i+1,celda))![mm]
+						call calc_recession(StoOut(i+1,celda), Rain(celda), recession_tol,&
+							& h_exp(i,celda), hspeed(i,celda), vacia)
+						if (vacia) then
+							hflux(i)=StoOut(i+1,celda)
+						else
+							call calc_speed(StoOut(i+1,celda)*m3_mmHill(celda), h_coef(i,celda),&
+								& h_exp(i,celda), hill_long(1,celda), hspeed(i,celda), section_area)
+							hflux(i)=min(Calib(i+4)*section_area*hspeed(i,celda)*dt/m3_mmHill(celda),&
+								& StoOut(i+1,celda))![mm]
+						endif
 				end select
 				!Actualiza el almacenamiento
 				StoOut(i+1,celda)=StoOut(i+1,celda)-hflux(i)	
 			enddo	
+			if (medir_fases .gt. 1) call medir_fase(4,t_fase)
 				
 			!Envia los flujos que salieron de acuerdo al tipo de celda 
 			if (unit_type(1,celda).eq.1) then
@@ -296,10 +347,16 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,N_cel,N_cont,N_contH,N_reg,Q,&
 					& hflux(3)*(unit_type(1,celda)-2) !celda tipo 2 se anula el flujo del tanque 4
 				
 				!Resuelve el transporte en el canal 
-				call calc_speed(StoOut(5,celda)*m3_mmRivers(celda), h_coef(4,celda),&
-					& h_exp(4,celda), stream_long(1,celda), hspeed(4,celda), section_area)
-				hflux(4)=min(section_area*hspeed(4,celda)*dt*Calib(8)/m3_mmRivers(celda),&
-					&StoOut(5,celda)) ![mm]				
+				call calc_recession(StoOut(5,celda), Rain(celda), recession_tol,&
+					& h_exp(4,celda), hspeed(4,celda), vacia)
+				if (vacia) then
+					hflux(4)=StoOut(5,celda)
+				else
+					call calc_speed(StoOut(5,celda)*m3_mmRivers(celda), h_coef(4,celda),&
+						& h_exp(4,celda), stream_long(1,celda), hspeed(4,celda), section_area)
+					hflux(4)=min(section_area*hspeed(4,celda)*dt*Calib(8)/m3_mmRivers(celda),&
+						&StoOut(5,celda)) ![mm]				
+				endif
 				
 				!!!!!!! Separacion de flujo (solo funciona si la activan) !!!!!!!!
 				if (separate_fluxes .eq. 1) then
@@ -326,6 +383,7 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,N_cel,N_cont,N_contH,N_reg,Q,&
 				endif
 				
 			endif
+			if (medir_fases .gt. 1) call medir_fase(5,t_fase)
 			
 			!Si evalua tte de sedimentos calcula el tte en ladera y cauce
 			if (sim_sediments .eq. 1) then
@@ -343,11 +401,14 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,N_cel,N_cont,N_contH,N_reg,Q,&
 						Qsed(i,1,tiempo)=Vsal_sed(i)
 					enddo  
 				endif
+				if (medir_fases .gt. 1) call medir_fase(6,t_fase)
 			endif
 			
 			!Si evalua deslizamientos
-			if (sim_slides.eq.1) call slide_ocurrence(celda, StoOut(3,celda)&
-				&, H(2,celda))
+			if (sim_slides.eq.1) then
+				call slide_ocurrence(celda, StoOut(3,celda), H(2,celda))
+				if (medir_fases .gt. 1) call medir_fase(7,t_fase)
+			endif
 			
 			!Record de variables y resultados del modelo
 			!Caudales en el punto de control
@@ -376,14 +437,33 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,N_cel,N_cont,N_contH,N_reg,Q,&
 		
 		!Obtiene la lluvia promedio para el intervalo de tiempo
 		Mean_Rain(1,tiempo)=rain_sum/N_cel
+		if (medir_fases .gt. 0) then
+			t_ahora = reloj()
+			fases_tiempo(2) = fases_tiempo(2) + t_ahora - t_paso
+			t_paso = t_ahora
+			if (rain_sum .eq. 0.0) then
+				fases_conteo(5) = fases_conteo(5) + 1
+			else
+				fases_conteo(6) = fases_conteo(6) + 1
+			endif
+		endif
 		
 		!Mapas de velocidad del flujo, muestra la velocidad promedio 
 		if (save_storage .eq. 1) then
-			call write_float_basin(ruta_storage,StoOut,tiempo,N_cel,5)
+			call write_float_basin(ruta_storage,StoOut,tiempo+paso_inicio,N_cel,5)
+			if (medir_fases .gt. 0) then
+				fases_conteo(3) = fases_conteo(3) + 1
+				fases_conteo(4) = fases_conteo(4) + 20*int(N_cel,8)
+			endif
 		endif
 		if (save_speed .eq. 1) then
-			call write_float_basin(rute_speed,hspeed,tiempo,N_cel,4)
+			call write_float_basin(rute_speed,hspeed,tiempo+paso_inicio,N_cel,4)
+			if (medir_fases .gt. 0) then
+				fases_conteo(3) = fases_conteo(3) + 1
+				fases_conteo(4) = fases_conteo(4) + 16*int(N_cel,8)
+			endif
 		endif
+		if (medir_fases .gt. 0) fases_tiempo(8) = fases_tiempo(8) + reloj() - t_paso
 		
 		!Actualiza balance 
 		balance(tiempo) = sum(StoOut)-StoAtras - entradas + salidas
@@ -397,6 +477,419 @@ subroutine shia_v1(ruta_bin,ruta_hdr,calib,N_cel,N_cont,N_contH,N_reg,Q,&
 		endif
 	enddo
 	
+	!Cierra el binario de lluvia
+	call rain_close_bin
+	!Guarda las velocidades finales para poder continuar la ejecucion
+	if (allocated(hspeed_estado)) deallocate(hspeed_estado)
+	allocate(hspeed_estado(4,N_cel))
+	hspeed_estado = hspeed
+	if (medir_fases .gt. 0) fases_tiempo(9) = fases_tiempo(9) + reloj() - t_ini
+	
+end subroutine
+
+!Simula para shia_v1 con shia_core los intervalos de un modelo sin sedimentos ni
+!deslizamientos: lee la lluvia del bloque con el lector del modulo y pasa a shia_core
+!las variables del modulo, el estado (StoOut, hspeed, Fluxes, Retorned) queda
+!actualizado. Con guardado de mapas cada bloque es un intervalo. Con medir_fases = 2
+!shia_core mide las fases de la celda (vertical, ladera, canal).
+subroutine shia_v1_bloques(calib,N_cel,N_cont,N_contH,N_reg,hspeed,StoOut,Q,&
+	& Qseparated,Hum,balance,ruta_storage)
+	!Variables de entrada
+	integer, intent(in) :: N_cel,N_cont,N_contH,N_reg
+	real, intent(in) :: calib(10)
+	character*500, intent(in), optional :: ruta_storage
+	!Estado y resultados de shia_v1
+	real, intent(inout) :: hspeed(4,N_cel),StoOut(5,N_cel)
+	real, intent(inout) :: Q(N_cont,N_reg),Qseparated(N_cont,3,N_reg),Hum(N_contH,N_reg)
+	real, intent(inout) :: balance(N_reg)
+	!Variables locales
+	integer drena_v(N_cel),unit_v(N_cel),control_v(N_cel),controlh_v(N_cel)
+	integer orden(N_cel),grupos(2),niveles(2),tipos(6),i,t0,nb,Nbloque
+	real geo(4,N_cel),Hmax(2,N_cel),tols(2),tiempo_r
+	real FluxAux(3,N_cel),RetAux(N_cel)
+	real, allocatable :: Rain(:,:)
+	real*8 t_paso,t_ahora,fases(3)
+	!La cuenca con la forma que recibe shia_core, en serie
+	drena_v = drena(1,:); unit_v = unit_type(1,:)
+	control_v = control(1,:); controlh_v = control_h(1,:)
+	geo(1,:) = hill_long(1,:); geo(2,:) = stream_long(1,:)
+	geo(3,:) = stream_width(1,:); geo(4,:) = elem_area(1,:)
+	Hmax(1,:) = Max_capilar(1,:); Hmax(2,:) = Max_gravita(1,:)
+	tipos(1:3) = speed_type; tipos(4) = int(retorno)
+	tipos(5) = separate_fluxes; tipos(6) = speed_solver
+	tols = (/ recession_tol, speed_tol /)
+	orden = (/ (i, i=1,N_cel) /); grupos = (/ 1, N_cel+1 /); niveles = (/ 1, 2 /)
+	!Flujos separados y retorno del modulo (shia_v1 ya los alojo si se usan)
+	FluxAux = 0.0; RetAux = 0.0
+	if (separate_fluxes .eq. 1) FluxAux = Fluxes
+	if (retorno .eq. 1) RetAux = Retorned(1,:)
+	!Bloques de maximo 128 MB de lluvia, de un intervalo si se guardan mapas
+	if (save_storage .eq. 1 .or. save_speed .eq. 1) then
+		Nbloque = 1
+	else
+		Nbloque = max(1, min(N_reg, 2**25/N_cel))
+	endif
+	allocate(Rain(N_cel,Nbloque))
+	do t0=1,N_reg,Nbloque
+		nb = min(Nbloque, N_reg-t0+1)
+		!Lee la lluvia del bloque
+		if (medir_fases .gt. 0) t_paso = reloj()
+		do i=1,nb
+			call rain_read_interval(t0+i-1,N_cel,Rain(:,i))
+		enddo
+		if (medir_fases .gt. 0) then
+			t_ahora = reloj()
+			fases_tiempo(1) = fases_tiempo(1) + t_ahora - t_paso
+			t_paso = t_ahora
+		endif
+		!Simula el bloque, las salidas van directo a su lugar en las de shia_v1
+		call shia_core(Rain,calib,drena_v,unit_v,control_v,controlh_v,geo,&
+			& v_coef,h_coef,h_exp,Hmax,tipos,dt,tols,orden,grupos,niveles,1,&
+			& N_cel,nb,N_cont,N_contH,1,1,1,&
+			& StoOut,hspeed,FluxAux,RetAux,Q(1,t0),Qseparated(1,1,t0),Hum(1,t0),&
+			& balance(t0),Mean_Rain(1,t0),merge(1,0,medir_fases .gt. 1),fases)
+		if (medir_fases .gt. 0) then
+			t_ahora = reloj()
+			fases_tiempo(2) = fases_tiempo(2) + t_ahora - t_paso
+			t_paso = t_ahora
+			if (medir_fases .gt. 1) fases_tiempo(3:5) = fases_tiempo(3:5) + fases
+			do i=t0,t0+nb-1
+				if (Mean_Rain(1,i) .eq. 0.0) then
+					fases_conteo(5) = fases_conteo(5) + 1
+				else
+					fases_conteo(6) = fases_conteo(6) + 1
+				endif
+			enddo
+		endif
+		!Mapas de almacenamiento y velocidad (bloques de un intervalo)
+		if (save_storage .eq. 1) then
+			call write_float_basin(ruta_storage,StoOut,t0+paso_inicio,N_cel,5)
+			if (medir_fases .gt. 0) then
+				fases_conteo(3) = fases_conteo(3) + 1
+				fases_conteo(4) = fases_conteo(4) + 20*int(N_cel,8)
+			endif
+		endif
+		if (save_speed .eq. 1) then
+			call write_float_basin(rute_speed,hspeed,t0+paso_inicio,N_cel,4)
+			if (medir_fases .gt. 0) then
+				fases_conteo(3) = fases_conteo(3) + 1
+				fases_conteo(4) = fases_conteo(4) + 16*int(N_cel,8)
+			endif
+		endif
+		if (medir_fases .gt. 0) fases_tiempo(8) = fases_tiempo(8) + reloj() - t_paso
+		if (verbose .eq. 1) then 
+			tiempo_r = t0+nb-1
+			print *, tiempo_r/N_reg
+		endif
+	enddo
+	deallocate(Rain)
+	if (separate_fluxes .eq. 1) Fluxes = FluxAux
+	if (retorno .eq. 1) Retorned(1,:) = RetAux
+end subroutine
+
+!Reloj de pared [s] para medir las fases de shia_v1
+real*8 function reloj()
+	integer(kind=8) cuenta,tasa
+	call system_clock(cuenta,tasa)
+	reloj = dble(cuenta)/dble(tasa)
+end function
+!Suma a la fase el tiempo desde t_fase y reinicia t_fase
+subroutine medir_fase(fase,t_fase)
+	integer, intent(in) :: fase
+	real*8, intent(inout) :: t_fase
+	call sumar_fase(fases_tiempo(fase),t_fase)
+end subroutine
+!Suma al acumulado el tiempo desde t_fase y reinicia t_fase (cada hilo de shia_core
+!tiene sus acumulados)
+subroutine sumar_fase(acumulado,t_fase)
+	real*8, intent(inout) :: acumulado,t_fase
+	real*8 t_ahora
+	t_ahora = reloj()
+	acumulado = acumulado + t_ahora - t_fase
+	t_fase = t_ahora
+end subroutine
+
+!Version re-entrante del modelo (sin sedimentos, deslizamientos ni guardado de mapas):
+!no usa variables del modulo, la cuenca, su estado y la lluvia del bloque de intervalos
+!entran como argumentos, asi varias cuencas se pueden simular a la vez desde diferentes
+!hilos (f2py libera el GIL). El estado (Sto, Speed, Flux, Ret) se actualiza en el sitio
+!y sirve para continuar la simulacion en el siguiente bloque.
+!Simula Nm miembros (calibraciones o estados iniciales) a la vez: la lluvia y la
+!topologia se recorren una vez y los miembros son la primera dimension de cada variable,
+!una ejecucion normal es Nm = 1.
+!Las celdas se recorren por niveles de grupos (p.ej. laderas): los grupos de un nivel no
+!drenan entre ellos y se ejecutan en paralelo (OpenMP, Nhilos), dentro de un grupo las
+!celdas van en orden. Cada celda recoge lo que le entregan las celdas de arriba en el
+!orden de la ejecucion en serie, asi el resultado no depende del orden de los grupos.
+!En serie: orden = 1..N_cel, grupos = (/1, N_cel+1/), niveles = (/1, 2/).
+!Con medir = 1 cada hilo suma el tiempo de las fases de sus celdas (vertical, ladera,
+!canal) y fases tiene la suma de los hilos.
+subroutine shia_core(Rain,calib,drena_in,unit_in,control_in,controlh_in,geo,&
+	& vcoef,hcoef,hexp,Hmax,tipos,delta,tols,orden,grupos,niveles,Nhilos,&
+	& N_cel,N_reg,N_cont,N_contH,Nm,Ngrupos,Nniveles,&
+	& Sto,Speed,Flux,Ret,Q,Qseparated,Hum,balance,MeanRain,medir,fases)
+	!f2py threadsafe
+	!Variables de entrada
+	integer, intent(in) :: N_cel,N_reg,N_cont,N_contH,Nm,Ngrupos,Nniveles,Nhilos
+	integer, intent(in) :: medir !Mide el tiempo de las fases de la celda: 0 no, 1 si
+	!f2py integer optional, intent(in) :: medir = 0
+	real, intent(in) :: Rain(N_cel,N_reg) !Lluvia de cada intervalo del bloque [mm]
+	real, intent(in) :: calib(10,Nm),delta
+	real, intent(in) :: tols(2) !1. recession_tol (0 es el modelo completo), 2. speed_tol
+	integer, intent(in) :: drena_in(N_cel),unit_in(N_cel) !Topologia y tipo de celda
+	integer, intent(in) :: control_in(N_cel),controlh_in(N_cel) !Puntos de control de caudal y humedad
+	real, intent(in) :: geo(4,N_cel) !1. hill_long, 2. stream_long, 3. stream_width, 4. elem_area
+	real, intent(in) :: vcoef(4,N_cel),hcoef(4,N_cel),hexp(4,N_cel)
+	real, intent(in) :: Hmax(2,N_cel) !1. Max_capilar, 2. Max_gravita
+	integer, intent(in) :: tipos(6) !1-3. speed_type, 4. retorno, 5. separate_fluxes, 6. speed_solver
+	integer, intent(in) :: orden(N_cel) !Celdas ordenadas por nivel y grupo
+	integer, intent(in) :: grupos(Ngrupos+1) !Inicio de cada grupo en orden
+	integer, intent(in) :: niveles(Nniveles+1) !Primer grupo de cada nivel
+	!Estado de la cuenca para cada miembro
+	real, intent(inout) :: Sto(Nm,5,N_cel) !Almacenamiento en los tanques
+	real, intent(inout) :: Speed(Nm,4,N_cel) !Velocidad horizontal (hspeed)
+	real, intent(inout) :: Flux(Nm,3,N_cel) !Flujos separados (solo si tipos(5) = 1)
+	real, intent(inout) :: Ret(Nm,N_cel) !Retorno acumulado del tanque 3 al 2 (solo si tipos(4) = 1)
+	!Variables de salida
+	real, intent(out) :: Q(Nm,N_cont,N_reg),Qseparated(Nm,N_cont,3,N_reg),Hum(Nm,N_contH,N_reg)
+	real, intent(out) :: balance(Nm,N_reg),MeanRain(N_reg)
+	real*8, intent(out) :: fases(3) !Tiempo [s] de los hilos en: 1. flujo vertical, 2. ladera, 3. canal y entregas
+	!Variables locales 
+	integer celda,tiempo,drenaid,i,m,j,k,g,nivel,origen
+	real*8 t_fase,t_vert,t_lad,t_can
+	real rain_sum,lluvia
+	real entradas(Nm),salidas(Nm),StoAtras(Nm),Retorno(Nm),Evp_loss(Nm),section_area(Nm)
+	real vflux(Nm,4),hflux(Nm,4)
+	logical vacia
+	real m3_mmHill(N_cel),m3_mmRivers(N_cel),vspeed(Nm,4,N_cel),H(Nm,2,N_cel)
+	!Lo que cada celda entrega aguas abajo y lo que pierde en el intervalo
+	real aporte(Nm,4,N_cel),aporteF(Nm,3,N_cel),perdidas(Nm,2,N_cel)
+	!Celdas que drenan a cada celda (en orden ascendente) y filas de los puntos de control
+	integer arriba_ini(N_cel+1),arriba(N_cel),llenas(N_cel),fila_q(N_cel),fila_h(N_cel)
+	!Conversiones y parametros que dependen de la calibracion
+	m3_mmHill = geo(4,:)/1000.0
+	m3_mmRivers = (geo(2,:)*geo(3,:))/1000.0
+	do m=1,Nm
+		do i=1,4
+			vspeed(m,i,:)=vcoef(i,:)*calib(i,m)*delta
+		enddo
+		H(m,1,:)=Hmax(1,:)*calib(9,m)
+		H(m,2,:)=Hmax(2,:)*calib(10,m)
+	enddo
+	!Topologia invertida y filas de salida de los puntos de control
+	llenas = 0
+	do celda=1,N_cel
+		if (drena_in(celda).ne.0) then
+			drenaid = N_cel-drena_in(celda)+1
+			llenas(drenaid) = llenas(drenaid)+1
+		endif
+	enddo
+	arriba_ini(1) = 1
+	do celda=1,N_cel
+		arriba_ini(celda+1) = arriba_ini(celda)+llenas(celda)
+	enddo
+	llenas = 0
+	do celda=1,N_cel
+		if (drena_in(celda).ne.0) then
+			drenaid = N_cel-drena_in(celda)+1
+			arriba(arriba_ini(drenaid)+llenas(drenaid)) = celda
+			llenas(drenaid) = llenas(drenaid)+1
+		endif
+	enddo
+	fila_q = 0; fila_h = 0; i = 1; j = 0
+	do celda=1,N_cel
+		if (control_in(celda).ne.0) then
+			i = i+1; fila_q(celda) = i
+		endif
+		if (controlh_in(celda).ne.0) then
+			j = j+1; fila_h(celda) = j
+		endif
+	enddo
+	Q = 0.0; Qseparated = 0.0; Hum = 0.0
+	aporte = 0.0; aporteF = 0.0
+	t_vert = 0.0d0; t_lad = 0.0d0; t_can = 0.0d0
+	!Itera en el tiempo 
+	do tiempo=1,N_reg
+		do m=1,Nm
+			StoAtras(m) = sum(Sto(m,:,:))
+		enddo
+		!Itera en las celdas o laderas por niveles, las condiciones son iguales para
+		!todos los miembros y quedan por fuera de los ciclos sobre los miembros
+		do nivel=1,Nniveles
+			!$omp parallel do schedule(dynamic) num_threads(Nhilos) default(shared)&
+			!$omp& private(g,k,j,celda,origen,i,m,lluvia,vflux,hflux,Retorno,Evp_loss,section_area,vacia,t_fase)&
+			!$omp& reduction(+:t_vert,t_lad,t_can)
+			do g=niveles(nivel),niveles(nivel+1)-1
+			do k=grupos(g),grupos(g+1)-1
+			celda = orden(k)
+			lluvia = Rain(celda,tiempo)
+			if (medir .eq. 1) t_fase = reloj()
+			!Recibe lo que entregan las celdas de arriba
+			do j=arriba_ini(celda),arriba_ini(celda+1)-1
+				origen = arriba(j)
+				if (unit_in(origen).eq.1) then
+					do i=1,3
+						Sto(:,i+1,celda)=Sto(:,i+1,celda)+aporte(:,i,origen)
+					enddo
+				else
+					Sto(:,4,celda)=Sto(:,4,celda)+aporte(:,3,origen)*(3-unit_in(origen))
+					Sto(:,5,celda)=Sto(:,5,celda)+aporte(:,4,origen)
+					if (tipos(5) .eq. 1) then
+						Flux(:,:,celda) = Flux(:,:,celda) + aporteF(:,:,origen)
+					endif
+				endif
+			enddo
+			if (medir .eq. 1) call sumar_fase(t_can,t_fase)
+			!Flujo vertical entre tanques, los ciclos con potencias no se vectorizan para
+			!que cada miembro de lo mismo que una ejecucion sola (powf vectorial redondea diferente)
+			!GCC$ NOVECTOR
+			do m=1,Nm
+				vflux(m,1) = max(0.0, lluvia-H(m,1,celda)+Sto(m,1,celda))
+				Sto(m,1,celda)=Sto(m,1,celda)+lluvia-vflux(m,1)
+				Evp_loss(m)=0.0
+				if (Sto(m,1,celda) .ne. 0.0) Evp_loss(m)=min(vspeed(m,1,celda)*&
+					&(Sto(m,1,celda)/H(m,1,celda))**0.6,Sto(m,1,celda))
+				Sto(m,1,celda)=Sto(m,1,celda)-Evp_loss(m)
+			enddo
+			do i=1,3
+				do m=1,Nm
+					vflux(m,i+1)=min(vflux(m,i),vspeed(m,i+1,celda))
+					Sto(m,i+1,celda)=Sto(m,i+1,celda)+vflux(m,i)-vflux(m,i+1)
+				enddo
+			enddo
+			!Retorno del tanque 3 al tanque 2
+			if (tipos(4) .gt. 0) then
+				do m=1,Nm
+					Retorno(m) = max(0.0 , Sto(m,3,celda)+vflux(m,3)-vflux(m,4)-H(m,2,celda))
+					Sto(m,2,celda) = Sto(m,2,celda) + Retorno(m)
+					Sto(m,3,celda) = Sto(m,3,celda) - Retorno(m)
+					Ret(m,celda) = Ret(m,celda) + Retorno(m)
+				enddo
+			endif
+			perdidas(:,1,celda) = vflux(:,4)
+			perdidas(:,2,celda) = Evp_loss
+			if (medir .eq. 1) call sumar_fase(t_vert,t_fase)
+			!Flujo que sale de los tanques 2 a 4
+			do i=1,3
+				select case(tipos(i))
+					case(1)
+						do m=1,Nm
+							hflux(m,i)=(1-geo(1,celda)/(Speed(m,i,celda)*delta+&
+								& geo(1,celda)))*Sto(m,i+1,celda)
+						enddo
+					case(2)
+						!GCC$ NOVECTOR
+						do m=1,Nm
+							call calc_recession(Sto(m,i+1,celda), lluvia, tols(1), hexp(i,celda),&
+								& Speed(m,i,celda), vacia)
+							if (vacia) then
+								hflux(m,i)=Sto(m,i+1,celda)
+							else
+								call calc_speed_solver(Sto(m,i+1,celda)*m3_mmHill(celda), hcoef(i,celda),&
+									& hexp(i,celda), geo(1,celda), delta, tipos(6), tols(2),&
+									& Speed(m,i,celda), section_area(m))
+								hflux(m,i)=min(calib(i+4,m)*section_area(m)*Speed(m,i,celda)*delta&
+									&/m3_mmHill(celda), Sto(m,i+1,celda))
+							endif
+						enddo
+				end select
+				Sto(:,i+1,celda)=Sto(:,i+1,celda)-hflux(:,i)
+			enddo
+			if (medir .eq. 1) call sumar_fase(t_lad,t_fase)
+			!Transporte de acuerdo al tipo de celda
+			if (unit_in(celda).eq.1) then
+				hflux(:,4) = 0.0
+				if (drena_in(celda).eq.0) then
+					do m=1,Nm
+						Q(m,1,tiempo)=Q(m,1,tiempo)+sum(hflux(m,1:3))*m3_mmHill(celda)
+					enddo
+				endif
+			elseif (unit_in(celda).gt.1) then
+				!GCC$ NOVECTOR
+				do m=1,Nm
+					Sto(m,5,celda)=Sto(m,5,celda)+sum(hflux(m,1:2))+&
+						& hflux(m,3)*(unit_in(celda)-2)
+					!Transporte en el canal 
+					call calc_recession(Sto(m,5,celda), lluvia, tols(1), hexp(4,celda),&
+						& Speed(m,4,celda), vacia)
+					if (vacia) then
+						hflux(m,4)=Sto(m,5,celda)
+					else
+						call calc_speed_solver(Sto(m,5,celda)*m3_mmRivers(celda), hcoef(4,celda),&
+							& hexp(4,celda), geo(2,celda), delta, tipos(6), tols(2),&
+							& Speed(m,4,celda), section_area(m))
+						hflux(m,4)=min(section_area(m)*Speed(m,4,celda)*delta*calib(8,m)&
+							&/m3_mmRivers(celda), Sto(m,5,celda))
+					endif
+				enddo
+				if (tipos(5) .eq. 1) then
+					do m=1,Nm
+						Flux(m,:,celda) = Flux(m,:,celda) + hflux(m,1:3)
+						Flux(m,:,celda) = Flux(m,:,celda) - Flux(m,:,celda) * (hflux(m,4)/Sto(m,5,celda))
+					enddo
+				endif
+				Sto(:,5,celda) = Sto(:,5,celda) - hflux(:,4)
+				!Lo que se entrega aguas abajo en los flujos separados
+				if (tipos(5) .eq. 1) then
+					do m=1,Nm
+						aporteF(m,:,celda) = Flux(m,:,celda) * (hflux(m,4)/Sto(m,5,celda))
+					enddo
+				endif
+				if (drena_in(celda).eq.0) then
+					Q(:,1,tiempo)=hflux(:,4)*m3_mmRivers(celda)/delta
+					if (tipos(5) .eq. 1) then
+						do m=1,Nm
+							Qseparated(m,1,:,tiempo) = aporteF(m,:,celda)*m3_mmRivers(celda)/delta
+						enddo
+					endif
+				endif
+			endif
+			aporte(:,:,celda) = hflux
+			!Caudales en los puntos de control
+			if (fila_q(celda).ne.0) then
+				Q(:,fila_q(celda),tiempo)=hflux(:,4)*m3_mmRivers(celda)/delta
+				if (tipos(5) .eq. 1) then
+					do m=1,Nm
+						Qseparated(m,fila_q(celda),:,tiempo) = Flux(m,:,celda) &
+							&* (hflux(m,4)/Sto(m,5,celda))*m3_mmRivers(celda)/delta
+					enddo
+				endif
+			endif
+			!Humedad en puntos de control
+			if (fila_h(celda).ne.0) then 
+				do m=1,Nm
+					Hum(m,fila_h(celda),tiempo)=sum((/ Sto(m,1,celda), Sto(m,3,celda)/))
+				enddo
+			endif
+			if (medir .eq. 1) call sumar_fase(t_can,t_fase)
+			enddo
+			enddo
+			!$omp end parallel do
+		enddo
+		!Lluvia promedio y balance del intervalo, se suman en el orden de las celdas
+		entradas = 0.0
+		salidas = 0.0
+		rain_sum = 0.0
+		do celda=1,N_cel
+			entradas = entradas+Rain(celda,tiempo)
+			rain_sum = rain_sum+Rain(celda,tiempo)
+			salidas = salidas+perdidas(:,1,celda)+perdidas(:,2,celda)
+			if (drena_in(celda).eq.0) then
+				if (unit_in(celda).eq.1) then
+					do m=1,Nm
+						salidas(m) = salidas(m)+sum(aporte(m,1:3,celda))
+					enddo
+				elseif (unit_in(celda).gt.1) then
+					salidas = salidas+aporte(:,4,celda)
+				endif
+			endif
+		enddo
+		MeanRain(tiempo)=rain_sum/N_cel
+		do m=1,Nm
+			balance(m,tiempo) = sum(Sto(m,:,:))-StoAtras(m) - entradas(m) + salidas(m)
+		enddo
+	enddo
+	fases = (/ t_vert, t_lad, t_can /)
 end subroutine
 
 
@@ -467,11 +960,267 @@ subroutine write_int_basin(ruta,vect,record,N_cel,N_col)
 		write(10,rec=record) vect
     close(10)
 end subroutine
+!Escribe un campo entero en formato disperso: solo las celdas diferentes de cero
+!Los records se agregan en orden, el record 1 reinicia el archivo
+subroutine write_int_basin_sparse(ruta,vect,record,N_cel)
+    !Variables de entrada
+    integer, intent(in) :: record, N_cel
+    character*255, intent(in) :: ruta
+    integer, intent(in) :: vect(N_cel)
+    !Variables internas
+    integer i
+    !Escritura     
+    if (record.eq.1) then
+		open(10,file=ruta,form='unformatted',status='replace',access='stream')
+		write(10) 'WMFS', N_cel, 0
+	else
+		open(10,file=ruta,form='unformatted',status='old',access='stream',position='append')
+	endif
+		write(10) count(vect.ne.0), pack((/ (i, i=1,N_cel) /), vect.ne.0), pack(vect, vect.ne.0)
+    close(10)
+end subroutine
+!Escribe un campo entero cuantizado (0 a 65535) en 2 bytes por celda
+!Encabezado 'WMFQ', N_cel, 0 y luego records de N_cel enteros de 16 bits sin signo
+subroutine write_int_basin_q16(ruta,vect,record,N_cel)
+    !Variables de entrada
+    integer, intent(in) :: record, N_cel
+    character*255, intent(in) :: ruta
+    integer, intent(in) :: vect(N_cel)
+    !Escritura     
+    if (record.eq.1) then
+		open(10,file=ruta,form='unformatted',status='replace',access='stream')
+		write(10) 'WMFQ', N_cel, 0
+	else
+		open(10,file=ruta,form='unformatted',status='old',access='stream')
+	endif
+		!Los valores sobre 32767 se guardan como su complemento a 2
+		write(10,pos=13+2*int(N_cel,8)*int(record-1,8)) int(vect-65536*(vect/32768),2)
+    close(10)
+end subroutine
+!Escribe un campo de lluvia entero en el formato indicado: 1. denso, 2. disperso, 3. uint16
+subroutine write_rain_record(ruta,vect,record,N_cel,formato)
+    !Variables de entrada
+    integer, intent(in) :: record, N_cel, formato
+    character*255, intent(in) :: ruta
+    integer, intent(in) :: vect(N_cel)
+    !Escritura de acuerdo al formato 
+    select case(formato)
+		case(1)
+			call write_int_basin(ruta,vect,record,N_cel,1)
+		case(2)
+			call write_int_basin_sparse(ruta,vect,record,N_cel)
+		case(3)
+			call write_int_basin_q16(ruta,vect,record,N_cel)
+	end select
+end subroutine
 
 
+!-----------------------------------------------------------------------
+!Lector de lluvia para la ejecucion del modelo
+!-----------------------------------------------------------------------
+!Abre el binario de lluvia y lo deja abierto durante toda la ejecucion
+subroutine rain_open_bin(ruta,N_cel)
+	!Variables de entrada
+	character*500, intent(in) :: ruta
+	integer, intent(in) :: N_cel
+	!Variables locales 
+	character*4 marca
+	integer Res
+	!Si quedo abierto de una ejecucion anterior lo cierra
+	call rain_close_bin
+	!Aloja el campo que se encuentra cargado
+	allocate(rain_buffer(N_cel))
+	rain_buffer = 0
+	rain_pos_actual = 1
+	!Determina el formato: los binarios densos comienzan con el campo de ceros
+	open(rain_unit,file=ruta,form='unformatted',status='old',access='stream',action='read')
+		read(rain_unit,iostat=Res) marca
+	if (Res .eq. 0 .and. marca .eq. 'WMFS') then
+		!Disperso: deja el archivo abierto como stream y ubica los records
+		rain_format = 2
+		call rain_sparse_offsets
+	elseif (Res .eq. 0 .and. marca .eq. 'WMFQ') then
+		!uint16: records de tamano fijo despues del encabezado, la escala viene del indice
+		rain_format = 3
+		if (any(escEvento .le. 0.0 .and. posEvento .gt. 1)) then
+			print *, 'Error: El binario uint16 requiere el indice (.idx) con las escalas'
+		endif
+	else
+		!Denso: lo abre para lectura directa 
+		close(rain_unit)
+		rain_format = 1
+		open(rain_unit,file=ruta,form='unformatted',status='old',access='direct',&
+			& RECL=4*N_cel,action='read')
+	endif
+end subroutine
+!Recorre los encabezados de un binario disperso y guarda donde empieza cada record
+subroutine rain_sparse_offsets
+	!Variables locales 
+	integer(kind=8) p,tamano
+	integer nnz,Nrec,k
+	inquire(unit=rain_unit,size=tamano)
+	!Primero cuenta los records, luego guarda sus posiciones
+	do k=1,2
+		p = 13; Nrec = 0
+		do while (p .le. tamano)
+			read(rain_unit,pos=p) nnz
+			Nrec = Nrec+1
+			if (k .eq. 2) rain_offsets(Nrec) = p
+			p = p+4+8*int(nnz,8)
+		enddo
+		if (k .eq. 1) allocate(rain_offsets(Nrec))
+	enddo
+end subroutine
+!Entrega la lluvia del intervalo de tiempo, solo lee si el record cambia
+subroutine rain_read_interval(tiempo,N_cel,Rain)
+	!Variables de entrada
+	integer, intent(in) :: tiempo,N_cel
+	!Variables de salida
+	real, intent(out) :: Rain(N_cel)
+	!Variables locales 
+	integer pos,Res,nnz
+	integer, allocatable :: indices(:), valores(:)
+	integer(kind=2) q16(N_cel)
+	character*500 ruta_arch
+	!Record que corresponde al intervalo, el 1 es siempre el campo de ceros
+	pos = posEvento(tiempo)
+	if (pos .eq. 1) then
+		Rain = 0.0
+		return
+	endif
+	!Indice virtual: cambia de binario si el record esta en otro
+	if (rain_narch .gt. 0) then
+		if (arcEvento(tiempo) .ne. rain_arch_actual) then
+			open(unit=10,file=rain_ruta_virtual,form='unformatted',access='stream',&
+				&status='old',action='read')
+				read(10,pos=29+500*int(arcEvento(tiempo)-1,8)) ruta_arch
+			close(10)
+			call rain_open_bin(ruta_arch,N_cel)
+			rain_arch_actual = arcEvento(tiempo)
+		endif
+	endif
+	!Solo va al disco si el campo no es el que ya esta cargado
+	if (pos .ne. rain_pos_actual) then
+		select case(rain_format)
+			!Denso: un record de N_cel enteros
+			case(1)
+				read(rain_unit,rec=pos,iostat=Res) rain_buffer
+			!Disperso: cantidad de celdas con lluvia, sus indices y sus valores
+			case(2)
+				Res = 1
+				nnz = 0
+				if (pos .le. size(rain_offsets)) then
+					read(rain_unit,pos=rain_offsets(pos),iostat=Res) nnz
+					allocate(indices(nnz),valores(nnz))
+					read(rain_unit,iostat=Res) indices, valores
+					rain_buffer = 0
+					rain_buffer(indices) = valores
+					deallocate(indices,valores)
+				endif
+			!uint16: se lee con signo y se devuelve al rango 0 a 65535
+			case(3)
+				read(rain_unit,pos=13+2*int(N_cel,8)*int(pos-1,8),iostat=Res) q16
+				rain_buffer = iand(int(q16),65535)
+		end select
+		if (Res.ne.0) print *, 'Error: Se ha tratado de leer un valor fuera del rango'
+		rain_pos_actual = pos
+		if (medir_fases .gt. 0) then
+			fases_conteo(1) = fases_conteo(1) + 1
+			select case(rain_format)
+				case(1)
+					fases_conteo(2) = fases_conteo(2) + 4*int(N_cel,8)
+				case(2)
+					fases_conteo(2) = fases_conteo(2) + 4 + 8*int(nnz,8)
+				case(3)
+					fases_conteo(2) = fases_conteo(2) + 2*int(N_cel,8)
+			end select
+		endif
+	endif
+	if (rain_format .eq. 3) then
+		Rain = rain_buffer * escEvento(tiempo)
+	else
+		Rain = rain_buffer / 1000.0
+	endif
+end subroutine
+!Cierra el binario de lluvia y libera el campo cargado
+subroutine rain_close_bin
+	!Variables locales 
+	logical abierto
+	inquire(unit=rain_unit,opened=abierto)
+	if (abierto) close(rain_unit)
+	if (allocated(rain_buffer)) deallocate(rain_buffer)
+	if (allocated(rain_offsets)) deallocate(rain_offsets)
+end subroutine
+
 !-----------------------------------------------------------------------
 !Subrutinas de interpolacion de lluvia
 !-----------------------------------------------------------------------
+!Lee la tabla de la lluvia, binaria (.idx) o de texto (.hdr) segun su encabezado
+subroutine rain_read_table(ruta,Nintervals)
+	!variables de entrada 
+	character*500, intent(in) :: ruta
+	integer, intent(in) :: Nintervals
+	!Variables locales 
+	character*4 marca
+	integer Res
+	!Solo los indices virtuales apuntan a otros binarios
+	rain_narch = 0
+	if (allocated(arcEvento)) deallocate(arcEvento)
+	!Lee los primeros bytes del archivo
+	open(unit=10,file=ruta,form='unformatted',access='stream',status='old',action='read')
+		read(10,iostat=Res) marca
+	close(10)
+	if (Res .eq. 0 .and. marca .eq. 'WMFI') then
+		call rain_read_bin_index(ruta,Nintervals)
+	else
+		call rain_read_ascii_table(ruta,Nintervals)
+	endif
+end subroutine
+!Lee el indice binario de la lluvia, salta directo al registro rain_first_point.
+!Encabezado: 'WMFI', version (1), N elementos, N registros, N campos, dt [seg], N binarios,
+!	luego las rutas de los binarios (500 caracteres, solo en los indices virtuales) y una fila
+!	por registro: fecha (int64, seg desde 1970), record, lluvia media, escala [mm] del formato
+!	uint16 y binario que tiene el record (0: el del mismo nombre del indice)
+subroutine rain_read_bin_index(ruta,Nintervals)
+	!variables de entrada 
+	character*500, intent(in) :: ruta
+	integer, intent(in) :: Nintervals
+	!Varuiables locales 
+	character*4 marca
+	integer i,version,Nelem,Ntotal,Ncampos,dtIdx,Nleer
+	integer(kind=8) fecha
+	real media
+	!Configura variables globales de posiciones de los eventos 
+	if (allocated(idEvento)) deallocate(idEvento)
+	if (allocated(posEvento)) deallocate(posEvento)
+	if (allocated(escEvento)) deallocate(escEvento)
+	allocate(idEvento(Nintervals),posEvento(Nintervals),escEvento(Nintervals))
+	idEvento = (/ (i, i=rain_first_point,rain_first_point+Nintervals-1) /)
+	posEvento = 1
+	escEvento = 0.0
+	!Abre el archivo y lee el encabezado
+	open(unit=10,file=ruta,form='unformatted',access='stream',status='old',action='read')
+		read(10) marca,version,Nelem,Ntotal,Ncampos,dtIdx,rain_narch
+		if (version .ne. 1) then
+			print *, 'Error: Version del indice de lluvia no soportada'
+			rain_narch = 0
+			close(10)
+			return
+		endif
+		!Un indice virtual es virtual aunque no se lean records (la lluvia de los
+		!intervalos que faltan es cero), las rutas se leen del indice cuando se necesitan
+		rain_ruta_virtual = ruta
+		allocate(arcEvento(Nintervals))
+		arcEvento = 1
+		!Lee solo los records del periodo a simular
+		Nleer = max(0,min(Nintervals,Ntotal-rain_first_point+1))
+		if (Nleer .lt. Nintervals) print *, 'Error: El indice de lluvia es mas corto que la simulacion'
+		if (Nleer .gt. 0) then
+			read(10,pos=29+500*int(rain_narch,8)+24*int(rain_first_point-1,8)) (fecha,&
+				&posEvento(i),media,escEvento(i),arcEvento(i), i=1,Nleer)
+		endif
+	close(10)
+end subroutine
 !lee la tabla de informacion de la lluvia generada por las subrutinas.
 subroutine rain_read_ascii_table(ruta,Nintervals)
 	!variables de entrada 
@@ -483,7 +1232,10 @@ subroutine rain_read_ascii_table(ruta,Nintervals)
 	!Configura variables globales de posiciones de los eventos 
 	if (allocated(idEvento)) deallocate(idEvento)
 	if (allocated(posEvento)) deallocate(posEvento)
-	allocate(idEvento(Nintervals),posEvento(Nintervals))
+	if (allocated(escEvento)) deallocate(escEvento)
+	allocate(idEvento(Nintervals),posEvento(Nintervals),escEvento(Nintervals))
+	!La tabla de texto no tiene escalas (formato uint16 solo con .idx)
+	escEvento = 0.0
 	!Abre el archivo 
 	open(unit = 10,file = ruta,status='old',action='read')
 		!lee la cantidad de intervalos de evento y aloja las variables 
@@ -494,10 +1246,10 @@ subroutine rain_read_ascii_table(ruta,Nintervals)
 		read(10,*)
 		read(10,*)
 		!Solo lee si se cumple la condicion 
-		if (Nintervals + rain_first_point .le. Ntotal) then
-			!Salta lo necesario de acuerdo a rain_first_point		
+		if (Nintervals + rain_first_point - 1 .le. Ntotal) then
+			!Salta lo necesario de acuerdo a rain_first_point (como con el .idx)
 			if (rain_first_point .gt. 1) then 
-				do i = 1,rain_first_point
+				do i = 1,rain_first_point-1
 					read(10,*)
 				enddo
 			endif
@@ -592,19 +1344,212 @@ subroutine rain_mit(xy_basin,coord,rain,tin,tin_perte,nceldas,ncoord,&
 		call write_float_basin(ruta,campo,tiempo,nceldas,1)
 	enddo
 end subroutine 
+!Pasa un campo de lluvia [mm] a los enteros que se guardan en el binario
+!Formatos 1 y 2: mm*1000 (escala 0.001), formato 3: 0 a 65535 con escala maximo/65535
+subroutine rain_quantize(campo,campoInt,escala,N_cel,formato)
+	!Variables de entrada
+	integer, intent(in) :: N_cel,formato
+	real, intent(in) :: campo(N_cel)
+	!Variables de salida
+	integer, intent(out) :: campoInt(N_cel)
+	real, intent(out) :: escala
+	!Cuantiza de acuerdo al formato 
+	if (formato .eq. 3) then
+		escala = maxval(campo)/65535.0
+		campoInt = 0
+		if (escala .gt. 0.0) campoInt = min(nint(campo/escala),65535)
+	else
+		escala = 0.001
+		campoInt = campo*1000
+	endif
+end subroutine
 subroutine rain_idw(xy_basin,coord,rain,pp,nceldas,ncoord,nreg,nhills,ruta,umbral,&
-	& meanRain, posIds,maskVector)	
+	& meanRain, posIds,maskVector,formato,cache,escalas)	
 	!Variables de entrada
 	integer, intent(in) :: nceldas,ncoord,nreg,nhills
 	integer, intent(in) :: maskVector(nceldas)
+	integer, intent(in) :: formato !Formato del binario: 1. denso, 2. disperso, 3. uint16
+	integer, intent(in) :: cache !Patrones de estaciones con dato cuya normalizacion se guarda (minimo 1, se descarta el de uso mas antiguo)
+	!f2py integer optional, intent(in) :: cache = 1
+	character*255, intent(in) :: ruta
+	real, intent(in) :: xy_basin(2,nceldas),coord(2,ncoord),rain(ncoord,nreg),pp,umbral
+	!Variables de salida
+	real, intent(out) :: meanRain(nreg)
+	integer, intent(out) :: posIds(nreg)
+	real, intent(out) :: escalas(nreg) !Escala de cada record (solo se usa en el formato 3)
+	!Variables locales 
+	integer tiempo, celda, i, cont, celdas_hills, nlluvia, ranura, ncache
+	real W(ncoord,nceldas),Wr,campo(nceldas),valor
+	integer lista(ncoord) !Estaciones con lluvia en el intervalo
+	logical disponible(ncoord),nueva
+	!Cache de la suma de los pesos de las estaciones con dato de cada celda, por patron
+	logical, allocatable :: patrones(:,:)
+	integer, allocatable :: usos(:)
+	real, allocatable :: Wsuma(:,:)
+	!Guarda el campo de ceros y mira si la cuenca es celdas o laderas
+	call rain_idw_start(ruta,maskVector,nceldas,nhills,formato,celdas_hills)
+	!Calcula el peso 
+	do i=1,ncoord
+		W(i,:)=1.0/(sqrt(((coord(1,i)-xy_basin(1,:))**2+(coord(2,i)-xy_basin(2,:))**2)))**pp
+    end do
+	ncache = max(cache,1)
+	allocate(patrones(ncoord,ncache),usos(ncache),Wsuma(nceldas,ncache))
+	usos = 0
+	!Itera para todos los tiempos para todas las celdas 
+	cont = 2
+	do tiempo=1,nreg
+		!Normalizacion del patron de estaciones con dato, solo se calcula si no esta
+		disponible = rain(:,tiempo).ge.0.0
+		call rain_idw_cache(disponible,patrones,usos,tiempo,ncoord,ncache,ranura,nueva)
+		if (nueva) then
+			do celda=1,nceldas
+				Wsuma(celda,ranura) = sum(W(:,celda),mask=disponible)
+			enddo
+		endif
+		!Estaciones con lluvia, en el mismo orden en que las suma el mask
+		nlluvia = 0
+		do i=1,ncoord
+			if (rain(i,tiempo).gt.0.0) then
+				nlluvia = nlluvia+1
+				lista(nlluvia) = i
+			endif
+		enddo
+		!Interpola para el intervalo de tiempo
+		do celda=1,nceldas
+			Wr=sum(W(lista(1:nlluvia),celda)*rain(lista(1:nlluvia),tiempo))
+			valor = max(Wr/Wsuma(celda,ranura),0.0)				
+			if (valor .eq. valor-1) then
+				campo(celda) = 0.0
+			else
+				campo(celda) = valor
+			endif
+		enddo
+		!Guarda el campo si tiene lluvia
+		call rain_idw_record(campo,tiempo,cont,ruta,umbral,maskVector,nceldas,nhills,&
+			& nreg,formato,celdas_hills,meanRain,posIds,escalas)
+	enddo
+	deallocate(patrones,usos,Wsuma)
+end subroutine 
+!IDW con solo algunas estaciones por celda (las k mas cercanas o las que estan en un
+!radio), las estaciones de cada celda estan en vecinos(vecinos_ini(celda):vecinos_ini(celda+1)-1)
+!en orden ascendente, los pesos se guardan dispersos y cada intervalo es un producto
+!matriz dispersa por vector. Con todas las estaciones da lo mismo que rain_idw
+subroutine rain_idw_sparse(xy_basin,coord,rain,pp,vecinos,vecinos_ini,nceldas,ncoord,&
+	& nreg,nvecinos,nhills,ruta,umbral,meanRain,posIds,maskVector,formato,cache,escalas)
+	!Variables de entrada
+	integer, intent(in) :: nceldas,ncoord,nreg,nhills,nvecinos
+	integer, intent(in) :: maskVector(nceldas)
+	integer, intent(in) :: vecinos(nvecinos),vecinos_ini(nceldas+1) !Estaciones de cada celda
+	integer, intent(in) :: formato !Formato del binario: 1. denso, 2. disperso, 3. uint16
+	integer, intent(in) :: cache !Patrones de estaciones con dato cuya normalizacion se guarda (minimo 1, se descarta el de uso mas antiguo)
+	!f2py integer optional, intent(in) :: cache = 1
 	character*255, intent(in) :: ruta
 	real, intent(in) :: xy_basin(2,nceldas),coord(2,ncoord),rain(ncoord,nreg),pp,umbral
 	!Variables de salida
 	real, intent(out) :: meanRain(nreg)
 	integer, intent(out) :: posIds(nreg)
+	real, intent(out) :: escalas(nreg) !Escala de cada record (solo se usa en el formato 3)
 	!Variables locales 
-	integer tiempo, celda, i, cont, celdas_hills
-	real W(ncoord,nceldas),Wr,campo(nceldas),valor,campoHill(nhills)
+	integer tiempo, celda, j, e, cont, celdas_hills, ranura, ncache
+	real W(nvecinos),Wr,Ws,r,campo(nceldas),valor
+	logical disponible(ncoord),nueva
+	!Cache de la suma de los pesos de las estaciones con dato de cada celda, por patron
+	logical, allocatable :: patrones(:,:)
+	integer, allocatable :: usos(:)
+	real, allocatable :: Wsuma(:,:)
+	!Guarda el campo de ceros y mira si la cuenca es celdas o laderas
+	call rain_idw_start(ruta,maskVector,nceldas,nhills,formato,celdas_hills)
+	!Calcula los pesos de las estaciones de cada celda
+	do celda=1,nceldas
+		do j=vecinos_ini(celda),vecinos_ini(celda+1)-1
+			e = vecinos(j)
+			W(j)=1.0/(sqrt(((coord(1,e)-xy_basin(1,celda))**2+(coord(2,e)-xy_basin(2,celda))**2)))**pp
+		enddo
+	enddo
+	ncache = max(cache,1)
+	allocate(patrones(ncoord,ncache),usos(ncache),Wsuma(nceldas,ncache))
+	usos = 0
+	!Itera para todos los tiempos para todas las celdas 
+	cont = 2
+	do tiempo=1,nreg
+		!Normalizacion del patron de estaciones con dato, solo se calcula si no esta
+		disponible = rain(:,tiempo).ge.0.0
+		call rain_idw_cache(disponible,patrones,usos,tiempo,ncoord,ncache,ranura,nueva)
+		if (nueva) then
+			do celda=1,nceldas
+				Ws = 0.0
+				do j=vecinos_ini(celda),vecinos_ini(celda+1)-1
+					if (disponible(vecinos(j))) Ws = Ws + W(j)
+				enddo
+				Wsuma(celda,ranura) = Ws
+			enddo
+		endif
+		!Interpola para el intervalo de tiempo con las estaciones de cada celda
+		do celda=1,nceldas
+			Wr = 0.0
+			do j=vecinos_ini(celda),vecinos_ini(celda+1)-1
+				r = rain(vecinos(j),tiempo)
+				if (r .gt. 0.0) Wr = Wr + W(j)*r
+			enddo
+			Ws = Wsuma(celda,ranura)
+			!Sin estaciones con dato no llueve
+			if (Ws .eq. 0.0) then
+				campo(celda) = 0.0
+				cycle
+			endif
+			valor = max(Wr/Ws,0.0)
+			if (valor .eq. valor-1) then
+				campo(celda) = 0.0
+			else
+				campo(celda) = valor
+			endif
+		enddo
+		!Guarda el campo si tiene lluvia
+		call rain_idw_record(campo,tiempo,cont,ruta,umbral,maskVector,nceldas,nhills,&
+			& nreg,formato,celdas_hills,meanRain,posIds,escalas)
+	enddo
+	deallocate(patrones,usos,Wsuma)
+end subroutine
+!Busca el patron de estaciones con dato en la cache del IDW, si no esta toma la
+!posicion de uso mas antiguo (o una vacia) y avisa que hay que calcularla
+subroutine rain_idw_cache(disponible,patrones,usos,tiempo,ncoord,ncache,ranura,nueva)
+	!Variables de entrada
+	integer, intent(in) :: ncoord,ncache,tiempo
+	logical, intent(in) :: disponible(ncoord)
+	!Variables de entrada y salida
+	logical, intent(inout) :: patrones(ncoord,ncache) !Patron guardado en cada posicion
+	integer, intent(inout) :: usos(ncache) !Ultimo intervalo en que se uso cada posicion (0: vacia)
+	!Variables de salida
+	integer, intent(out) :: ranura
+	logical, intent(out) :: nueva
+	!Variables locales 
+	integer k
+	do k=1,ncache
+		if (usos(k) .gt. 0) then
+			if (all(patrones(:,k) .eqv. disponible)) then
+				ranura = k
+				usos(k) = tiempo
+				nueva = .false.
+				return
+			endif
+		endif
+	enddo
+	ranura = minloc(usos,1)
+	patrones(:,ranura) = disponible
+	usos(ranura) = tiempo
+	nueva = .true.
+end subroutine
+!Guarda el primer record de un binario interpolado (campo de ceros) y dice si la
+!cuenca es por celdas (1) o por laderas (2)
+subroutine rain_idw_start(ruta,maskVector,nceldas,nhills,formato,celdas_hills)
+	!Variables de entrada
+	integer, intent(in) :: nceldas,nhills,formato
+	integer, intent(in) :: maskVector(nceldas)
+	character*255, intent(in) :: ruta
+	!Variables de salida
+	integer, intent(out) :: celdas_hills
+	!Variables locales 
+	real campo(nceldas),campoHill(nhills)
 	integer campoInt(nceldas),campoIntHill(nhills),mascara(nceldas)
 	!Mira si la cuenca es celdas o laderas 
 	if (sum(maskVector) .eq. nceldas) then
@@ -614,6 +1559,7 @@ subroutine rain_idw(xy_basin,coord,rain,pp,nceldas,ncoord,nreg,nhills,ruta,umbra
 	endif
 	!Guarda un campo vacio que va a ser el usado en 
 	!los casos en que no tenga valores de lluvia sobre toda la cuenca
+	campo = 0.0
 	campoInt = 0
 	mascara = 1
 	if (celdas_hills .eq. 2) then
@@ -621,54 +1567,55 @@ subroutine rain_idw(xy_basin,coord,rain,pp,nceldas,ncoord,nreg,nhills,ruta,umbra
 		call basin_subbasin_map2subbasin(maskVector,campo,campoHill,&
 			&nhills,nceldas,mascara,celdas_hills)
 		campoIntHill = campoHill
-		call write_int_basin(ruta,campoIntHill,1,nhills,1)
+		call write_rain_record(ruta,campoIntHill,1,nhills,formato)
 	elseif (celdas_hills .eq. 1) then
 		!Si es por celdas guarda la primera como nceldas de ceros
-		call write_int_basin(ruta,campoInt,1,nceldas,1)
+		call write_rain_record(ruta,campoInt,1,nceldas,formato)
 	endif
-	!Calcula el peso 
-	do i=1,ncoord
-		W(i,:)=1.0/(sqrt(((coord(1,i)-xy_basin(1,:))**2+(coord(2,i)-xy_basin(2,:))**2)))**pp
-    end do
-	!Itera para todos los tiempos para todas las celdas 
-	cont = 2
-	do tiempo=1,nreg
-		!Interpola para el intervalo de tiempo
-		do celda=1,nceldas
-			Wr=sum(W(:,celda)*rain(:,tiempo),mask=rain(:,tiempo).gt.0.0)
-			valor = max(Wr/sum(W(:,celda),mask=rain(:,tiempo).ge.0.0),0.0)				
-			if (valor .eq. valor-1) then
-				campo(celda) = 0.0
-			else
-				campo(celda) = valor
-			endif
-		enddo
-		!Si el campo tiene algun valor diferente de cero lo mete en la media 
-		!Y tambien lo guarda.
-		if (sum(campo) .gt. umbral .and. count(campo .gt. umbral) .gt. 0) then
-			!Obtiene la media
-			meanRain(tiempo) = sum(campo)/count(campo .gt. 0)			
-			!Guarda el campo interpolado para el tiempo		
-			if (celdas_hills .eq. 1) then 
-				!Caso de celdas 
-				campoInt = campo*1000
-				call write_int_basin(ruta,campoInt,cont,nceldas,1)
-			elseif (celdas_hills .eq. 2) then 
-				!Caso de laderas
-				call basin_subbasin_map2subbasin(maskVector,campo,campoHill,&
-				&nhills,nceldas,mascara,celdas_hills)
-				campoIntHill = campoHill*1000
-				call write_int_basin(ruta,campoIntHill,cont,nhills,1)
-			endif
-			!Actualiza el conteo de la posicion de los campos
-			posIds(tiempo) = cont
-			cont = cont+1			
-		else
-			meanRain(tiempo) = 0.0
-			posIds(tiempo) = 1
+end subroutine
+!Guarda el campo interpolado de un intervalo si supera el umbral, si no el intervalo
+!apunta al campo de ceros
+subroutine rain_idw_record(campo,tiempo,cont,ruta,umbral,maskVector,nceldas,nhills,&
+	& nreg,formato,celdas_hills,meanRain,posIds,escalas)
+	!Variables de entrada
+	integer, intent(in) :: tiempo,nceldas,nhills,nreg,formato,celdas_hills
+	integer, intent(in) :: maskVector(nceldas)
+	character*255, intent(in) :: ruta
+	real, intent(in) :: campo(nceldas),umbral
+	!Variables de entrada y salida
+	integer, intent(inout) :: cont
+	real, intent(inout) :: meanRain(nreg),escalas(nreg)
+	integer, intent(inout) :: posIds(nreg)
+	!Variables locales 
+	real campoHill(nhills)
+	integer campoInt(nceldas),campoIntHill(nhills),mascara(nceldas)
+	mascara = 1
+	!Si el campo tiene algun valor diferente de cero lo mete en la media 
+	!Y tambien lo guarda.
+	if (sum(campo) .gt. umbral .and. count(campo .gt. umbral) .gt. 0) then
+		!Obtiene la media
+		meanRain(tiempo) = sum(campo)/count(campo .gt. 0)			
+		!Guarda el campo interpolado para el tiempo		
+		if (celdas_hills .eq. 1) then 
+			!Caso de celdas 
+			call rain_quantize(campo,campoInt,escalas(tiempo),nceldas,formato)
+			call write_rain_record(ruta,campoInt,cont,nceldas,formato)
+		elseif (celdas_hills .eq. 2) then 
+			!Caso de laderas
+			call basin_subbasin_map2subbasin(maskVector,campo,campoHill,&
+			&nhills,nceldas,mascara,celdas_hills)
+			call rain_quantize(campoHill,campoIntHill,escalas(tiempo),nhills,formato)
+			call write_rain_record(ruta,campoIntHill,cont,nhills,formato)
 		endif
-	enddo
-end subroutine 
+		!Actualiza el conteo de la posicion de los campos
+		posIds(tiempo) = cont
+		cont = cont+1			
+	else
+		meanRain(tiempo) = 0.0
+		posIds(tiempo) = 1
+		escalas(tiempo) = 0.0
+	endif
+end subroutine
 
 !-----------------------------------------------------------------------
 !Subrutinas de solucion
@@ -681,35 +1628,112 @@ subroutine calc_speed(sm, coef, expo, elem_long, speed, area)
 	!Variables de salidqa
 	real, intent(out) :: Area
 	real, intent(inout) :: speed
+	!Usa el dt y el tipo de solucion del modulo
+	call calc_speed_solver(sm, coef, expo, elem_long, dt, speed_solver, speed_tol, speed, area)
+end subroutine 
+!Resuelve la onda cinematica con el tipo de solucion dado: 2 es Newton (calc_speed_newton)
+!con tolerancia tol, cualquier otro valor son las 4 iteraciones de calc_speed_dt
+subroutine calc_speed_solver(sm, coef, expo, elem_long, delta, solver, tol, speed, area)
+	!Variables de entrada
+	real, intent(in) :: sm,coef, expo, elem_long, delta, tol
+	integer, intent(in) :: solver
+	!Variables de salidqa
+	real, intent(out) :: Area
+	real, intent(inout) :: speed
+	if (solver .eq. 2) then
+		call calc_speed_newton(sm, coef, expo, elem_long, delta, tol, speed, area)
+	else
+		call calc_speed_dt(sm, coef, expo, elem_long, delta, speed, area)
+	endif
+end subroutine
+!Igual a calc_speed con el intervalo de tiempo como argumento (no usa el modulo)
+subroutine calc_speed_dt(sm, coef, expo, elem_long, delta, speed, area)
+	!Variables de entrada
+	real, intent(in) :: sm,coef, expo, elem_long, delta
+	!Variables de salidqa
+	real, intent(out) :: Area
+	real, intent(inout) :: speed
 	!Variables locales
 	real new_speed
 	integer i 
 	!Itera la cantidad de veces niter para solucionar la ecuacion
 	do i=1,4
-	    Area=sm/(elem_long+speed*dt) ![m2] Calcula el area de la seccion
+	    Area=sm/(elem_long+speed*delta) ![m2] Calcula el area de la seccion
 	    new_speed=coef*(Area**expo) ![m/seg] Calcula la velocidad nueva
 	    speed=(2*new_speed+speed)/3 ![m/seg] Promedia la velocidad
 	enddo		
 end subroutine 
+!Solucion de la onda cinematica con Newton: f(v) = v - coef*(sm/(elem_long+v*delta))**expo = 0,
+!parte de la velocidad anterior y para cuando el cambio relativo es menor a tol (maximo 20
+!iteraciones), cada iteracion usa una potencia y en un intervalo normal bastan 1 o 2.
+!f es creciente y concava, desde abajo Newton converge en forma monotona, si un paso
+!desde arriba cruza cero la velocidad se deja en cero y sigue desde ahi.
+subroutine calc_speed_newton(sm, coef, expo, elem_long, delta, tol, speed, area)
+	!Variables de entrada
+	real, intent(in) :: sm,coef, expo, elem_long, delta, tol
+	!Variables de salidqa
+	real, intent(out) :: Area
+	real, intent(inout) :: speed
+	!Variables locales
+	real seccion, new_speed, nueva
+	integer i
+	do i=1,20
+		seccion = elem_long+speed*delta ![m] Longitud mas lo que avanza el flujo
+		Area = sm/seccion ![m2] Area de la seccion
+		new_speed = coef*(Area**expo) ![m/seg] Velocidad de la ecuacion
+		!Paso de Newton: f/f' con f' = 1 + expo*delta*new_speed/seccion
+		nueva = max(0.0, speed - (speed-new_speed)/(1.0+expo*delta*new_speed/seccion))
+		if (abs(nueva-speed) .le. tol*nueva) then
+			speed = nueva
+			exit
+		endif
+		speed = nueva
+	enddo
+	Area = sm/(elem_long+speed*delta)
+end subroutine
+!Recesion rapida antes de calc_speed_dt: con el tanque vacio (sto = 0) calc_speed_dt da
+!flujo cero y solo amortigua la velocidad, aca se hace lo mismo sin potencias. Si la celda
+!esta seca (lluvia = 0) y el tanque tiene menos de tol [mm] se vacia completo en el
+!intervalo: el volumen se conserva y llega aguas abajo antes, el error por tanque es menor
+!a tol. Si vacia es .true. el flujo del tanque es todo su almacenamiento.
+subroutine calc_recession(sto, lluvia, tol, expo, speed, vacia)
+	!Variables de entrada
+	real, intent(in) :: sto, lluvia, tol, expo
+	!Variables de salida
+	real, intent(inout) :: speed
+	logical, intent(out) :: vacia
+	!Variables locales
+	integer i
+	vacia = expo .gt. 0.0 .and. (sto .eq. 0.0 .or. (lluvia .eq. 0.0 .and. sto .lt. tol))
+	if (vacia) then
+		do i=1,4
+			speed=speed/3
+		enddo
+	endif
+end subroutine
 
 !-----------------------------------------------------------------------
 !Subrutinas de sedimentos
 !-----------------------------------------------------------------------
 subroutine sed_allocate !Funcion para alojar variables si se van a calcular sed
+    logical nuevo
     !Tamaño a los vectores de sedimentos en suspención y depositads
+    nuevo = .not. allocated(VS)
     if (allocated(VS) .eqv. .false.) allocate(VS(3,nceldas))
     if (allocated(VD) .eqv. .false.) allocate(VD(3,nceldas))
     if (allocated(VolERO) .eqv. .false.) allocate(VolERO(nceldas))
     if (allocated(VolDEPo) .eqv. .false.) allocate(VolDEPo(nceldas))
     if (allocated(VSc) .eqv. .false.) allocate(VSc(3,nceldas))
     if (allocated(VDc) .eqv. .false.) allocate(VDc(3,nceldas))    
-    !estado inicial del almacenamiento de sedimentos
-    VS=0 ![m3]
-    VD=0![m3]
-    VSc=0 ![m3]
-    VDc=0 ![m3]
-    VolERO=0; VolDEPo=0 ![m3]
-    EROt=0; DEPt=0
+    !estado inicial del almacenamiento de sedimentos, si continua conserva el que hay
+    if (continuar_estado .eq. 0 .or. nuevo) then
+	VS=0 ![m3]
+	VD=0![m3]
+	VSc=0 ![m3]
+	VDc=0 ![m3]
+	VolERO=0; VolDEPo=0 ![m3]
+	EROt=0; DEPt=0
+    endif
 end subroutine
 subroutine sed_hillslope(alfa,S2,v2,So,area_sec,celda,drena_id,tipo) !Subrutina para calcular los sedimentos en ladera
     !Variables de entrada
@@ -893,6 +1917,8 @@ end subroutine
 !Subrutinas de deslizamientos
 !-----------------------------------------------------------------------
 subroutine slide_allocate !Funcion para alojar variables de deslizamientos
+	logical nuevo
+	nuevo = .not. allocated(SlideOcurrence)
 	!Aloja variables de umbrales para deslizamientos
 	if (allocated(Zmin) .eqv. .false.) allocate(Zmin(1,nceldas))
 	if (allocated(Zmax) .eqv. .false.) allocate(Zmax(1,nceldas))
@@ -916,8 +1942,8 @@ subroutine slide_allocate !Funcion para alojar variables de deslizamientos
 	RiskVector=0 !Se asume todo el vector estable
 	where(hill_slope.gt.Bo .and. Zs .gt. Zmin) RiskVector=1 ! Condicionado
 	where(hill_slope.gt.Bo .and. Zs .gt. Zmax) RiskVector=2 ! Inestable
-	!Inicia en cero el vector de deslizamientos, como si no ocurrieran
-	SlideOcurrence=0
+	!Inicia en cero el vector de deslizamientos, como si no ocurrieran (salvo si continua)
+	if (continuar_estado .eq. 0 .or. nuevo) SlideOcurrence=0
 end subroutine 
 subroutine slide_ocurrence(cell,StorageT3,MaxStoT3) !Evalua la ocurrencia o no de deslizamientos
 	!Variables de entrada
@@ -21,11 +21,21 @@ from mpl_toolkits.basemap import Basemap, addcyclic, shiftgrid, cm
 import pylab as pl
 import osgeo.ogr, osgeo.osr
 import gdal
-from scipy.spatial import Delaunay
+from scipy.spatial import Delaunay, cKDTree
 from scipy.stats import norm
 import os
 import pandas as pd
 import datetime as datetime
+import threading
+import Queue
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import shutil
+import hashlib
+import collections
+import zlib
+import time
+import weakref
 try:
 	import netcdf as netcdf
 except:
@@ -82,7 +92,7 @@ def plot_sim_single(Qs,Qo=None,mrain=None,Dates=None,ruta=None,
 #-----------------------------------------------------------------------
 #Lectura de informacion y mapas 
 #-----------------------------------------------------------------------
-def read_map_raster(ruta_map,isDEMorDIR=False,dxp=None):
+def read_map_raster(ruta_map,isDEMorDIR=False,dxp=None,structure=None):
 	'Funcion: read_map\n'\
 	'Descripcion: Lee un mapa raster soportado por GDAL.\n'\
 	'Parametros Obligatorios:.\n'\
@@ -90,9 +100,12 @@ def read_map_raster(ruta_map,isDEMorDIR=False,dxp=None):
 	'Parametros Opcionales:.\n'\
 	'	-isDEMorDIR: Pasa las propiedades de los mapas al modulo cuencas \n'\
 	'		escrito en fortran \n'\
+	'	-structure: Estructura de una cuenca (Basin.structure), si se da solo.\n'\
+	'		se lee la ventana del mapa que cubre la cuenca.\n'\
 	'Retorno:.\n'\
 	'	Si no es DEM o DIR retorna todas las propieades del elemento en un vector.\n'\
 	'		En el siguiente orden: ncols,nrows,xll,yll,dx,nodata.\n'\
+	'		Con structure las propiedades son las de la ventana leida.\n'\
 	'	Si es DEM o DIR le pasa las propieades a cuencas para el posterior trazado.\n'\
 	'		de cuencas y tramos.\n' \
     #Abre el mapa
@@ -106,7 +119,12 @@ def read_map_raster(ruta_map,isDEMorDIR=False,dxp=None):
 	dx=geoT[1]
 	xll=geoT[0]; yll=geoT[3]-nrows*dx
 	#lee el mapa
-	Mapa=direction.ReadAsArray()
+	if structure is not None and isDEMorDIR is False:
+		xoff,yoff,ncols,nrows = __BasinWindow__(structure,geoT[0],geoT[3],dx,ncols,nrows)
+		xll = geoT[0]+xoff*dx; yll = geoT[3]-(yoff+nrows)*dx
+		Mapa=direction.ReadAsArray(xoff,yoff,ncols,nrows)
+	else:
+		Mapa=direction.ReadAsArray()
 	direction.FlushCache()
 	del direction
 	if isDEMorDIR==True:
@@ -237,6 +255,21 @@ def Save_Points2Map(XY,ids,ruta,EPSG = 4326, Dict = None,
 		feature.Destroy()
 	shapeData.Destroy()	
 
+def __BasinWindow__(structure,xllM,ytopM,dxM,ncolsM,nrowsM):
+	#Ventana de pixeles (xoff,yoff,ncols,nrows) de un mapa que cubre la cuenca,
+	#con un pixel de margen, si la cuenca no toca el mapa se lee completo
+	xmin = cu.xll+cu.dx*(structure[1].min()-1)
+	xmax = cu.xll+cu.dx*structure[1].max()
+	ymin = cu.yll+cu.dx*(cu.nrows-structure[2].max())
+	ymax = cu.yll+cu.dx*(cu.nrows-structure[2].min()+1)
+	c0 = max(int(np.floor((xmin-xllM)/dxM))-1, 0)
+	c1 = min(int(np.ceil((xmax-xllM)/dxM))+1, ncolsM)
+	f0 = max(int(np.floor((ytopM-ymax)/dxM))-1, 0)
+	f1 = min(int(np.ceil((ytopM-ymin)/dxM))+1, nrowsM)
+	if c1 <= c0 or f1 <= f0:
+		return 0,0,ncolsM,nrowsM
+	return c0,f0,c1-c0,f1-f0
+
 def __ListaRadarNames__(ruta,FechaI,FechaF,fmt,exten,string,dt):
 	'Funcion: OCG_param\n'\
 	'Descripcion: Obtiene una lista con los nombres para leer datos de radar.\n'\
@@ -255,19 +288,423 @@ def __ListaRadarNames__(ruta,FechaI,FechaF,fmt,exten,string,dt):
 		date+=datetime.timedelta(minutes=dt)
 		Dates.append(date)
 	#Mira que archivos estan en esas fechas
-	Lista=[]; L=os.listdir(ruta)
+	Lista=[]; L=set(os.listdir(ruta))
 	DatesFin = []
 	for i in Dates:
-		try:
-			stringB=string+i.strftime(fmt)+exten 
-			Pos=L.index(stringB)
-			Lista.append(L[Pos])
+		stringB=string+i.strftime(fmt)+exten 
+		if stringB in L:
+			Lista.append(stringB)
 			DatesFin.append(i)
-		except: 
-			pass
 	return Lista,DatesFin
 
+def __RadarPoolInit__(structure,regrid,conv_factor,window=False):
+	#Deja en cada proceso del pool lo necesario para pasar mapas a la cuenca
+	global __RadarPool__
+	__RadarPool__ = {'structure':structure,'regrid':regrid,'factor':conv_factor,
+		'window':window}
+
+def __RadarMap2Basin__(ruta):
+	#Lee un mapa de radar y lo pasa a la cuenca (se ejecuta en el pool)
+	ventana = __RadarPool__['structure'] if __RadarPool__['window'] else None
+	Map,p = read_map_raster(ruta,structure = ventana)
+	regrid = __RadarPool__['regrid']
+	if regrid.llave <> tuple(p):
+		regrid = MapRegridder(__RadarPool__['structure'],p)
+		__RadarPool__['regrid'] = regrid
+	return regrid.Transform(Map) * __RadarPool__['factor']
+
+def __IdwPoolInit__(Datos):
+	#Deja en cada proceso del pool lo necesario para interpolar con idw
+	global __IdwPool__
+	__IdwPool__ = Datos
+
+def __IdwChunk__(bloque):
+	#Interpola con idw los intervalos i a j en su propio binario (se ejecuta en el pool)
+	i,j,ruta = bloque
+	D = __IdwPool__
+	reg = D['reg'][:,i:j]
+	if D['vecinos'] is None:
+		return models.rain_idw(D['xy'],D['coord'],reg,D['p'],D['nhills'],ruta,
+			D['umbral'],D['mascara'],D['codigo'],cache = D['cache'])
+	return models.rain_idw_sparse(D['xy'],D['coord'],reg,D['p'],D['vecinos'],
+		D['inicio'],D['nhills'],ruta,D['umbral'],D['mascara'],D['codigo'],cache = D['cache'])
+
+def __JoinRainParts__(ruta,partes,Resultados,codigo,N):
+	#Une en orden los binarios de los pedazos de una interpolacion: el primero completo
+	#y de los demas solo sus records (sin encabezado ni campo de ceros), los records
+	#de cada pedazo se corren en los que ya tienen los anteriores
+	inicio = {1 : 4*N, 2 : 16, 3 : 12+2*N}[codigo]
+	f = open(ruta,'wb')
+	posIds = []
+	corrimiento = 0
+	for k,(parte,pos) in enumerate(zip(partes,[r[1] for r in Resultados])):
+		g = open(parte,'rb')
+		if k > 0:
+			g.seek(inicio)
+		shutil.copyfileobj(g,f,2**24)
+		g.close()
+		os.remove(parte)
+		posIds.append(np.where(pos > 1,pos + corrimiento,1))
+		corrimiento += np.count_nonzero(pos > 1)
+	f.close()
+	meanRain = np.hstack([r[0] for r in Resultados])
+	escalas = np.hstack([r[2] for r in Resultados])
+	return meanRain,np.hstack(posIds),escalas
+
+def __MitBlock__(B,reg,i,j,ruta,meanRain):
+	#Interpola los intervalos i a j con el operador baricentrico y escribe sus records
+	#en su lugar del binario, que ya tiene el tamano final
+	campos = np.maximum(B.dot(reg[:,i:j]),0.0).astype(np.float32)
+	with np.errstate(divide='ignore',invalid='ignore'):
+		meanRain[i:j] = campos.sum(axis=0)/np.count_nonzero(campos > 0,axis=0)
+	f = open(ruta,'r+b')
+	f.seek(campos.itemsize*campos.shape[0]*i)
+	f.write(campos.T.tostring())
+	f.close()
+
+def __Covariance__(h,modelo,rango,meseta,pepita):
+	#Covarianza a distancia h de un variograma exponencial, esferico o gaussiano con
+	#rango practico rango, la pepita solo se suma en h = 0
+	r = h/float(rango)
+	if modelo == 'exponential':
+		g = 1.0-np.exp(-3.0*r)
+	elif modelo == 'spherical':
+		g = np.where(r < 1.0,1.5*r-0.5*r**3,1.0)
+	elif modelo == 'gaussian':
+		g = 1.0-np.exp(-3.0*r**2)
+	else:
+		raise ValueError('variograma %s no soportado: exponential, spherical o gaussian' % modelo)
+	return np.where(h > 0,meseta*(1.0-g),meseta+pepita)
+
+def __KrigingOperator__(xy_basin,coord,disponible,k,Covarianza,Nbloque=2**16):
+	#Matriz dispersa [Nceldas,Ncoord] con los pesos de kriging ordinario de cada celda
+	#con sus k estaciones con dato mas cercanas. Las celdas con las mismas estaciones
+	#comparten el sistema de covarianzas, que se invierte una sola vez
+	from scipy import sparse
+	xy = np.asarray(xy_basin,dtype=float).T
+	N = xy.shape[0]
+	est = np.where(disponible)[0]
+	if est.size == 0:
+		return sparse.csr_matrix((N,coord.shape[1]))
+	k = min(int(k),est.size)
+	puntos = np.asarray(coord,dtype=float).T[est]
+	dist,vecinos = cKDTree(puntos).query(xy,k=k)
+	vecinos = np.sort(np.asarray(vecinos).reshape(N,k),axis=1)
+	#Vecindarios diferentes y a cual pertenece cada celda
+	grupos,cual = np.unique(vecinos,axis=0,return_inverse=True)
+	#Sistema de cada vecindario: covarianzas entre estaciones y la fila de lagrange
+	P = puntos[grupos]
+	A = np.ones((grupos.shape[0],k+1,k+1))
+	A[:,:k,:k] = Covarianza(np.sqrt(((P[:,:,None,:]-P[:,None,:,:])**2).sum(-1)))
+	A[:,k,k] = 0.0
+	try:
+		Ainv = np.linalg.inv(A)
+	except np.linalg.LinAlgError:
+		#Estaciones repetidas dejan sistemas singulares
+		Ainv = np.linalg.pinv(A)
+	#Pesos de las celdas por bloques: covarianzas con sus estaciones y la restriccion
+	W = np.empty((N,k))
+	for i in range(0,N,Nbloque):
+		v = vecinos[i:i+Nbloque]
+		b = np.ones((v.shape[0],k+1))
+		b[:,:k] = Covarianza(np.sqrt(((puntos[v]-xy[i:i+Nbloque,None,:])**2).sum(-1)))
+		W[i:i+Nbloque] = np.einsum('nij,nj->ni',Ainv[cual[i:i+Nbloque],:k,:],b)
+	return sparse.csr_matrix((W.ravel(),est[vecinos].ravel(),np.arange(0,N*k+1,k)),
+		shape=(N,coord.shape[1]))
+
+def __RainFormat__(formato):
+	'Funcion: __RainFormat__\n'\
+	'Descripcion: Obtiene el codigo con el que models escribe los binarios de lluvia.\n'\
+	'Parametros:.\n'\
+	'	-formato : dense: un entero por celda en cada record.\n'\
+	'		sparse: solo las celdas con lluvia (indices y valores), liviano para.\n'\
+	'		campos con pocas celdas mojadas (radar convectivo).\n'\
+	'		uint16: dos bytes por celda con una escala por record guardada en el.\n'\
+	'		indice (.idx), la resolucion es el maximo del campo / 65535.\n'\
+	'Retorno:.\n'\
+	'	codigo : 1 (dense), 2 (sparse) o 3 (uint16).\n'\
+	#Codigos de los formatos en models
+	Formatos = {'dense':1,'sparse':2,'uint16':3}
+	if formato not in Formatos:
+		raise ValueError('formato de lluvia no soportado: %s' % formato)
+	return Formatos[formato]
+
+def __RainBinFormat__(ruta_bin,defecto):
+	#Codigo del formato de un binario de lluvia que ya existe segun su marca
+	#(WMFS sparse, WMFQ uint16, sin marca dense), si no existe el codigo por defecto
+	if os.path.exists(ruta_bin) is False or os.path.getsize(ruta_bin) == 0:
+		return defecto
+	f = open(ruta_bin,'rb')
+	marca = f.read(4)
+	f.close()
+	return {'WMFS':2,'WMFQ':3}.get(marca,1)
+
+def __RainQuantize__(vec,codigo):
+	#Enteros que se guardan en el binario y escala [mm] del record (ver models.rain_quantize)
+	if codigo == 3:
+		escala = np.float32(vec.max()/65535.0)
+		if escala <= 0:
+			return np.zeros(vec.shape[0],dtype=int),np.float32(0.0)
+		return np.minimum(np.round(vec/escala),65535).astype(int),escala
+	return (vec*1000).astype(int),np.float32(0.001)
+
+def __RainHash__(valores,escala):
+	#Huella de un record cuantizado, dos campos con la misma huella comparten record
+	return hashlib.sha1(np.asarray(valores,dtype=np.int32).tostring()
+		+ np.float32(escala).tostring()).digest()
+
+def __UniqueColumns__(M):
+	#Columnas diferentes de M en el orden en que aparecen y a cual corresponde cada columna
+	u,primera,inversa = np.unique(M.T,axis=0,return_index=True,return_inverse=True)
+	orden = np.argsort(primera)
+	rango = np.empty_like(orden)
+	rango[orden] = np.arange(orden.size)
+	return M[:,primera[orden]],rango[inversa]
+
+def __IdwNeighbors__(xy_basin,coord,k=None,radius=None):
+	#Estaciones que usa cada celda en el IDW disperso: las k mas cercanas y/o las que
+	#estan a menos de radius, en orden ascendente y con indices de Fortran (desde 1).
+	#Entrega las estaciones de todas las celdas seguidas y donde empieza cada celda
+	arbol = cKDTree(np.asarray(coord,dtype=float).T)
+	Ncoord = coord.shape[1]
+	if k is None:
+		k = Ncoord
+	k = min(int(k),Ncoord)
+	if radius is None:
+		radius = np.inf
+	dist,vecinos = arbol.query(np.asarray(xy_basin,dtype=float).T,k=k,
+		distance_upper_bound=radius)
+	vecinos = np.sort(np.asarray(vecinos).reshape(xy_basin.shape[1],k),axis=1)
+	#Las que no alcanzan a estar en el radio salen con indice Ncoord
+	validos = vecinos < Ncoord
+	inicio = np.hstack([0,np.cumsum(validos.sum(axis=1))]) + 1
+	return vecinos[validos] + 1,inicio
+
+def __BarycentricOperator__(TIN,xy_basin):
+	#Matriz dispersa [Nceldas,Ncoord] con las coordenadas baricentricas de cada celda
+	#en su triangulo (3 valores por fila), el triangulo se ubica con find_simplex.
+	#Las celdas por fuera de la malla toman la estacion mas cercana
+	from scipy import sparse
+	xy = np.asarray(xy_basin,dtype=float).T
+	N = xy.shape[0]
+	Ncoord = TIN.points.shape[0]
+	triangulo = TIN.find_simplex(xy)
+	dentro = triangulo >= 0
+	T = TIN.transform[triangulo[dentro]]
+	b = np.einsum('nij,nj->ni',T[:,:2,:],xy[dentro] - T[:,2,:])
+	Pesos = np.hstack([b,1 - b.sum(axis=1)[:,np.newaxis]])
+	Filas = np.repeat(np.nonzero(dentro)[0],3)
+	Columnas = TIN.simplices[triangulo[dentro]].ravel()
+	Pesos = Pesos.ravel()
+	if not dentro.all():
+		fuera = np.nonzero(~dentro)[0]
+		cercana = cKDTree(TIN.points).query(xy[fuera])[1]
+		Filas = np.hstack([Filas,fuera])
+		Columnas = np.hstack([Columnas,cercana])
+		Pesos = np.hstack([Pesos,np.ones(fuera.size)])
+	return sparse.csr_matrix((Pesos,(Filas,Columnas)),shape=(N,Ncoord))
+
+#Filas del indice de lluvia, archivo 0 es el binario del mismo nombre del indice y
+#de 1 en adelante los binarios de la tabla de un indice virtual
+__RainIndexRow__ = np.dtype([('fecha','<i8'),('record','<i4'),('lluvia','<f4'),('escala','<f4'),
+	('archivo','<i4')])
+__RainIndexVersion__ = 1
+
+def __RainIndexDt__(epoch):
+	#Si las fechas son regulares entrega el dt [seg], asi se ubican en O(1)
+	if epoch.size > 1 and epoch.any():
+		delta = np.diff(epoch)
+		if delta[0] > 0 and (delta == delta[0]).all():
+			return int(delta[0])
+	return 0
+
+def write_rain_index(ruta,posIds,meanRain,dates=None,Nelem=0,scales=None):
+	'Funcion: write_rain_index\n'\
+	'Descripcion: Escribe el indice binario (.idx) de un binario de lluvia,.\n'\
+	'	reemplaza la tabla del .hdr para la ejecucion del modelo.\n'\
+	'Parametros:.\n'\
+	'	-ruta : Ruta del indice, debe terminar en .idx.\n'\
+	'	-posIds : Record del binario que corresponde a cada intervalo.\n'\
+	'	-meanRain : Lluvia media de cada intervalo.\n'\
+	'	-dates : Fecha de cada intervalo (opcional).\n'\
+	'	-Nelem : Cantidad de celdas o laderas de cada campo.\n'\
+	'	-scales : Escala [mm] de cada intervalo, necesaria en el formato uint16.\n'\
+	'Retorno:.\n'\
+	'	Escribe el indice: encabezado (WMFI, version, Nelem, Nreg, Ncampos, dt [seg],.\n'\
+	'		Narch), las rutas de los Narch binarios (500 caracteres, 0 si no es virtual).\n'\
+	'		y una fila por intervalo con la fecha (int64, seg desde 1970), el record (int32),.\n'\
+	'		la lluvia media y la escala (float32) y el binario (int32, 0 el del mismo.\n'\
+	'		nombre), asi se le pueden agregar intervalos al final.\n'\
+	#Pasa las fechas a segundos desde 1970
+	Nreg = len(posIds)
+	if dates is not None and len(dates) == Nreg:
+		epoch = np.array(dates,dtype='datetime64[s]').astype(np.int64)
+	else:
+		epoch = np.zeros(Nreg,dtype=np.int64)
+	dtIdx = __RainIndexDt__(epoch)
+	#Escribe el indice 
+	Filas = np.zeros(Nreg,dtype=__RainIndexRow__)
+	Filas['fecha'] = epoch
+	Filas['record'] = posIds
+	Filas['lluvia'] = meanRain
+	if scales is not None:
+		Filas['escala'] = scales
+	f = open(ruta,'wb')
+	f.write('WMFI')
+	np.array([__RainIndexVersion__,Nelem,Nreg,np.max(posIds),dtIdx,0],dtype=np.int32).tofile(f)
+	Filas.tofile(f)
+	f.close()
+
+def __ReadRainIndexHeader__(f):
+	#Lee el encabezado de un indice abierto: Nelem, Nreg, Ncampos, dt, Narch
+	if f.read(4) <> 'WMFI':
+		raise ValueError('El archivo no es un indice de lluvia (.idx)')
+	version,Nelem,Nreg,Ncampos,dtIdx,Narch = np.fromfile(f,dtype=np.int32,count=6)
+	if version <> __RainIndexVersion__:
+		raise ValueError('Version %d del indice de lluvia no soportada' % version)
+	return Nelem,Nreg,Ncampos,dtIdx,Narch
+
+def __ReadRainIndexFiles__(f,Narch):
+	#Lee (despues del encabezado) los binarios de un indice virtual y donde
+	#empiezan las filas
+	archivos = [f.read(500).rstrip() for i in range(Narch)]
+	return 28+500*Narch,archivos
+
+def read_rain_index(ruta):
+	'Funcion: read_rain_index\n'\
+	'Descripcion: Lee el indice binario (.idx) de un binario de lluvia.\n'\
+	'Parametros:.\n'\
+	'	-ruta : Ruta del indice .idx.\n'\
+	'Retorno:.\n'\
+	'	Data : DataFrame con el Record, la Lluvia, la Escala y el Archivo (binario.\n'\
+	'		que tiene el record) de cada fecha.\n'\
+	#Lee el encabezado y los vectores del indice
+	f = open(ruta,'rb')
+	Nelem,Nreg,Ncampos,dtIdx,Narch = __ReadRainIndexHeader__(f)
+	inicio,archivos = __ReadRainIndexFiles__(f,Narch)
+	Filas = np.fromfile(f,dtype=__RainIndexRow__,count=Nreg)
+	f.close()
+	archivos = [os.path.abspath(ruta[:-3]+'bin')] + archivos
+	return pd.DataFrame({'Record':Filas['record'],'Lluvia':Filas['lluvia'],
+		'Escala':Filas['escala'],'Archivo':np.array(archivos,dtype=object)[Filas['archivo']]},
+		index = pd.to_datetime(Filas['fecha'],unit='s'),columns=['Record','Lluvia','Escala','Archivo'])
+
+def find_rain_index(ruta,fecha):
+	'Funcion: find_rain_index\n'\
+	'Descripcion: Ubica una fecha en el indice binario (.idx) de la lluvia,.\n'\
+	'	si el indice tiene dt regular la ubica sin leer las fechas.\n'\
+	'Parametros:.\n'\
+	'	-ruta : Ruta del indice .idx.\n'\
+	'	-fecha : Fecha buscada en formato datetime.\n'\
+	'Retorno:.\n'\
+	'	pos : Numero del intervalo (inicia en 1), sirve como start_point.\n'\
+	'		de SimuBasin.run_shia.\n'\
+	#Lee el encabezado y la primera fecha
+	objetivo = np.array(fecha,dtype='datetime64[s]').astype(np.int64)
+	f = open(ruta,'rb')
+	Nelem,Nreg,Ncampos,dtIdx,Narch = __ReadRainIndexHeader__(f)
+	offset = 28+500*Narch
+	if dtIdx > 0:
+		#Intervalos regulares: la posicion sale directo
+		f.seek(offset)
+		inicio = np.fromfile(f,dtype=np.int64,count=1)[0]
+		pos = int((objetivo - inicio) // dtIdx)
+		if (objetivo - inicio) % dtIdx <> 0:
+			pos = -1
+	else:
+		#Intervalos irregulares: busqueda binaria sobre las fechas mapeadas
+		epoch = np.memmap(ruta,dtype=__RainIndexRow__,mode='r',offset=offset,shape=(Nreg,))['fecha']
+		pos = int(np.searchsorted(epoch,objetivo))
+		if pos >= Nreg or epoch[pos] <> objetivo:
+			pos = -1
+	f.close()
+	if pos < 0 or pos >= Nreg:
+		raise ValueError('La fecha %s no esta en el indice %s' % (fecha,ruta))
+	return pos+1
+
+def write_virtual_rain_index(ruta,Data,Nelem):
+	'Funcion: write_virtual_rain_index\n'\
+	'Descripcion: Escribe un indice virtual (.idx con tabla de binarios), los intervalos.\n'\
+	'	apuntan a records de uno o varios binarios existentes, no se copian campos.\n'\
+	'Parametros:.\n'\
+	'	-ruta : Ruta del indice virtual, debe terminar en .idx.\n'\
+	'	-Data : DataFrame como el de read_rain_index (Record, Lluvia, Escala, Archivo).\n'\
+	'	-Nelem : Cantidad de celdas o laderas de cada campo.\n'\
+	'Retorno:.\n'\
+	'	Escribe el indice, SimuBasin.run_shia lo usa como cualquier .idx.\n'\
+	#Tabla de binarios, las rutas se guardan absolutas y de 500 caracteres (models)
+	archivos = sorted(set(Data['Archivo']))
+	for a in archivos:
+		if len(a) > 500:
+			raise ValueError('La ruta del binario supera 500 caracteres: %s' % a)
+	numero = dict([(a,i+1) for i,a in enumerate(archivos)])
+	#Filas del indice 
+	epoch = Data.index.values.astype('datetime64[s]').astype(np.int64)
+	Filas = np.zeros(Data.shape[0],dtype=__RainIndexRow__)
+	Filas['fecha'] = epoch
+	Filas['record'] = Data['Record'].values
+	Filas['lluvia'] = Data['Lluvia'].values
+	Filas['escala'] = Data['Escala'].values
+	Filas['archivo'] = [numero[a] for a in Data['Archivo']]
+	f = open(ruta,'wb')
+	f.write('WMFI')
+	np.array([__RainIndexVersion__,Nelem,Data.shape[0],Data['Record'].max(),
+		__RainIndexDt__(epoch),len(archivos)],dtype=np.int32).tofile(f)
+	f.write(''.join([a.ljust(500) for a in archivos]))
+	Filas.tofile(f)
+	f.close()
+
+def slice_rain_index(ruta_in,ruta_out,fechaI=None,fechaF=None):
+	'Funcion: slice_rain_index\n'\
+	'Descripcion: Genera una fuente de lluvia virtual con el periodo [fechaI,fechaF].\n'\
+	'	de otra, solo escribe un indice nuevo que apunta a los binarios existentes.\n'\
+	'Parametros:.\n'\
+	'	-ruta_in : Indice (.idx) de la lluvia original, normal o virtual.\n'\
+	'	-ruta_out : Ruta del indice virtual (.idx).\n'\
+	'	-fechaI, fechaF : Fechas inicial y final (incluidas), si no se dan se.\n'\
+	'		toma desde el inicio o hasta el final.\n'\
+	'Retorno:.\n'\
+	'	Data : DataFrame con los intervalos del indice virtual.\n'\
+	#Lee el indice y toma el periodo
+	f = open(ruta_in,'rb')
+	Nelem = __ReadRainIndexHeader__(f)[0]
+	f.close()
+	Data = read_rain_index(ruta_in)[fechaI:fechaF]
+	if Data.shape[0] == 0:
+		raise ValueError('El periodo no tiene intervalos en %s' % ruta_in)
+	write_virtual_rain_index(ruta_out,Data,Nelem)
+	return Data
+
+def concat_rain_index(rutas_in,ruta_out):
+	'Funcion: concat_rain_index\n'\
+	'Descripcion: Genera una fuente de lluvia virtual que une varias fuentes en.\n'\
+	'	el orden dado (p.ej. archivos mensuales), sin copiar los campos.\n'\
+	'Parametros:.\n'\
+	'	-rutas_in : Lista de indices (.idx) a unir, normales o virtuales.\n'\
+	'	-ruta_out : Ruta del indice virtual (.idx).\n'\
+	'Retorno:.\n'\
+	'	Data : DataFrame con los intervalos del indice virtual.\n'\
+	#Todas las fuentes deben tener la misma cantidad de elementos
+	Datos = []; Nelem = None
+	for ruta in rutas_in:
+		f = open(ruta,'rb')
+		N = __ReadRainIndexHeader__(f)[0]
+		f.close()
+		if Nelem is not None and N <> Nelem:
+			raise ValueError('%s tiene %d elementos y las demas fuentes %d' % (ruta,N,Nelem))
+		Nelem = N
+		Datos.append(read_rain_index(ruta))
+	Data = pd.concat(Datos)
+	write_virtual_rain_index(ruta_out,Data,Nelem)
+	return Data
+
 def read_mean_rain(ruta,Nintervals=None,FirstInt=None):
+	#Si es un indice binario lo lee directamente
+	if ruta.endswith('.idx'):
+		Rain = read_rain_index(ruta)['Lluvia']
+		if Nintervals is not None or FirstInt is not None:
+			Rain = Rain[FirstInt:FirstInt+Nintervals]
+		return Rain
 	#Abrey cierra el archivo plano
 	Data = np.loadtxt(ruta,skiprows=6,usecols=(2,3),delimiter=',',dtype='str')
 	Rain = np.array([float(i[0]) for i in Data])
@@ -279,6 +716,126 @@ def read_mean_rain(ruta,Nintervals=None,FirstInt=None):
 	#Regresa el resultado de la funcion
 	return pd.Series(Rain,index = pd.to_datetime(Dates))
 	
+def __RainIndexEpoch__(ruta,pos):
+	#Fecha (seg desde 1970) del intervalo pos (inicia en 1) del indice, -1 si
+	#el indice no tiene fechas o no existe
+	if ruta.endswith('.idx') is False or os.path.exists(ruta) is False:
+		return -1
+	f = open(ruta,'rb')
+	Nelem,Nreg,Ncampos,dtIdx,Narch = __ReadRainIndexHeader__(f)
+	f.close()
+	epoch = np.memmap(ruta,dtype=__RainIndexRow__,mode='r',offset=28+500*Narch,
+		shape=(Nreg,))['fecha']
+	if Nreg == 0 or epoch[0] == 0:
+		return -1
+	if pos <= Nreg:
+		return int(epoch[pos-1])
+	#Despues del ultimo intervalo solo se conoce si el dt es regular
+	if dtIdx > 0:
+		return int(epoch[Nreg-1]) + (pos-Nreg)*int(dtIdx)
+	return -1
+
+def read_shia_output(ruta):
+	'Funcion: read_shia_output\n'\
+	'Descripcion: Lee un binario de salida escrito por ShiaWriter.\n'\
+	'Parametros:.\n'\
+	'	-ruta : Ruta del binario (ruta_<salida>.bin).\n'\
+	'Retorno:.\n'\
+	'	Datos : Registros [Nreg, forma de la salida] (memmap de solo lectura), el.\n'\
+	'		registro k es el intervalo k*cada de la simulacion.\n'\
+	'	cada : Cada cuantos intervalos se guardo la salida.\n'\
+	#Lee el encabezado
+	f = open(ruta,'rb')
+	if f.read(4) <> 'WMFO':
+		raise ValueError('%s no es una salida de ShiaWriter' % ruta)
+	version,cada,Nreg,ndim = np.fromfile(f,dtype=np.int32,count=4)
+	forma = tuple(np.fromfile(f,dtype=np.int32,count=ndim))
+	f.close()
+	if Nreg == 0:
+		return np.zeros((0,)+forma,dtype=np.float32),cada
+	return np.memmap(ruta,dtype=np.float32,mode='r',offset=20+4*ndim,
+		shape=(Nreg,)+forma),cada
+
+def __ShuffleBytes__(datos):
+	#Agrupa los bytes de igual posicion de los float32, asi zlib comprime mucho mejor
+	datos = np.ascontiguousarray(datos,dtype=np.float32)
+	return datos.view(np.uint8).reshape(-1,4).T.tostring()
+
+def __UnshuffleBytes__(texto,forma):
+	#Inverso de __ShuffleBytes__
+	datos = np.frombuffer(texto,dtype=np.uint8).reshape(4,-1).T.copy()
+	return datos.view(np.float32).reshape(forma)
+
+def __ReadSnapshotInfo__(ruta):
+	#Lee el encabezado de un SnapshotStore y su indice de bloques
+	f = open(ruta,'rb')
+	if f.read(4) <> 'WMFZ':
+		f.close()
+		raise ValueError('%s no es un binario de SnapshotStore' % ruta)
+	version,cada,Nfilas,Nceldas,Nchunk,Ncells,N = np.fromfile(f,dtype=np.int32,count=7)
+	filas = np.fromfile(f,dtype=np.int32,count=2*Nfilas).reshape(Nfilas,2)
+	celdas = np.fromfile(f,dtype=np.int32,count=Nceldas)
+	f.close()
+	g = open(ruta+'.idx','rb')
+	g.read(4)
+	indice = np.fromfile(g,dtype=__SnapshotRow__)
+	g.close()
+	nombres = ['%s_%d' % (__SnapshotVars__[c][0],t) for c,t in filas]
+	return {'cada' : cada,'nombres' : nombres,'celdas' : celdas,'Ncells' : Ncells,
+		'N' : N,'indice' : indice}
+
+def __ReadSnapshotBlock__(f,fila,Nfilas,Ncells,Nceldas):
+	#Lee y descomprime un bloque [Nregistros,Nfilas,celdas del bloque]
+	f.seek(fila['offset'])
+	ancho = min(Ncells,Nceldas - fila['bloque']*Ncells)
+	return __UnshuffleBytes__(zlib.decompress(f.read(fila['bytes'])),
+		(fila['Nregistros'],Nfilas,ancho))
+
+def write_checkpoint(ruta,Estado):
+	'Funcion: write_checkpoint\n'\
+	'Descripcion: Guarda el estado completo de una simulacion de SimuBasin.run_shia.\n'\
+	'	en un binario comprimido (npz), el archivo se reemplaza de una vez para que.\n'\
+	'	una falla durante el guardado no deje un checkpoint a medias.\n'\
+	'Parametros:.\n'\
+	'	-ruta : Ruta del checkpoint.\n'\
+	'	-Estado : Diccionario con los arreglos del estado (ver read_checkpoint).\n'\
+	'Retorno:.\n'\
+	'	Escribe el checkpoint.\n'\
+	#Escribe a un temporal y lo renombra
+	temporal = ruta + '.tmp'
+	f = open(temporal,'wb')
+	np.savez_compressed(f,**Estado)
+	f.close()
+	if os.name == 'nt' and os.path.exists(ruta):
+		os.remove(ruta)
+	os.rename(temporal,ruta)
+
+def read_checkpoint(ruta):
+	'Funcion: read_checkpoint\n'\
+	'Descripcion: Lee un checkpoint escrito por SimuBasin.run_shia.\n'\
+	'Parametros:.\n'\
+	'	-ruta : Ruta del checkpoint.\n'\
+	'Retorno:.\n'\
+	'	Estado : Diccionario con:.\n'\
+	'		- version, N, modelType, dt.\n'\
+	'		- intervalo : siguiente intervalo de lluvia a simular (start_point).\n'\
+	'		- fecha : fecha de ese intervalo (seg desde 1970), -1 si la lluvia no tiene fechas.\n'\
+	'		- calibracion [Nmiembros,10].\n'\
+	'		- storage [Nmiembros,5,N], speed [Nmiembros,4,N], fluxes [Nmiembros,3,N].\n'\
+	'			y retorned [Nmiembros,N].\n'\
+	'		- vs, vd, vsc, vdc, volero, voldepo, erot, dept : estado de sedimentos (si se simulan).\n'\
+	'		- slideocurrence, unit_type : estado de deslizamientos (si se simulan).\n'\
+	#Los valores escalares salen como numeros
+	f = open(ruta,'rb')
+	Datos = np.load(f)
+	Estado = {}
+	for k in Datos.files:
+		Estado.update({k : Datos[k][()] if Datos[k].ndim == 0 else Datos[k]})
+	f.close()
+	if Estado.get('version',0) <> 1:
+		raise ValueError('%s no es un checkpoint de WMF' % ruta)
+	return Estado
+	
 	
 #-----------------------------------------------------------------------
 #Ecuaciones Que son de utilidad
@@ -345,6 +902,870 @@ def __ModifyElevErode__(X,slope=0.01,d2 = 0.03, window = 25):
 	slope = np.hstack([slope,slope[-1]])
 	return Y,np.abs(slope)
 
+#-----------------------------------------------------------------------
+#Escritura continua de binarios de lluvia
+#-----------------------------------------------------------------------
+
+class RainWriter:
+	
+	#------------------------------------------------------
+	# Apertura, escritura por bloques y cierre del binario
+	#------------------------------------------------------
+	def __init__(self,cuenca,ruta_out,umbral=0.01,formato='dense',
+		Nbuffer=32,status='update',dedupe=False,tipo='radar',criterio='media'):
+		'Descripcion: Mantiene abierto un binario de lluvia y su indice para.\n'\
+		'	agregarle campos uno a uno, los campos se acumulan en memoria y se.\n'\
+		'	escriben por bloques en un hilo aparte, despues de cada bloque el.\n'\
+		'	indice (.idx) queda actualizado, si el proceso se cae solo se pierde.\n'\
+		'	el bloque que estaba en memoria y con status=old se continua.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'cuenca : Objeto SimuBasin al que corresponden los campos.\n'\
+		'ruta_out: Ruta donde escribe el binario con la lluvia.\n'\
+		'umbral: Lluvia media minima para guardar el campo, debajo se usa el record 1.\n'\
+		'formato: Formato del binario: dense (defecto), sparse o uint16.\n'\
+		'Nbuffer: Cantidad de intervalos que se acumulan antes de escribir.\n'\
+		'status: update: (Defecto) crea un binario nuevo.\n'\
+		'	old: continua un binario existente desde el ultimo bloque escrito.\n'\
+		'dedupe: Si es True los campos identicos a uno ya escrito por este.\n'\
+		'	escritor comparten record (defecto False).\n'\
+		'tipo: Origen de los campos que se anota en el .hdr (defecto radar).\n'\
+		'criterio: Cuando se guarda un campo y que lluvia media se anota:.\n'\
+		'	media: (Defecto) si la media de todos los elementos supera umbral,.\n'\
+		'	se anota esa media.\n'\
+		'	idw: como rain_interpolate_idw, si la suma del campo supera umbral y.\n'\
+		'	algun elemento supera umbral, se anota la suma sobre la cantidad de.\n'\
+		'	elementos con lluvia.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'self : Escritor listo, se usa con with o se cierra con close.\n'\
+		#Rutas del binario, la tabla y el indice
+		if ruta_out.endswith('.hdr') or ruta_out.endswith('.bin'):
+			ruta_out = ruta_out[:-4]
+		self.ruta_bin = ruta_out+'.bin'
+		self.ruta_hdr = ruta_out+'.hdr'
+		self.ruta_idx = ruta_out+'.idx'
+		self.cuenca = cuenca
+		self.umbral = umbral
+		self.Nbuffer = Nbuffer
+		self.dedupe = dedupe
+		self.tipo = tipo
+		self.criterio = criterio
+		self.huellas = {}
+		#Establece la cantidad de elementos de acuerdo al tipo de cuenca
+		if cuenca.modelType[0] is 'c':
+			self.N = cuenca.ncells
+		elif cuenca.modelType[0] is 'h':
+			self.N = cuenca.nhills
+		#Abre los archivos 
+		if status == 'old' and os.path.exists(self.ruta_idx):
+			self.__Continue__()
+		else:
+			self.__Create__(formato)
+		#Bloque en memoria y escritor en segundo plano
+		self.datos = []
+		self.filas = []
+		self.error = None
+		self.cola = Queue.Queue(maxsize = 2)
+		self.hilo = threading.Thread(target = self.__Writer__)
+		self.hilo.daemon = True
+		self.hilo.start()
+	
+	def __Create__(self,formato):
+		#Binario nuevo: encabezado (sparse y uint16) y record 1 con el campo de ceros
+		self.codigo = __RainFormat__(formato)
+		self.fbin = open(self.ruta_bin,'wb')
+		if self.codigo > 1:
+			self.fbin.write({2:'WMFS',3:'WMFQ'}[self.codigo])
+			np.array([self.N,0],dtype=np.int32).tofile(self.fbin)
+		self.fbin.write(self.__Encode__(np.zeros(self.N,dtype=np.int32)))
+		self.fbin.flush()
+		#Indice sin intervalos
+		self.Nreg = 0; self.Ncampos = 1; self.dtIdx = 0; self.ultima = 0
+		self.fidx = open(self.ruta_idx,'wb')
+		self.fidx.write('WMFI')
+		self.fidx.write(self.__Header__().tostring())
+		self.fidx.flush()
+	
+	def __Continue__(self):
+		#A los indices virtuales no se les agregan campos
+		f = open(self.ruta_idx,'rb')
+		Nelem,Nreg,Ncampos,dtIdx,Narch = __ReadRainIndexHeader__(f)
+		f.close()
+		if Narch > 0:
+			raise ValueError('%s es un indice virtual, no se le pueden agregar campos' % self.ruta_idx)
+		self.Nreg = Nreg; self.Ncampos = Ncampos; self.dtIdx = dtIdx
+		#Descarta lo que quedo escrito despues del ultimo bloque completo
+		self.fidx = open(self.ruta_idx,'r+b')
+		self.fidx.truncate(28+__RainIndexRow__.itemsize*Nreg)
+		self.ultima = 0
+		if Nreg > 0:
+			self.fidx.seek(28+__RainIndexRow__.itemsize*(Nreg-1))
+			self.ultima = np.fromfile(self.fidx,dtype=__RainIndexRow__,count=1)['fecha'][0]
+		self.fbin = open(self.ruta_bin,'r+b')
+		marca = self.fbin.read(4)
+		if marca == 'WMFS':
+			#Sparse: recorre los encabezados de los records escritos
+			self.codigo = 2
+			pos = 12
+			for i in range(Ncampos):
+				self.fbin.seek(pos)
+				pos += 4*(1+2*np.fromfile(self.fbin,dtype=np.int32,count=1)[0])
+		elif marca == 'WMFQ':
+			self.codigo = 3
+			pos = 12+2*self.N*Ncampos
+		else:
+			self.codigo = 1
+			pos = 4*self.N*Ncampos
+		self.fbin.truncate(pos)
+		self.fbin.seek(pos)
+	
+	def __Header__(self):
+		#Encabezado del indice sin la marca
+		return np.array([__RainIndexVersion__,self.N,self.Nreg,self.Ncampos,self.dtIdx,0],
+			dtype=np.int32)
+	
+	def __Encode__(self,vec):
+		#Bytes de un record en el formato del binario
+		if self.codigo == 1:
+			return vec.astype(np.int32).tostring()
+		if self.codigo == 3:
+			return vec.astype(np.uint16).tostring()
+		pos = np.nonzero(vec)[0]
+		return np.hstack([[pos.size],pos+1,vec[pos]]).astype(np.int32).tostring()
+	
+	def __Writer__(self):
+		#Escribe los bloques en orden: primero los campos y luego el indice,
+		#el encabezado del indice solo cuenta intervalos que ya estan en disco
+		while True:
+			bloque = self.cola.get()
+			if bloque is None:
+				self.cola.task_done()
+				break
+			datos,filas,encabezado = bloque
+			try:
+				self.fbin.write(''.join(datos))
+				self.fbin.flush()
+				os.fsync(self.fbin.fileno())
+				self.fidx.seek(28+__RainIndexRow__.itemsize*(encabezado[2]-filas.size))
+				self.fidx.write(filas.tostring())
+				self.fidx.flush()
+				os.fsync(self.fidx.fileno())
+				self.fidx.seek(4)
+				self.fidx.write(encabezado.tostring())
+				self.fidx.flush()
+			except Exception as e:
+				self.error = e
+			self.cola.task_done()
+	
+	def __CheckError__(self):
+		#Levanta en el hilo principal los errores del escritor
+		if self.error is not None:
+			raise IOError('No se pudo escribir la lluvia en %s: %s' % (self.ruta_bin,self.error))
+	
+	def write(self,vec,fecha=None):
+		'Descripcion: Agrega un campo de lluvia al binario.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'vec: Array en forma de la cuenca con la lluvia del intervalo [mm].\n'\
+		'fecha: Fecha del intervalo.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'record : Record del binario asignado al intervalo.\n'\
+		#Revisa que el hilo de escritura siga bien
+		self.__CheckError__()
+		vec = np.asarray(vec)
+		#Con criterio idw se decide con el campo tal como llega (en celdas),
+		#igual que rain_idw_record
+		if self.criterio == 'idw':
+			suma = vec.sum()
+			guarda = suma > self.umbral and (vec > self.umbral).any()
+			if guarda:
+				media = suma / (vec > 0).sum()
+		if self.cuenca.modelType[0] is 'h' and vec.shape[0] == self.cuenca.ncells:
+			vec = self.cuenca.Transform_Basin2Hills(vec,sumORmean=1)
+		#Campo con lluvia o intervalo seco
+		if self.criterio <> 'idw':
+			media = vec.mean()
+			guarda = media > self.umbral
+		if guarda:
+			valores,escala = __RainQuantize__(vec,self.codigo)
+			llave = None
+			if self.dedupe:
+				llave = __RainHash__(valores,escala)
+			if llave in self.huellas:
+				record = self.huellas[llave]
+			else:
+				self.Ncampos += 1
+				record = self.Ncampos
+				self.datos.append(self.__Encode__(valores))
+				if self.dedupe:
+					self.huellas[llave] = record
+		else:
+			record = 1
+			media = 0.0
+			escala = 0.0
+		#Fecha en segundos y regularidad del dt
+		epoch = 0
+		if fecha is not None:
+			epoch = np.array(fecha,dtype='datetime64[s]').astype(np.int64)
+		if self.Nreg == 1 and epoch > self.ultima and self.ultima <> 0:
+			self.dtIdx = int(epoch - self.ultima)
+		elif self.Nreg > 1 and epoch - self.ultima <> self.dtIdx:
+			self.dtIdx = 0
+		self.ultima = epoch
+		self.Nreg += 1
+		self.filas.append((epoch,record,media,escala,0))
+		#Escribe el bloque cuando se llena
+		if len(self.filas) >= self.Nbuffer:
+			self.flush()
+		return record
+	
+	def flush(self):
+		'Descripcion: Pasa el bloque en memoria al hilo de escritura.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'No hay retorno, el bloque se escribe en segundo plano.\n'\
+		#Entrega una copia del estado actual al escritor
+		self.__CheckError__()
+		if len(self.filas) == 0:
+			return
+		filas = np.array(self.filas,dtype=__RainIndexRow__)
+		self.cola.put((self.datos,filas,self.__Header__()))
+		self.datos = []
+		self.filas = []
+	
+	def close(self):
+		'Descripcion: Escribe lo que queda en memoria, cierra el binario.\n'\
+		'	y genera la tabla .hdr a partir del indice.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'meanRain : La serie de lluvia promedio.\n'\
+		#Termina el hilo de escritura
+		if self.hilo.is_alive():
+			self.flush()
+			self.cola.put(None)
+			self.hilo.join()
+			self.fbin.close()
+			self.fidx.close()
+		self.__CheckError__()
+		#Guarda un archivo con informacion de la lluvia 
+		Data = read_rain_index(self.ruta_idx)
+		f=open(self.ruta_hdr,'w')
+		f.write('Numero de celdas: %d \n' % self.cuenca.ncells)
+		f.write('Numero de laderas: %d \n' % self.cuenca.nhills)
+		f.write('Numero de registros: %d \n' % Data.shape[0])
+		f.write('Numero de campos no cero: %d \n' % self.Ncampos)
+		f.write('Tipo de interpolacion: %s \n' % self.tipo)
+		f.write('IDfecha, Record, Lluvia, Fecha \n')
+		c = 1
+		for d,pos,m in zip(Data.index,Data['Record'],Data['Lluvia']):
+			f.write('%d, \t %d, \t %.2f, %s \n' % (c,pos,m,d.strftime('%Y-%m-%d-%H:%M')))
+			c+=1
+		f.close()
+		return Data['Lluvia']
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self,tipo,valor,traza):
+		#Aun con errores deja en disco lo que alcanzo a recibir
+		self.close()
+		return False
+
+class RainReader:
+
+	def __init__(self,ruta_bin,ruta_tabla,N):
+		'Descripcion: Lee por bloques de intervalos un binario de lluvia (dense,.\n'\
+		'	sparse o uint16) con su tabla (.idx, tambien virtual, o .hdr), entrega.\n'\
+		'	la lluvia igual a como la lee models en la simulacion. Cada lector tiene.\n'\
+		'	sus propios archivos abiertos, asi se pueden usar varios desde diferentes hilos.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'ruta_bin: Ruta del binario de lluvia.\n'\
+		'ruta_tabla: Ruta del indice (.idx) o de la tabla de texto (.hdr).\n'\
+		'N: Cantidad de celdas o laderas de cada campo.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'self : Lector listo, se cierra con close.\n'\
+		#Record, escala y binario de cada intervalo
+		f = open(ruta_tabla,'rb')
+		marca = f.read(4)
+		f.close()
+		if marca == 'WMFI':
+			Data = read_rain_index(ruta_tabla)
+			self.records = Data['Record'].values.astype(int)
+			self.escalas = Data['Escala'].values.astype(np.float32)
+			archivos = Data['Archivo'].values
+		else:
+			self.records = np.loadtxt(ruta_tabla,skiprows=6,usecols=(1,),delimiter=',',
+				dtype=int,ndmin=1)
+			self.escalas = np.zeros(self.records.size,dtype=np.float32)
+			archivos = np.array([ruta_bin]*self.records.size,dtype=object)
+		self.rutas,self.archivo = np.unique(archivos,return_inverse=True)
+		self.N = N
+		self.binarios = {}
+		#Ultimo campo leido, solo se va al disco si el record cambia
+		self.cargado = None
+		self.campo = None
+		#Records leidos del disco y sus bytes
+		self.lecturas = 0
+		self.bytes = 0
+
+	def __Binario__(self,a):
+		#Abre una sola vez el binario a: formato y acceso a sus records
+		if a not in self.binarios:
+			ruta = self.rutas[a]
+			tamano = os.path.getsize(ruta)
+			f = open(ruta,'rb')
+			marca = f.read(4)
+			if marca == 'WMFS':
+				#Sparse: ubica donde empieza cada record
+				offsets = []
+				pos = 12
+				while pos < tamano:
+					f.seek(pos)
+					offsets.append(pos)
+					pos += 4*(1+2*np.fromfile(f,dtype=np.int32,count=1)[0])
+				self.binarios[a] = (2,f,offsets)
+			elif marca == 'WMFQ':
+				f.close()
+				self.binarios[a] = (3,np.memmap(ruta,dtype=np.uint16,mode='r',offset=12,
+					shape=((tamano-12)/(2*self.N),self.N)),None)
+			else:
+				f.close()
+				self.binarios[a] = (1,np.memmap(ruta,dtype=np.int32,mode='r',
+					shape=(tamano/(4*self.N),self.N)),None)
+		return self.binarios[a]
+
+	def __Record__(self,a,record):
+		#Enteros del record en el binario a
+		codigo,datos,offsets = self.__Binario__(a)
+		self.lecturas += 1
+		if codigo == 2:
+			if record > len(offsets):
+				raise ValueError('El record %d no esta en %s' % (record,self.rutas[a]))
+			datos.seek(offsets[record-1])
+			nnz = np.fromfile(datos,dtype=np.int32,count=1)[0]
+			pos = np.fromfile(datos,dtype=np.int32,count=2*nnz)
+			campo = np.zeros(self.N,dtype=np.int32)
+			campo[pos[:nnz]-1] = pos[nnz:]
+			self.bytes += 4*(1+2*nnz)
+			return codigo,campo
+		if record > datos.shape[0]:
+			raise ValueError('El record %d no esta en %s' % (record,self.rutas[a]))
+		self.bytes += datos.itemsize*self.N
+		return codigo,datos[record-1]
+
+	def read(self,inicio,Nintervalos):
+		'Descripcion: Lee la lluvia de un bloque de intervalos.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'inicio: Primer intervalo del bloque (inicia en 1, como start_point).\n'\
+		'Nintervalos: Cantidad de intervalos del bloque.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'Rain : Lluvia [mm] de cada intervalo (N,Nintervalos) en float32.\n'\
+		#Revisa que la tabla alcance
+		if inicio-1+Nintervalos > self.records.size:
+			raise ValueError('El indice de lluvia es mas corto que la simulacion')
+		Rain = np.zeros((self.N,Nintervalos),dtype=np.float32,order='F')
+		for j in range(Nintervalos):
+			t = inicio-1+j
+			if self.records[t] == 1:
+				continue
+			llave = (self.archivo[t],self.records[t])
+			if llave <> self.cargado:
+				self.codigo,campo = self.__Record__(*llave)
+				self.campo = campo.astype(np.float32)
+				self.cargado = llave
+			#Misma aritmetica en float32 que models.rain_read_interval
+			if self.codigo == 3:
+				Rain[:,j] = self.campo*self.escalas[t]
+			else:
+				Rain[:,j] = self.campo/np.float32(1000.0)
+		return Rain
+
+	def close(self):
+		'Descripcion: Cierra los binarios abiertos por el lector.\n'\
+		#Los sparse quedan abiertos como archivo, los demas como memmap
+		for codigo,datos,offsets in self.binarios.values():
+			if codigo == 2:
+				datos.close()
+		self.binarios = {}
+		self.cargado = None
+
+#Salidas de run_shia que puede guardar ShiaWriter: series (un valor por intervalo)
+#y estados (mapas de la cuenca al final de un bloque de intervalos)
+__ShiaSeries__ = ['Qsim','Humedad','Balance','Fluxes','Sediments','MeanRain']
+__ShiaEstados__ = ['Storage','Speed']
+
+class ShiaWriter:
+	
+	def __init__(self,ruta,salidas,buffer_mb=64):
+		'Descripcion: Recibe los resultados de SimuBasin.run_shia (o de.\n'\
+		'	run_shia_ensemble) a medida que se simulan y los escribe en un hilo.\n'\
+		'	aparte, asi las series completas no tienen que caber en memoria. Cada.\n'\
+		'	salida va a su propio binario y se guarda cada tantos intervalos.\n'\
+		'	Varias ejecuciones seguidas (p.ej. con resume_from) con el mismo.\n'\
+		'	escritor continuan las mismas series.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'ruta: Ruta base, cada salida se escribe en ruta_<salida>.bin.\n'\
+		'salidas: Diccionario {salida : cada} con las salidas y cada cuantos intervalos.\n'\
+		'	se guardan, p.ej. {"Qsim":1, "Storage":60}. Series: Qsim, Humedad, Balance,.\n'\
+		'	Fluxes, Sediments y MeanRain, se guarda el valor del intervalo multiplo de.\n'\
+		'	cada. Estados: Storage y Speed, el almacenamiento y las velocidades al.\n'\
+		'	final de ese intervalo.\n'\
+		'buffer_mb: Megas que acumula cada salida antes de pasarlos al hilo de.\n'\
+		'	escritura, la cola del hilo tiene maximo 2 bloques.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'self : Escritor listo para run_shia(sink=...), se usa con with o se cierra.\n'\
+		'	con close. Los binarios se leen con read_shia_output.\n'\
+		#Revisa las salidas y sus intervalos
+		self.salidas = {}
+		self.rutas = {}
+		for nombre,cada in salidas.iteritems():
+			if nombre not in __ShiaSeries__ + __ShiaEstados__:
+				raise ValueError('%s no es una salida de run_shia' % nombre)
+			if int(cada) < 1:
+				raise ValueError('La salida %s se debe guardar cada 1 o mas intervalos' % nombre)
+			self.salidas[nombre] = int(cada)
+			self.rutas[nombre] = ruta+'_'+nombre+'.bin'
+		self.Nbytes = int(buffer_mb*2**20)
+		#Intervalos ya recibidos y bloques en memoria de cada salida
+		self.paso = 0
+		self.datos = dict([(nombre,[]) for nombre in self.salidas])
+		self.tamano = dict([(nombre,0) for nombre in self.salidas])
+		#Escritor en segundo plano
+		self.archivos = {}
+		self.error = None
+		self.cola = Queue.Queue(maxsize = 2)
+		self.hilo = threading.Thread(target = self.__Writer__)
+		self.hilo.daemon = True
+		self.hilo.start()
+	
+	def __Writer__(self):
+		#Escribe los bloques en orden, el encabezado de cada binario (WMFO, version,.
+		#cada, Nreg, ndim y la forma de un registro) solo cuenta lo que ya esta en disco
+		while True:
+			bloque = self.cola.get()
+			if bloque is None:
+				self.cola.task_done()
+				break
+			nombre,datos = bloque
+			try:
+				if nombre not in self.archivos:
+					f = open(self.rutas[nombre],'wb')
+					f.write('WMFO')
+					f.write(np.array([1,self.salidas[nombre],0,datos.ndim-1]+list(datos.shape[1:]),
+						dtype=np.int32).tostring())
+					self.archivos[nombre] = [f,0]
+				f,Nreg = self.archivos[nombre]
+				f.seek(0,2)
+				f.write(datos.tostring())
+				Nreg += datos.shape[0]
+				f.seek(12)
+				f.write(np.array([Nreg],dtype=np.int32).tostring())
+				f.flush()
+				self.archivos[nombre][1] = Nreg
+			except Exception as e:
+				self.error = e
+			self.cola.task_done()
+	
+	def __CheckError__(self):
+		#Levanta en el hilo principal los errores del escritor
+		if self.error is not None:
+			raise IOError('No se pudieron escribir las salidas en %s: %s' % (
+				self.rutas.values(),self.error))
+	
+	def __Add__(self,nombre,registros):
+		#Acumula registros de una salida y los pasa al hilo cuando se llena el bloque
+		registros = np.array(registros,dtype=np.float32)
+		self.datos[nombre].append(registros)
+		self.tamano[nombre] += registros.nbytes
+		if self.tamano[nombre] >= self.Nbytes:
+			self.__Send__(nombre)
+	
+	def __Send__(self,nombre):
+		#Entrega al hilo de escritura el bloque de una salida
+		if len(self.datos[nombre]) == 0:
+			return
+		self.cola.put((nombre,np.concatenate(self.datos[nombre])))
+		self.datos[nombre] = []
+		self.tamano[nombre] = 0
+	
+	def __StateCuts__(self,N_intervals):
+		#Intervalos (contados desde el inicio de la ejecucion) en que termina un
+		#bloque para poder guardar los estados
+		cortes = set()
+		for nombre,cada in self.salidas.iteritems():
+			if nombre in __ShiaEstados__:
+				cortes.update(range(cada - self.paso % cada,N_intervals+1,cada))
+		return cortes
+	
+	def write_block(self,Series,Nintervalos,Estados={}):
+		'Descripcion: Recibe los resultados de un bloque de intervalos, run_shia.\n'\
+		'	lo llama despues de cada bloque que simula.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'Series: Diccionario {salida : arreglo} con el tiempo en la ultima dimension.\n'\
+		'Nintervalos: Cantidad de intervalos del bloque.\n'\
+		'Estados: Diccionario {salida : arreglo} con los estados al final del bloque.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'No hay retorno, los registros se escriben en segundo plano.\n'\
+		#Revisa que el hilo de escritura siga bien
+		self.__CheckError__()
+		pasos = np.arange(self.paso+1,self.paso+Nintervalos+1)
+		for nombre,valores in Series.iteritems():
+			if nombre in self.salidas:
+				pos = np.nonzero(pasos % self.salidas[nombre] == 0)[0]
+				if pos.size > 0:
+					self.__Add__(nombre,np.rollaxis(np.asarray(valores)[...,pos],-1,0))
+		self.paso += Nintervalos
+		for nombre,valores in Estados.iteritems():
+			if (nombre in __ShiaEstados__ and nombre in self.salidas
+				and self.paso % self.salidas[nombre] == 0):
+				self.__Add__(nombre,np.asarray(valores)[np.newaxis])
+	
+	def flush(self):
+		'Descripcion: Pasa al hilo de escritura todo lo que hay en memoria.\n'\
+		#Entrega los bloques de todas las salidas
+		self.__CheckError__()
+		for nombre in self.salidas:
+			self.__Send__(nombre)
+	
+	def close(self):
+		'Descripcion: Escribe lo que queda en memoria y cierra los binarios.\n'\
+		#Termina el hilo de escritura
+		if self.hilo.is_alive():
+			self.flush()
+			self.cola.put(None)
+			self.hilo.join()
+			for f,Nreg in self.archivos.values():
+				f.close()
+		self.__CheckError__()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self,tipo,valor,traza):
+		#Aun con errores deja en disco lo que alcanzo a recibir
+		self.close()
+		return False
+
+#Estados que guarda SnapshotStore y cuantos tanques tiene cada uno, el orden
+#da el codigo de la variable en el encabezado del binario
+__SnapshotVars__ = [('Storage',5),('Speed',4),('Fluxes',3)]
+#Fila del indice de bloques de un SnapshotStore
+__SnapshotRow__ = np.dtype([('registro',np.int32),('Nregistros',np.int32),
+	('bloque',np.int32),('bytes',np.int32),('offset',np.int64)])
+
+class SnapshotStore:
+	
+	def __init__(self,ruta,variables={'Storage':[1,2,3,4,5]},cada=1,celdas=None,
+		Nchunk=64,Ncells_chunk=4096,nivel=1):
+		'Descripcion: Guarda la historia de los estados del modelo (almacenamiento,.\n'\
+		'	velocidades, flujos separados) en bloques comprimidos, solo de los tanques.\n'\
+		'	y celdas elegidas y cada tantos intervalos. Se usa como sink de run_shia.\n'\
+		'	(solo o en una lista con un ShiaWriter) y se lee con.\n'\
+		'	SimuBasin.read_snapshot_step y SimuBasin.read_snapshot_series.\n'\
+		'	Cada bloque tiene Nchunk registros de Ncells_chunk celdas, asi un intervalo.\n'\
+		'	o la serie de una celda se leen sin descomprimir todo el binario.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'ruta: Ruta del binario, el indice de los bloques queda en ruta.idx.\n'\
+		'variables: Diccionario {variable : tanques} con los tanques (desde 1) de cada.\n'\
+		'	variable: Storage (1 a 5), Speed (1 a 4), Fluxes (1 a 3, flujos separados).\n'\
+		'cada: Cada cuantos intervalos se guarda el estado.\n'\
+		'celdas: Elementos de la cuenca que se guardan (indices desde 0 o vector.\n'\
+		'	booleano de tamano N), por defecto todos.\n'\
+		'Nchunk: Registros (intervalos guardados) por bloque.\n'\
+		'Ncells_chunk: Celdas por bloque.\n'\
+		'nivel: Nivel de compresion de zlib (1 a 9).\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'self : Almacen listo para run_shia(sink=...), se usa con with o se cierra.\n'\
+		'	con close.\n'\
+		#Variables y tanques a guardar, cada uno es una fila de los registros
+		tanques = dict(__SnapshotVars__)
+		codigos = [nombre for nombre,Ntanques in __SnapshotVars__]
+		self.filas = []
+		for nombre,lista in sorted(variables.iteritems()):
+			if nombre not in tanques:
+				raise ValueError('%s no es un estado que guarde SnapshotStore' % nombre)
+			for t in lista:
+				if t < 1 or t > tanques[nombre]:
+					raise ValueError('%s no tiene el tanque %d' % (nombre,t))
+				self.filas.append((codigos.index(nombre),int(t)))
+		if int(cada) < 1 or int(Nchunk) < 1 or int(Ncells_chunk) < 1:
+			raise ValueError('cada, Nchunk y Ncells_chunk deben ser 1 o mas')
+		self.ruta = ruta
+		self.cada = int(cada)
+		self.Nchunk = int(Nchunk)
+		self.Ncells = int(Ncells_chunk)
+		self.nivel = int(nivel)
+		#Las celdas se resuelven con el primer estado, cuando se conoce N
+		self.celdas = celdas
+		self.N = None
+		#Intervalos recibidos, registros en memoria y registros entregados al hilo
+		self.paso = 0
+		self.registros = []
+		self.Nreg = 0
+		#Escritor en segundo plano, zlib suelta el GIL mientras comprime
+		self.archivos = None
+		self.error = None
+		self.cola = Queue.Queue(maxsize = 2)
+		self.hilo = threading.Thread(target = self.__Writer__)
+		self.hilo.daemon = True
+		self.hilo.start()
+	
+	def __Writer__(self):
+		#Comprime cada bloque de celdas de los registros y lo agrega al binario, el
+		#indice se escribe despues de los datos, asi solo cuenta lo que esta en disco
+		while True:
+			bloque = self.cola.get()
+			if bloque is None:
+				self.cola.task_done()
+				break
+			registro,datos = bloque
+			try:
+				if self.archivos is None:
+					self.archivos = self.__Open__()
+				f,g = self.archivos
+				for b,i in enumerate(range(0,datos.shape[2],self.Ncells)):
+					comprimido = zlib.compress(__ShuffleBytes__(datos[:,:,i:i+self.Ncells]),
+						self.nivel)
+					f.seek(0,2)
+					fila = np.array([(registro,datos.shape[0],b,len(comprimido),f.tell())],
+						dtype=__SnapshotRow__)
+					f.write(comprimido)
+					f.flush()
+					g.write(fila.tostring())
+					g.flush()
+			except Exception as e:
+				self.error = e
+			self.cola.task_done()
+	
+	def __Open__(self):
+		#Crea el binario con su encabezado (WMFZ, version, cada, Nfilas, Nceldas,
+		#Nchunk, Ncells_chunk, N, codigo y tanque de cada fila, celdas) y el indice
+		f = open(self.ruta,'wb')
+		f.write('WMFZ')
+		f.write(np.array([1,self.cada,len(self.filas),self.celdas.size,self.Nchunk,
+			self.Ncells,self.N],dtype=np.int32).tostring())
+		f.write(np.array(self.filas,dtype=np.int32).tostring())
+		f.write(self.celdas.astype(np.int32).tostring())
+		g = open(self.ruta+'.idx','wb')
+		g.write('WMFZ')
+		return f,g
+	
+	def __CheckError__(self):
+		#Levanta en el hilo principal los errores del escritor
+		if self.error is not None:
+			raise IOError('No se pudo escribir %s: %s' % (self.ruta,self.error))
+	
+	def __Send__(self):
+		#Entrega al hilo de escritura los registros en memoria
+		if len(self.registros) == 0:
+			return
+		self.cola.put((self.Nreg,np.array(self.registros,dtype=np.float32)))
+		self.Nreg += len(self.registros)
+		self.registros = []
+	
+	def __StateCuts__(self,N_intervals):
+		#Intervalos (contados desde el inicio de la ejecucion) en que se guarda el estado
+		return set(range(self.cada - self.paso % self.cada,N_intervals+1,self.cada))
+	
+	def write_block(self,Series,Nintervalos,Estados={}):
+		'Descripcion: Recibe el estado al final de un bloque de intervalos, run_shia.\n'\
+		'	lo llama despues de cada bloque que simula.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'Series: Series del bloque (no se usan).\n'\
+		'Nintervalos: Cantidad de intervalos del bloque.\n'\
+		'Estados: Diccionario {variable : arreglo [tanques,N]} al final del bloque.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'No hay retorno, los bloques se comprimen y escriben en segundo plano.\n'\
+		#Revisa que el hilo de escritura siga bien
+		self.__CheckError__()
+		self.paso += Nintervalos
+		if self.paso % self.cada <> 0:
+			return
+		codigos = [nombre for nombre,Ntanques in __SnapshotVars__]
+		registro = []
+		for codigo,t in self.filas:
+			nombre = codigos[codigo]
+			if nombre not in Estados:
+				raise ValueError('La simulacion no entrega el estado %s' % nombre)
+			valores = np.asarray(Estados[nombre])
+			if valores.ndim <> 2:
+				raise ValueError('SnapshotStore solo guarda simulaciones de un miembro')
+			#Con el primer estado se conocen N y las celdas a guardar
+			if self.N is None:
+				self.N = valores.shape[1]
+				if self.celdas is None:
+					self.celdas = np.arange(self.N)
+				self.celdas = np.asarray(self.celdas)
+				if self.celdas.dtype == bool:
+					self.celdas = np.nonzero(self.celdas)[0]
+			registro.append(valores[t-1,self.celdas])
+		self.registros.append(registro)
+		if len(self.registros) == self.Nchunk:
+			self.__Send__()
+	
+	def flush(self):
+		'Descripcion: Pasa al hilo de escritura los registros en memoria, quedan.\n'\
+		'	en un bloque mas corto que Nchunk.\n'\
+		#Entrega lo que haya
+		self.__CheckError__()
+		self.__Send__()
+	
+	def close(self):
+		'Descripcion: Escribe lo que queda en memoria y cierra el binario.\n'\
+		#Termina el hilo de escritura
+		if self.hilo.is_alive():
+			self.flush()
+			self.cola.put(None)
+			self.hilo.join()
+			if self.archivos is not None:
+				for f in self.archivos:
+					f.close()
+		self.__CheckError__()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self,tipo,valor,traza):
+		#Aun con errores deja en disco lo que alcanzo a recibir
+		self.close()
+		return False
+
+#-----------------------------------------------------------------------
+#Paso de mapas externos a la topologia de la cuenca
+#-----------------------------------------------------------------------
+
+class MapRegridder:
+	
+	def __init__(self,structure,MapProp,area_weighted=False):
+		'Descripcion: Precalcula la posicion de cada celda de la cuenca en un.\n'\
+		'	mapa externo (radar, parametros), despues cada mapa con la misma.\n'\
+		'	geometria se pasa a la cuenca con un solo take.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'structure : Estructura de la cuenca (Basin.structure).\n'\
+		'MapProp : Propiedades del mapa: ncols, nrows, xll, yll, dx, nodata.\n'\
+		'	(todas hacen parte de la llave con la que se reutiliza).\n'\
+		'area_weighted : False (defecto): toma el pixel en el centro de la celda.\n'\
+		'	(igual que cu.basin_map2basin).\n'\
+		'	True: promedia los pixeles que tocan la celda pesados por el area.\n'\
+		'	compartida, sirve cuando el mapa tiene mejor resolucion que el DEM.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'self : Regridder, se aplica con Transform(Map).\n'\
+		#Geometria del mapa y de la cuenca (en real, como en cuencas)
+		self.llave = tuple(MapProp)
+		ncolsM,nrowsM = int(MapProp[0]),int(MapProp[1])
+		xllM,yllM,dxM = [np.float32(i) for i in MapProp[2:5]]
+		self.shape = (ncolsM,nrowsM)
+		self.nodata = cu.nodata
+		self.ncells = structure.shape[1]
+		self.area_weighted = area_weighted
+		celdas = structure.astype(np.float32)
+		Xpos = np.float32(cu.xll)+np.float32(cu.dx)*(celdas[1]-np.float32(0.5))
+		Ypos = np.float32(cu.yll)+np.float32(cu.dx)*((np.float32(cu.nrows)-celdas[2])+np.float32(0.5))
+		if area_weighted is False:
+			#Pixel que contiene el centro de cada celda
+			self.dentro = np.where((Xpos > xllM) & (Xpos < xllM+dxM*ncolsM)
+				& (Ypos > yllM) & (Ypos < yllM+nrowsM*dxM))[0]
+			col = np.ceil((Xpos[self.dentro]-xllM)/dxM).astype(int)
+			fil = nrowsM - np.ceil((Ypos[self.dentro]-yllM)/dxM).astype(int) + 1
+			self.cols = col-1; self.fils = fil-1
+		else:
+			#Pixeles que se cruzan con cada celda y el area compartida, sin
+			#contar las astillas que deja el redondeo (cuencas guarda xll en real)
+			from scipy import sparse
+			dx = float(cu.dx); xllM,yllM,dxM = [float(i) for i in MapProp[2:5]]
+			Xpos = float(cu.xll)+dx*(structure[1]-0.5)
+			Ypos = float(cu.yll)+dx*((cu.nrows-structure[2])+0.5)
+			k = int(np.ceil(dx/dxM))+1
+			tol = 0.01*min(dx,dxM)
+			c0 = np.floor((Xpos-dx/2.0-xllM)/dxM).astype(int)
+			r0 = np.floor((yllM+nrowsM*dxM-(Ypos+dx/2.0))/dxM).astype(int)
+			Celdas = []; Cols = []; Fils = []; Pesos = []
+			for a in range(k):
+				for b in range(k):
+					c = c0+a; r = r0+b
+					ox = np.minimum(Xpos+dx/2.0, xllM+(c+1)*dxM) - np.maximum(Xpos-dx/2.0, xllM+c*dxM)
+					top = yllM+(nrowsM-r)*dxM
+					oy = np.minimum(Ypos+dx/2.0, top) - np.maximum(Ypos-dx/2.0, top-dxM)
+					pos = np.where((ox > tol) & (oy > tol) & (c >= 0) & (c < ncolsM)
+						& (r >= 0) & (r < nrowsM))[0]
+					Celdas.append(pos); Cols.append(c[pos]); Fils.append(r[pos])
+					Pesos.append(ox[pos]*oy[pos])
+			Celdas = np.hstack(Celdas); Pesos = np.hstack(Pesos)
+			#Cada pixel se lee una sola vez aunque toque varias celdas
+			plano = np.hstack(Cols)*nrowsM + np.hstack(Fils)
+			plano,pixel = np.unique(plano,return_inverse=True)
+			self.cols = plano // nrowsM; self.fils = plano % nrowsM
+			self.pesos = sparse.csr_matrix((Pesos,(Celdas,pixel)),
+				shape=(self.ncells,plano.size))
+			self.dentro = np.unique(Celdas)
+	
+	def Transform(self,Map):
+		'Descripcion: Pasa un mapa con la geometria del regridder a la cuenca.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'Map : Matriz del mapa como la entrega read_map_raster (ncols,nrows).\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'vecMap : Vector con la informacion del mapa al interior de la cuenca,.\n'\
+		'	las celdas fuera del mapa quedan con nodata y las celdas con nodata.\n'\
+		'	dentro del mapa con la media del mapa.\n'\
+		#Lee solo los pixeles que usa la cuenca
+		if Map.shape <> self.shape:
+			raise ValueError('El mapa no tiene la geometria del regridder')
+		valores = Map[self.cols,self.fils].astype(np.float32)
+		vec = np.zeros(self.ncells,dtype=np.float32) + np.float32(self.nodata)
+		if self.area_weighted is False:
+			vec[self.dentro] = valores
+			faltan = self.dentro[valores == self.nodata]
+		else:
+			validos = (valores <> self.nodata).astype(float)
+			peso = self.pesos.dot(validos)
+			suma = self.pesos.dot(np.where(validos > 0, valores, 0.0))
+			vec[self.dentro] = suma[self.dentro]/np.maximum(peso[self.dentro],1e-12)
+			faltan = self.dentro[peso[self.dentro] == 0]
+		#La media del mapa solo se calcula si hay huecos que llenar
+		if faltan.size > 0:
+			vec[faltan] = Map[Map <> self.nodata].mean(dtype=np.float64)
+		return vec
+
 #-----------------------------------------------------------------------
 #Clase de cuencas
 #-----------------------------------------------------------------------
@@ -982,9 +2403,11 @@ class Basin:
 	#------------------------------------------------------
 	# Trabajo con mapas externos y variables fisicas
 	#------------------------------------------------------
-	def Transform_Map2Basin(self,Map,MapProp):
+	def Transform_Map2Basin(self,Map,MapProp,area_weighted=False):
 		'Descripcion: A partir de un mapa leido obtiene un vector \n'\
 		'	con la forma de la cuenca, el cual luego puede ser agregado a esta. \n'\
+		'	La posicion de las celdas en el mapa se guarda, los siguientes mapas. \n'\
+		'	con la misma geometria (p.ej. radar) solo hacen un take. \n'\
 		'\n'\
 		'Parametros\n'\
 		'----------\n'\
@@ -996,18 +2419,20 @@ class Basin:
 		'	3. Xll Mapa.\n'\
 		'	4. Yll Mapa.\n'\
 		'	5. dx Mapa.\n'\
+		'	6. nodata Mapa (hace parte de la llave del regridder).\n'\
+		'area_weighted : Promedia los pixeles que tocan cada celda pesados por.\n'\
+		'	el area (ver MapRegridder), por defecto toma el pixel del centro.\n'\
 		'\n'\
 		'Retornos\n'\
 		'----------\n'\
 		'vecMap : Vector conla informacion del mapa al interio de la cuenca.\n'\
-		#Comienza le codifgo 
-		vec = cu.basin_map2basin(self.structure,
-			Map,MapProp[2],MapProp[3],MapProp[4],
-			cu.nodata,
-			'fill_mean',
-			self.ncells,
-			MapProp[0],MapProp[1])
-		return vec
+		#Reutiliza el regridder si el mapa tiene la misma geometria
+		regrid = self.__dict__.get('regridder')
+		if regrid is None or regrid.llave <> tuple(MapProp) \
+			or regrid.area_weighted <> area_weighted:
+			regrid = MapRegridder(self.structure,MapProp,area_weighted)
+			self.regridder = regrid
+		return regrid.Transform(Map)
 	def Transform_Hills2Basin(self,HillsMap):
 		'Descripcion: A partir de un vector con propiedades de las laderas\n'\
 		'	obtiene un vector con las propiedades por celda, ojo estas \n'\
@@ -1595,6 +3020,16 @@ class Basin:
 			pl.close('all')
 		else:
 			pl.show()
+
+#Las variables globales de models solo las usa una cuenca a la vez (SimuBasin.run_shia)
+__ModelsLock__ = threading.RLock()
+#Variables de models que forman el estado de sedimentos y de deslizamientos (checkpoints)
+__EstadoSedimentos__ = ['vs','vd','vsc','vdc','volero','voldepo','erot','dept']
+__EstadoDeslizamientos__ = ['slideocurrence','unit_type']
+#Cuenca cuyas variables estan publicadas en models (models.v_coef, models.storage...)
+#y version de cada variable publicada, asi solo se copian las que cambiaron
+__ModelsDueno__ = {'cuenca' : None,'versiones' : {}}
+
 class SimuBasin(Basin):
 	
 	def __init__(self,lat,lon,DEM,DIR,name='NaN',stream=None,umbral=500,
@@ -1643,7 +3078,15 @@ class SimuBasin(Basin):
 		self.radarDates = []
 		self.radarPos = []
 		self.radarMeanRain = []
+		self.radarScale = []
+		self.radarHashes = {}
 		self.radarCont = 1
+		#Variables del modelo de esta cuenca (ver run_shia), tienen los nombres
+		#de las variables de models, publish_models las deja tambien en el modulo
+		#y pull_models toma lo que se cambie alli a mano
+		self.modelVars = {'speed_type':np.ones(3,dtype=int),'retorno':0,'verbose':0,
+			'sim_sediments':0,'sim_slides':0,'save_storage':0,'save_speed':0,
+			'separate_fluxes':0,'recession_tol':0.0,'speed_solver':1,'speed_tol':1e-4}
 		#Si no hay ruta traza la cuenca
 		if rute is None:
 			#Si se entrega cauce corrige coordenadas
@@ -1672,45 +3115,49 @@ class SimuBasin(Basin):
 			self.hills_own,sub_basin = cu.basin_subbasin_find(self.structure,
 				nodos,self.nhills,self.ncells)
 			self.hills = cu.basin_subbasin_cut(self.nhills)
-			models.drena=self.structure		
 			#Determina la cantidad de celdas para alojar
 			if modelType=='cells':
 				N=self.ncells
 			elif modelType=='hills':
 				N=self.nhills
 			#aloja variables
-			models.v_coef = np.ones((4,N))
-			models.h_coef = np.ones((4,N))
-			models.v_exp = np.ones((4,N))
-			models.h_exp = np.ones((4,N))
-			models.max_capilar = np.ones((1,N))
-			models.max_gravita = np.ones((1,N))
-			models.storage = np.zeros((5,N))
-			models.dt = dt
-			models.retorno = 0
-			models.verbose = 0
+			V = self.modelVars
+			V['drena'] = self.structure
+			V['v_coef'] = np.ones((4,N))
+			V['h_coef'] = np.ones((4,N))
+			V['v_exp'] = np.ones((4,N))
+			V['h_exp'] = np.ones((4,N))
+			V['max_capilar'] = np.ones((1,N))
+			V['max_gravita'] = np.ones((1,N))
+			V['storage'] = np.zeros((5,N))
+			V['dt'] = dt
+			V['retorno'] = 0
+			V['verbose'] = 0
 			#Define los puntos de control		
-			models.control = np.zeros((1,N))
-			models.control_h = np.zeros((1,N))
+			V['control'] = np.zeros((1,N))
+			V['control_h'] = np.zeros((1,N))
 			#Define las simulaciones que se van a hacer 
-			models.sim_sediments=0
+			V['sim_sediments']=0
 			if SimSed is 'si':
-				models.sim_sediments=1
-			models.sim_slides=0
+				V['sim_sediments']=1
+			V['sim_slides']=0
 			if SimSlides is 'si':
-				models.sim_slides=1
-			models.save_storage=0
+				V['sim_slides']=1
+			V['save_storage']=0
 			if SaveStorage is 'si':
-				models.save_storage=1
-			models.save_speed=0
+				V['save_storage']=1
+			V['save_speed']=0
 			if SaveSpeed is 'si':
-				models.save_speed=1
-			models.separate_fluxes = 0
+				V['save_speed']=1
+			V['separate_fluxes'] = 0
 			if SeparateFluxes is 'si':
-				models.separate_fluxes = 1
+				V['separate_fluxes'] = 1
 		# si hay tura lee todo lo de la cuenca
 		elif rute is not None:
 			self.__Load_SimuBasin(rute)
+		#Version de cada variable de modelVars, los set_* la aumentan y models
+		#solo recibe las variables con publish_models o al simular con shia_v1
+		self.modelVersions = {}
 	
 	def __Load_SimuBasin(self,ruta):
 		'Descripcion: Lee una cuenca posteriormente guardada\n'\
@@ -1732,8 +3179,9 @@ class SimuBasin(Basin):
 		self.umbral = gr.umbral
 		self.ncells = gr.ncells
 		self.nhills = gr.nhills
-		models.dt = gr.dt
-		models.retorno = gr.retorno
+		V = self.modelVars
+		V['dt'] = gr.dt
+		V['retorno'] = gr.retorno
 		#Asigna dem y DIr a partir de la ruta 
 		try:
 			DEM = read_map_raster(gr.DEM,True,gr.dxp)
@@ -1756,37 +3204,37 @@ class SimuBasin(Basin):
 		self.hills = gr.variables['hills'][:]
 		self.hills_own = gr.variables['hills_own'][:]
 		#obtiene las propieades del modelo 
-		models.h_coef = np.ones((4,N)) * gr.variables['h_coef'][:]
-		models.v_coef = np.ones((4,N)) * gr.variables['v_coef'][:]
-		models.h_exp = np.ones((4,N)) * gr.variables['h_exp'][:]
-		models.v_exp = np.ones((4,N)) * gr.variables['v_exp'][:]
-		models.max_capilar = np.ones((1,N)) * gr.variables['h1_max'][:]
-		models.max_gravita = np.ones((1,N)) * gr.variables['h3_max'][:]
+		V['h_coef'] = np.ones((4,N)) * gr.variables['h_coef'][:]
+		V['v_coef'] = np.ones((4,N)) * gr.variables['v_coef'][:]
+		V['h_exp'] = np.ones((4,N)) * gr.variables['h_exp'][:]
+		V['v_exp'] = np.ones((4,N)) * gr.variables['v_exp'][:]
+		V['max_capilar'] = np.ones((1,N)) * gr.variables['h1_max'][:]
+		V['max_gravita'] = np.ones((1,N)) * gr.variables['h3_max'][:]
 		
 		if self.modelType[0] is 'c':			
-			models.drena = np.ones((3,N)) *gr.variables['drena'][:]
+			V['drena'] = np.ones((3,N)) *gr.variables['drena'][:]
 		elif self.modelType[0] is 'h':
-			models.drena = np.ones((1,N)) * gr.variables['drena'][:]			
-		models.unit_type = np.ones((1,N)) * gr.variables['unit_type'][:]
-		models.hill_long = np.ones((1,N)) * gr.variables['hill_long'][:]
-		models.hill_slope = np.ones((1,N)) * gr.variables['hill_slope'][:]
-		models.stream_long = np.ones((1,N)) * gr.variables['stream_long'][:]
-		models.stream_slope = np.ones((1,N)) * gr.variables['stream_slope'][:]
-		models.stream_width = np.ones((1,N)) * gr.variables['stream_width'][:]
-		models.elem_area = np.ones((1,N)) * gr.variables['elem_area'][:]
-		models.speed_type = np.ones((3)) * gr.variables['speed_type'][:]
-		models.storage = np.ones((5,N)) * gr.variables['storage'][:]
+			V['drena'] = np.ones((1,N)) * gr.variables['drena'][:]			
+		V['unit_type'] = np.ones((1,N)) * gr.variables['unit_type'][:]
+		V['hill_long'] = np.ones((1,N)) * gr.variables['hill_long'][:]
+		V['hill_slope'] = np.ones((1,N)) * gr.variables['hill_slope'][:]
+		V['stream_long'] = np.ones((1,N)) * gr.variables['stream_long'][:]
+		V['stream_slope'] = np.ones((1,N)) * gr.variables['stream_slope'][:]
+		V['stream_width'] = np.ones((1,N)) * gr.variables['stream_width'][:]
+		V['elem_area'] = np.ones((1,N)) * gr.variables['elem_area'][:]
+		V['speed_type'] = np.ones((3)) * gr.variables['speed_type'][:]
+		V['storage'] = np.ones((5,N)) * gr.variables['storage'][:]
 		
 		#propiedades de puntos de control
-		models.control = np.ones((1,N)) * gr.variables['control'][:]
-		models.control_h = np.ones((1,N)) * gr.variables['control_h'][:]
+		V['control'] = np.ones((1,N)) * gr.variables['control'][:]
+		V['control_h'] = np.ones((1,N)) * gr.variables['control_h'][:]
 		#Cierra el archivo 
 		gr.close()
 		
 	#------------------------------------------------------
 	# Subrutinas de lluvia, interpolacion, lectura, escritura
 	#------------------------------------------------------	
-	def rain_interpolate_mit(self,coord,registers,ruta):
+	def rain_interpolate_mit(self,coord,registers,ruta,dedupe=False,Nproc=1):
 		'Descripcion: Interpola la lluvia mediante una malla\n'\
 		'	irregular de triangulos, genera campos que son. \n'\
 		'	guardados en un binario para luego ser leido por el. \n'\
@@ -1799,6 +3247,11 @@ class SimuBasin(Basin):
 		'registers : Array (Nest,Nregisters) con los registros de lluvia.\n'\
 		'ruta : Ruta con nombre en donde se guardara el binario con.\n'\
 		'	la informacion de lluvia.\n'\
+		'dedupe : Si es True los intervalos con los mismos registros en todas.\n'\
+		'	las estaciones se guardan una sola vez, el .hdr indica el record.\n'\
+		'	de cada fecha (defecto False).\n'\
+		'Nproc : Hilos que interpolan bloques de intervalos al tiempo, cada uno.\n'\
+		'	escribe sus records en su lugar del binario (defecto 1).\n'\
 		'\n'\
 		'Retornos\n'\
 		'----------\n'\
@@ -1830,31 +3283,52 @@ class SimuBasin(Basin):
 		#Obtiene las coordenadas de cada celda de la cuenca
 		x,y = cu.basin_coordxy(self.structure,self.ncells)
 		xy_basin=np.vstack((x,y))	
-		#Obtiene la malla irregular 
+		#Obtiene la malla irregular y los pesos baricentricos de cada celda
 		TIN_mesh=Delaunay(coord.T)
-		TIN_mesh=TIN_mesh.vertices.T+1
-		#Obtiene las pertenencias en la cuenca a la malla 
-		TIN_perte = models.rain_pre_mit(xy_basin,TIN_mesh,coord,self.ncells,
-			TIN_mesh.shape[1],coord.shape[1]) 	 			
-		#Genera las interpolaciones para el rango de datos 		
-		meanRain = models.rain_mit(xy_basin,coord,reg,TIN_mesh,
-			TIN_perte,ruta,self.ncells,coord.shape[1],
-			TIN_mesh.shape[1],reg.shape[1])
+		B = __BarycentricOperator__(TIN_mesh,xy_basin)
+		#Registros iguales dan campos iguales, se interpolan una sola vez
+		Nreg = reg.shape[1]
+		Records = np.arange(Nreg)
+		if dedupe:
+			reg,Records = __UniqueColumns__(reg)
+		#Interpola todos los intervalos de un bloque con un producto disperso por denso,
+		#los bloques son de maximo 128 MB y cada intervalo es un record del binario.
+		#Los records tienen tamano fijo, asi cada bloque escribe en su lugar
+		reg = np.maximum(np.asarray(reg,dtype=float),0.0)
+		Nbloque = max(1,min(2**25/self.ncells,-(-reg.shape[1]/Nproc)))
+		meanRain = np.zeros(reg.shape[1],dtype=np.float32)
+		f = open(ruta,'wb')
+		f.truncate(4*self.ncells*reg.shape[1])
+		f.close()
+		bloques = [(B,reg,i,i+Nbloque,ruta,meanRain) for i in range(0,reg.shape[1],Nbloque)]
+		if Nproc > 1:
+			pool = ThreadPool(Nproc)
+			try:
+				pool.map(lambda b: __MitBlock__(*b),bloques)
+			finally:
+				pool.terminate()
+				pool.join()
+		else:
+			for b in bloques:
+				__MitBlock__(*b)
+		meanRain = meanRain[Records]
 		#Guarda un archivo con informacion de la lluvia 
 		f=open(ruta[:-3]+'hdr','w')
 		f.write('Numero de celdas: %d \n' % self.ncells)
 		f.write('Numero de laderas: %d \n' % self.nhills)
-		f.write('Numero de registros: %d \n' % reg.shape[1])
+		f.write('Numero de registros: %d \n' % Nreg)
 		f.write('Tipo de interpolacion: TIN\n')
 		f.write('Record, Fecha \n')
 		if isPandas:
 			dates=registers.index.to_pydatetime()
-			for c,d in enumerate(dates):
+			for c,d in zip(Records,dates):
 				f.write('%d, %s \n' % (c,d.strftime('%Y-%m-%d-%H:%M')))
 		f.close()
 		return meanRain
 			
-	def rain_interpolate_idw(self,coord,registers,ruta,p=1,umbral=0.0):
+	def rain_interpolate_idw(self,coord,registers,ruta,p=1,umbral=0.0,
+		formato = 'dense', dedupe = False, k = None, radius = None, cache = 16,
+		Nproc = 1):
 		'Descripcion: Interpola la lluvia mediante la metodologia\n'\
 		'	del inverso de la distancia ponderado. \n'\
 		'\n'\
@@ -1870,6 +3344,23 @@ class SimuBasin(Basin):
 		'	que un intervalo tiene suficiente agua como para generar reaccion\n'\
 		'	(umbral = 0.0) a medida que incremente se generaran archivos mas\n'\
 		'	livianos, igualmente existe la posibilidad de borrar informacion.\n'\
+		'formato : Formato del binario: dense (defecto), sparse (solo las celdas.\n'\
+		'	con lluvia) o uint16 (2 bytes por celda, escala en el .idx).\n'\
+		'dedupe : Si es True los intervalos con los mismos registros en todas.\n'\
+		'	las estaciones se interpolan y guardan una sola vez (defecto False).\n'\
+		'k : Si se da cada celda usa solo sus k estaciones mas cercanas.\n'\
+		'radius : Si se da cada celda usa solo las estaciones a menos de radius.\n'\
+		'	(unidades de las coordenadas), con k tambien son maximo k. Las celdas.\n'\
+		'	sin estaciones con dato quedan sin lluvia.\n'\
+		'	Con k o radius las estaciones se buscan una vez con un arbol (cKDTree) y.\n'\
+		'	los pesos se guardan dispersos, no se arma la matriz [Nest,Nceldas].\n'\
+		'cache : Cantidad de patrones de estaciones con dato (registros >= 0) cuya.\n'\
+		'	normalizacion de pesos se guarda, cuando se llena se descarta la de uso.\n'\
+		'	mas antiguo. Cada celda ocupa 4 bytes por patron.\n'\
+		'Nproc : Procesos que interpolan al tiempo, cada uno un pedazo de los.\n'\
+		'	intervalos en su propio binario, al final se unen en orden en ruta y el.\n'\
+		'	resultado es igual al de un proceso (defecto 1). Sin k ni radius cada.\n'\
+		'	proceso tiene su matriz de pesos [Nest,Nceldas].\n'\
 		'\n'\
 		'Retornos\n'\
 		'----------\n'\
@@ -1891,18 +3382,61 @@ class SimuBasin(Basin):
 		#Obtiene las coordenadas de cada celda de la cuenca
 		x,y = cu.basin_coordxy(self.structure,self.ncells)
 		xy_basin=np.vstack((x,y))	
+		#Registros iguales dan campos iguales, se interpolan una sola vez
+		Nreg = reg.shape[1]
+		if dedupe:
+			reg,Repetidos = __UniqueColumns__(reg)
 		#Interpola con idw 		
-		if self.modelType[0] is 'h':	
-			meanRain,posIds = models.rain_idw(xy_basin, coord, reg, p, self.nhills,
-				ruta, umbral, self.hills_own, self.ncells, coord.shape[1],reg.shape[1])
+		codigo = __RainFormat__(formato)
+		if self.modelType[0] is 'h':
+			mascara = self.hills_own
 		elif self.modelType[0] is 'c':
-			meanRain,posIds = models.rain_idw(xy_basin, coord, reg, p, self.nhills,
-				ruta, umbral, np.ones(self.ncells), self.ncells, coord.shape[1],reg.shape[1])
+			mascara = np.ones(self.ncells)
+		#Solo las estaciones vecinas de cada celda, con pesos dispersos
+		vecinos = inicio = None
+		if k is not None or radius is not None:
+			vecinos,inicio = __IdwNeighbors__(xy_basin,coord,k,radius)
+		if Nproc > 1 and reg.shape[1] > 1:
+			#Pedazos de intervalos en paralelo, cada uno en su binario
+			Datos = {'xy' : xy_basin,'coord' : coord,'reg' : reg,'p' : p,
+				'nhills' : self.nhills,'umbral' : umbral,'mascara' : mascara,
+				'codigo' : codigo,'vecinos' : vecinos,'inicio' : inicio,'cache' : cache}
+			cortes = np.unique(np.linspace(0,reg.shape[1],min(4*Nproc,reg.shape[1])+1).astype(int))
+			partes = [ruta[:-4]+'_parte%d.bin' % c for c in range(cortes.size-1)]
+			pool = multiprocessing.Pool(Nproc,__IdwPoolInit__,(Datos,))
+			#Si un pedazo falla se termina el pool (ningun proceso sigue escribiendo) y
+			#se borran los binarios de los pedazos
+			try:
+				try:
+					Resultados = pool.map(__IdwChunk__,zip(cortes[:-1],cortes[1:],partes),
+						chunksize = 1)
+				finally:
+					pool.terminate()
+					pool.join()
+				N = self.ncells if self.modelType[0] is 'c' else self.nhills
+				meanRain,posIds,escalas = __JoinRainParts__(ruta,partes,Resultados,codigo,N)
+			except:
+				for parte in partes:
+					if os.path.exists(parte):
+						os.remove(parte)
+				raise
+		else:
+			if vecinos is None:
+				meanRain,posIds,escalas = models.rain_idw(xy_basin, coord, reg, p, self.nhills,
+					ruta, umbral, mascara, codigo, self.ncells, coord.shape[1],reg.shape[1],
+					cache = cache)
+			else:
+				meanRain,posIds,escalas = models.rain_idw_sparse(xy_basin, coord, reg, p,
+					vecinos, inicio, self.nhills, ruta, umbral, mascara, codigo, cache = cache)
+		if dedupe:
+			meanRain = meanRain[Repetidos]
+			posIds = posIds[Repetidos]
+			escalas = escalas[Repetidos]
 		#Guarda un archivo con informacion de la lluvia 
 		f=open(ruta[:-3]+'hdr','w')
 		f.write('Numero de celdas: %d \n' % self.ncells)
 		f.write('Numero de laderas: %d \n' % self.nhills)
-		f.write('Numero de registros: %d \n' % reg.shape[1])
+		f.write('Numero de registros: %d \n' % Nreg)
 		f.write('Numero de campos no cero: %d \n' % posIds.max())
 		f.write('Tipo de interpolacion: IDW, p= %.2f \n' % p)
 		f.write('IDfecha, Record, Lluvia, Fecha \n')
@@ -1913,11 +3447,110 @@ class SimuBasin(Basin):
 				f.write('%d, \t %d, \t %.2f, %s \n' % (c,pos,m,d.strftime('%Y-%m-%d-%H:%M')))
 				c+=1
 		f.close()
+		#Guarda el indice binario de la lluvia 
+		if self.modelType[0] is 'c':
+			N = self.ncells
+		elif self.modelType[0] is 'h':
+			N = self.nhills
+		if isPandas:
+			write_rain_index(ruta[:-3]+'idx',posIds,meanRain,dates,N,escalas)
+		else:
+			write_rain_index(ruta[:-3]+'idx',posIds,meanRain,Nelem=N,scales=escalas)
+		return meanRain,posIds
+	
+	def rain_interpolate_kriging(self,coord,registers,ruta,variograma='exponential',
+		rango=None,meseta=1.0,pepita=0.0,k=8,umbral=0.0,formato='dense',
+		dedupe=False,cache=16):
+		'Descripcion: Interpola la lluvia mediante kriging ordinario con las.\n'\
+		'	k estaciones con dato mas cercanas a cada celda. Los pesos se calculan.\n'\
+		'	una vez por patron de estaciones con dato (registros >= 0), las celdas.\n'\
+		'	con las mismas estaciones comparten la inversa del sistema y los pesos.\n'\
+		'	se aplican como una matriz dispersa [Nceldas,Nest] a todos los.\n'\
+		'	intervalos con ese patron.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'self : .\n'\
+		'coord : Array (2,Ncoord) con las coordenadas de estaciones.\n'\
+		'registers : Array (Nest,Nregisters) o DataFrame con los registros de lluvia.\n'\
+		'ruta : Ruta con nombre en donde se guardara el binario con.\n'\
+		'	la informacion de lluvia.\n'\
+		'variograma : Modelo del variograma: exponential (defecto), spherical o gaussian.\n'\
+		'rango : Rango practico del variograma (unidades de las coordenadas), por.\n'\
+		'	defecto la mitad de la maxima distancia entre estaciones.\n'\
+		'meseta : Meseta del variograma sin la pepita (defecto 1.0).\n'\
+		'pepita : Efecto pepita (defecto 0.0), los pesos solo dependen de pepita/meseta.\n'\
+		'k : Cantidad de estaciones con dato mas cercanas que usa cada celda (defecto 8).\n'\
+		'umbral : Umbral de suma total de lluvia bajo el cual el intervalo usa el.\n'\
+		'	record 1, como en rain_interpolate_idw la media que se anota es la suma.\n'\
+		'	sobre la cantidad de celdas con lluvia.\n'\
+		'formato : Formato del binario: dense (defecto), sparse (solo las celdas.\n'\
+		'	con lluvia) o uint16 (2 bytes por celda, escala en el .idx).\n'\
+		'dedupe : Si es True los campos identicos comparten record (defecto False).\n'\
+		'cache : Cantidad de patrones de estaciones con dato cuyos pesos se guardan,.\n'\
+		'	cuando se llena se descarta el de uso mas antiguo.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'meanRain :  La serie de lluvia promedio interpolada para la cuenca.\n'\
+		'posIds : Record del binario de cada intervalo.\n'\
+		'\n'\
+		'Mirar Tambien\n'\
+		'----------\n'\
+		'rain_interpolate_idw: interpola campos mediante la metodologia idw.\n'\
+		'rain_interpolate_mit: interpola campos mediante triangulos (TIN).\n'\
+		#Mira si los registros son un data frame de pandas
+		fechas = None
+		if type(registers)==pd.core.frame.DataFrame:
+			reg = registers.values.T
+			fechas = registers.index.to_pydatetime()
+		else:
+			reg = registers
+		reg = np.asarray(reg,dtype=float)
+		coord = np.asarray(coord,dtype=float)
+		#Obtiene las coordenadas de cada celda de la cuenca
+		x,y = cu.basin_coordxy(self.structure,self.ncells)
+		xy_basin=np.vstack((x,y))
+		#Variograma
+		if rango is None:
+			rango = 0.5*np.sqrt(((coord[:,:,None]-coord[:,None,:])**2).sum(0)).max()
+		Covarianza = lambda h: __Covariance__(h,variograma,rango,meseta,pepita)
+		#Pesos por patron de estaciones con dato, en orden de uso
+		operadores = collections.OrderedDict()
+		disponibles = reg >= 0
+		posIds = np.zeros(reg.shape[1],dtype=int)
+		escritor = RainWriter(self,ruta,umbral,formato,dedupe=dedupe,
+			tipo='Kriging ordinario, variograma %s, rango= %.2f' % (variograma,rango),
+			criterio='idw')
+		#Interpola por bloques de maximo 128 MB y escribe los campos en orden
+		Nbloque = max(1,2**24/self.ncells)
+		for i in range(0,reg.shape[1],Nbloque):
+			bloque = np.maximum(reg[:,i:i+Nbloque],0.0)
+			campos = np.empty((self.ncells,bloque.shape[1]))
+			patrones,cual = __UniqueColumns__(disponibles[:,i:i+Nbloque])
+			for j in range(patrones.shape[1]):
+				llave = patrones[:,j].tostring()
+				if llave in operadores:
+					W = operadores.pop(llave)
+				else:
+					W = __KrigingOperator__(xy_basin,coord,patrones[:,j],k,Covarianza)
+				operadores[llave] = W
+				if len(operadores) > max(cache,1):
+					operadores.popitem(last = False)
+				campos[:,cual == j] = W.dot(bloque[:,cual == j])
+			#Los pesos negativos pueden dar lluvia negativa
+			campos = np.maximum(campos,0.0)
+			for j in range(bloque.shape[1]):
+				fecha = None
+				if fechas is not None:
+					fecha = fechas[i+j]
+				posIds[i+j] = escritor.write(campos[:,j],fecha)
+		meanRain = escritor.close().values
 		return meanRain,posIds
 	
 	def rain_radar2basin_from_asc(self,ruta_in,ruta_out,fechaI,fechaF,dt,
 		pre_string,post_string,fmt = '%Y%m%d%H%M',conv_factor=1.0/12.0,
-		umbral = 0.0):
+		umbral = 0.0, formato = 'dense', Nproc = 1, dedupe = False, window = False):
 		'Descripcion: Genera campos de lluvia a partir de archivos asc. \n'\
 		'\n'\
 		'Parametros\n'\
@@ -1928,6 +3561,15 @@ class SimuBasin(Basin):
 		'fechaI: Fecha de inicio de registros.\n'\
 		'fechaF: Fecha de finalizacion de registros.\n'\
 		'dt: Intervalo de tiempo entre registros.\n'\
+		'formato: Formato del binario: dense (defecto), sparse (solo las celdas.\n'\
+		'	con lluvia) o uint16 (2 bytes por celda, escala en el .idx).\n'\
+		'Nproc: Cantidad de procesos que leen y pasan los mapas a la cuenca,.\n'\
+		'	con Nproc > 1 los mapas se leen en paralelo y los campos se.\n'\
+		'	escriben en orden de fechas desde este proceso (defecto 1).\n'\
+		'dedupe: Si es True los campos repetidos se guardan una sola vez (defecto False).\n'\
+		'window: Si es True de cada mapa solo se lee la ventana que cubre la cuenca,.\n'\
+		'	las celdas con nodata se llenan con la media de la ventana y no con la.\n'\
+		'	del mapa completo (defecto False, lee el mapa completo).\n'\
 		'Retornos\n'\
 		'----------\n'\
 		'Guarda el binario, no hay retorno\n'\
@@ -1951,31 +3593,63 @@ class SimuBasin(Basin):
 		elif self.modelType[0] is 'h':
 			N = self.nhills
 		#Guarda la primera entrada como un mapa de ceros		
-		models.write_int_basin(ruta_bin,np.zeros((1,N)),1,N,1)
+		codigo = __RainFormat__(formato)
+		models.write_rain_record(ruta_bin,np.zeros(N),1,codigo,N)
 		#Genera la lista de las fechas.
 		ListDates,dates = __ListaRadarNames__(ruta_in,
 			fechaI,fechaF,
 			fmt,post_string,pre_string,dt)
-		#Lee los mapas y los transforma 
+		#Lee los mapas y los transforma, con varios procesos el pool los
+		#entrega en el orden de la lista
+		rutas = [ruta_in + l for l in ListDates]
+		ventana = self.structure if window else None
+		pool = None
+		if Nproc > 1 and len(rutas) > 0:
+			Map,p = read_map_raster(rutas[0],structure = ventana)
+			self.Transform_Map2Basin(Map,p)
+			pool = multiprocessing.Pool(Nproc,__RadarPoolInit__,
+				(self.structure,self.regridder,conv_factor,window))
+			Campos = pool.imap(__RadarMap2Basin__,rutas,chunksize = 4)
+		else:
+			Campos = (self.Transform_Map2Basin(*read_map_raster(r,structure = ventana))
+				* conv_factor for r in rutas)
 		cont = 1
 		meanRain = []
 		posIds = []
-		for l in ListDates:
-			Map,p = read_map_raster(ruta_in + l)
-			vec = self.Transform_Map2Basin(Map,p) * conv_factor
-			#Si el mapa tiene mas agua de un umbral 
-			if vec.sum() > umbral:
-				#Actualiza contador, lluvia media y pocisiones 
-				cont +=1
-				meanRain.append(vec.mean())
-				posIds.append(cont)
-				#Guarda el vector 
-				vec = vec*1000; vec = vec.astype(int)
-				models.write_int_basin(ruta_bin,np.zeros((1,N))+vec,cont,N,1)
-			else:
-				#lluvia media y pocisiones 
-				meanRain.append(0.0)
-				posIds.append(1)
+		escalas = []
+		Huellas = {}
+		#Si algo falla (un mapa danado, el disco) el pool se termina y no quedan
+		#procesos leyendo mapas
+		try:
+			for vec in Campos:
+				#Si el mapa tiene mas agua de un umbral 
+				if vec.sum() > umbral:
+					#Lluvia media y escala
+					meanRain.append(vec.mean())
+					vec,escala = __RainQuantize__(vec,codigo)
+					escalas.append(escala)
+					#Si el campo ya esta en el binario apunta a ese record
+					llave = None
+					if dedupe:
+						llave = __RainHash__(vec,escala)
+					if llave in Huellas:
+						posIds.append(Huellas[llave])
+						continue
+					#Actualiza contador y guarda el vector 
+					cont +=1
+					posIds.append(cont)
+					models.write_rain_record(ruta_bin,vec,cont,codigo,N)
+					if dedupe:
+						Huellas[llave] = cont
+				else:
+					#lluvia media y pocisiones 
+					meanRain.append(0.0)
+					posIds.append(1)
+					escalas.append(0.0)
+		finally:
+			if pool is not None:
+				pool.terminate()
+				pool.join()
 		posIds = np.array(posIds)
 		meanRain = np.array(meanRain)
 		#Guarda un archivo con informacion de la lluvia 
@@ -1991,9 +3665,11 @@ class SimuBasin(Basin):
 			f.write('%d, \t %d, \t %.2f, %s \n' % (c,pos,m,d.strftime('%Y-%m-%d-%H:%M')))
 			c+=1
 		f.close()
+		#Guarda el indice binario de la lluvia 
+		write_rain_index(ruta_hdr[:-3]+'idx',posIds,meanRain,dates,N,escalas)
 		return np.array(meanRain),np.array(posIds)
 	def rain_radar2basin_from_array(self,vec=None,ruta_out=None,fecha=None,dt=None,
-		status='update',umbral = 0.01):
+		status='update',umbral = 0.01, formato = 'dense', dedupe = False):
 		'Descripcion: Genera campos de lluvia a partir de archivos array\n'\
 		'\n'\
 		'Parametros\n'\
@@ -2008,6 +3684,10 @@ class SimuBasin(Basin):
 		'	old: Estado para abrir y tomar las propiedades de self.radar.. para la generacion de un binario.\n'\
 		'	close: Cierra un binario que se ha generado mediante update.\n'\
 		'	reset: Reinicia las condiciones de self.radar... para la creacion de un campo nuevo.\n'\
+		'formato: Formato del binario: dense (defecto), sparse o uint16, debe ser el mismo.\n'\
+		'	en todos los llamados que escriben en el mismo binario.\n'\
+		'dedupe: Si es True los campos identicos a uno ya escrito en esta sesion no se.\n'\
+		'	escriben de nuevo, el intervalo apunta al record existente (defecto False).\n'\
 		'Retornos\n'\
 		'----------\n'\
 		'Guarda el binario, no hay retorno\n'\
@@ -2017,6 +3697,7 @@ class SimuBasin(Basin):
 		'----------\n'\
 		'rain_interpolate_idw: interpola campos mediante la metodologia idw.\n'\
 		'rain_radar2basin_from_asc: Mete campos de lluvia mediante multiples arrays.\n'\
+		'rain_writer: escritor continuo por bloques para series largas.\n'\
 		#Edita la ruta de salida 
 		if ruta_out <> None:
 			if ruta_out.endswith('.hdr') or ruta_out.endswith('.bin'):
@@ -2039,23 +3720,38 @@ class SimuBasin(Basin):
 		# binario final 
 		actualizo = 1
 		if status == 'update':
-			#Entrada 1 es la entrada de campos sin lluvia 
+			#Entrada 1 es la entrada de campos sin lluvia, si el binario ya tiene
+			#campos (p.ej. despues de old) sigue en el formato en que fue escrito
+			codigo = __RainFormat__(formato)
 			if len(self.radarDates) == 0:
-				models.write_int_basin(ruta_bin,np.zeros((1,N)),1,N,1)
+				models.write_rain_record(ruta_bin,np.zeros(N),1,codigo,N)
+				self.radarHashes = {}
+			else:
+				codigo = __RainBinFormat__(ruta_bin,codigo)
 			if vec.mean() > umbral:
-				#Actualiza contador, lluvia media y pocisiones 
-				self.radarCont +=1
+				#Lluvia media y escala
 				self.radarMeanRain.append(vec.mean())
-				self.radarPos.append(self.radarCont)
-				#Guarda el vector 
-				vec = vec*1000; vec = vec.astype(int)
-				models.write_int_basin(ruta_bin,np.zeros((1,N))+vec,
-					self.radarCont,N,1)
+				valores,escala = __RainQuantize__(vec,codigo)
+				self.radarScale.append(escala)
+				#Si el campo ya esta en el binario apunta a ese record
+				llave = None
+				if dedupe:
+					llave = __RainHash__(valores,escala)
+				if llave in self.radarHashes:
+					self.radarPos.append(self.radarHashes[llave])
+				else:
+					#Actualiza contador y guarda el vector 
+					self.radarCont +=1
+					self.radarPos.append(self.radarCont)
+					models.write_rain_record(ruta_bin,valores,self.radarCont,codigo,N)
+					if dedupe:
+						self.radarHashes[llave] = self.radarCont
 				actualizo = 0
 			else:
 				#lluvia media y pocisiones 
 				self.radarMeanRain.append(0.0)
 				self.radarPos.append(1)
+				self.radarScale.append(0.0)
 			self.radarDates.append(fecha)
 		#Si ya no va a agregar nada, no agrega mas campos y genera el .hdr 
 		elif status == 'close':
@@ -2075,6 +3771,9 @@ class SimuBasin(Basin):
 				f.write('%d, \t %d, \t %.2f, %s \n' % (c,pos,m,d.strftime('%Y-%m-%d-%H:%M')))
 				c+=1
 			f.close()
+			#Guarda el indice binario de la lluvia 
+			write_rain_index(ruta_hdr[:-3]+'idx',self.radarPos,self.radarMeanRain,
+				self.radarDates,N,self.radarScale)
 			#Vuelve las variables listas de nuevo 
 			self.radarMeanRain = self.radarMeanRain.tolist()
 			self.radarPos = self.radarPos.tolist()
@@ -2083,21 +3782,62 @@ class SimuBasin(Basin):
 			self.radarDates = []
 			self.radarPos = []
 			self.radarMeanRain = []
+			self.radarScale = []
+			self.radarHashes = {}
 			self.radarCont = 1
+		elif status == 'old' and os.path.exists(ruta_hdr[:-3]+'idx'):
+			#si hay indice binario toma de ahi las variables para continuar en ese punto
+			Data = read_rain_index(ruta_hdr[:-3]+'idx')
+			self.radarPos = Data['Record'].tolist()
+			self.radarMeanRain = Data['Lluvia'].tolist()
+			self.radarScale = Data['Escala'].tolist()
+			self.radarDates = Data.index.to_pydatetime().tolist()
+			self.radarCont = max(self.radarPos)
+			self.radarHashes = {}
 		elif status == 'old':
 			#si es un archivo viejo, lo abre para tomar las variables y continuar en ese punto 
-			f=open(ruta_hdr[:-3]+'.hdr','r')
+			f=open(ruta_hdr,'r')
 			Lista = f.readlines()
 			self.radarCont = int(Lista[3].split()[-1])
+			self.radarHashes = {}
 			f.close()
 			#Abre con numpy para simplificar las cosas 
 			a = np.loadtxt(ruta_hdr,skiprows=6,dtype='str').T
 			self.radarPos = [int(i.split(',')[0]) for i in a[1]]
 			self.radarMeanRain = [float(i.split(',')[0]) for i in a[2]]
-			for i in a[3]:
-				d = datetime.datetime.strptime(i,'%Y-%m-%d-%H:%M')
-				self.radarDates.append(d)
+			self.radarDates = [datetime.datetime.strptime(i,'%Y-%m-%d-%H:%M') for i in a[3]]
+			#El .hdr no tiene la escala, sin .idx el binario es entero (mm*1000)
+			self.radarScale = [0.001 if p > 1 else 0.0 for p in self.radarPos]
 		return actualizo 
+	
+	def rain_writer(self,ruta_out,umbral = 0.01,formato = 'dense',Nbuffer = 32,
+		status = 'update', dedupe = False):
+		'Descripcion: Crea un escritor continuo de campos de lluvia, mantiene\n'\
+		'	el binario abierto y escribe por bloques en segundo plano, el indice.\n'\
+		'	(.idx) se actualiza con cada bloque.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'self : .\n'\
+		'ruta_out: Ruta donde escribe el binario con la lluvia.\n'\
+		'umbral: Lluvia media minima para guardar el campo.\n'\
+		'formato: Formato del binario: dense (defecto), sparse o uint16.\n'\
+		'Nbuffer: Cantidad de intervalos que se acumulan antes de escribir.\n'\
+		'status: update: (Defecto) crea un binario nuevo.\n'\
+		'	old: continua un binario existente, p.ej despues de una caida.\n'\
+		'dedupe: Si es True los campos repetidos comparten record (defecto False).\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'escritor : RainWriter, se usa como:\n'\
+		'	with cuenca.rain_writer(ruta) as w:\n'\
+		'		for fecha,campo in datos: w.write(campo,fecha)\n'\
+		'\n'\
+		'Mirar Tambien\n'\
+		'----------\n'\
+		'rain_radar2basin_from_array: escribe los campos uno a uno abriendo el binario.\n'\
+		#Crea el escritor
+		return RainWriter(self,ruta_out,umbral,formato,Nbuffer,status,dedupe)
 		
 	#------------------------------------------------------
 	# Subrutinas para preparar modelo 
@@ -2116,18 +3856,18 @@ class SimuBasin(Basin):
 		'Retornos\n'\
 		'----------\n'\
 		'self : Con las variables geomorfologicas de simulacion iniciadas.\n'\
-		'	models.drena : Numero de celda o ladera destino. \n'\
-		'	models.nceldas : Numero de celdas o laderas. \n'\
-		'	models.unit_type : tipo de celda, en el caso de ladera no aplica.\n'\
+		'	modelVars["drena"] : Numero de celda o ladera destino. \n'\
+		'	modelVars["nceldas"] : Numero de celdas o laderas. \n'\
+		'	modelVars["unit_type"] : tipo de celda, en el caso de ladera no aplica.\n'\
 		'		1: Celda tipo ladera.\n'\
 		'		2: Celda tipo carcava.\n'\
 		'		3: Celda tipo cauce.\n'\
-		'	models.hill_long : Longitud de la ladera (o celda). \n'\
-		'	models.hill_slope : Pendiente de cada ladera (o celda).\n'\
-		'	models.stream_long : Longitud de cada tramo de cuace. \n'\
-		'	models.stream_slope : Pendiente de cada tramo de cauce. \n'\
-		'	models.stream_width : Ancho de cada tramo de cauce. \n'\
-		'	models.elem_area : Area de cada celda o ladera. \n'\
+		'	modelVars["hill_long"] : Longitud de la ladera (o celda). \n'\
+		'	modelVars["hill_slope"] : Pendiente de cada ladera (o celda).\n'\
+		'	modelVars["stream_long"] : Longitud de cada tramo de cuace. \n'\
+		'	modelVars["stream_slope"] : Pendiente de cada tramo de cauce. \n'\
+		'	modelVars["stream_width"] : Ancho de cada tramo de cauce. \n'\
+		'	modelVars["elem_area"] : Area de cada celda o ladera. \n'\
 		#Obtiene lo basico para luego pasar argumentos
 		acum,hill_long,pend,elev = cu.basin_basics(self.structure,
 			self.DEM,self.DIR,cu.ncols,cu.nrows,self.ncells)
@@ -2156,28 +3896,30 @@ class SimuBasin(Basin):
 			stream_width=np.ones(self.ncells)
 		#De acuerdo a si el modelo es por laderas o por celdas agrega lass varaibeles 
 		if self.modelType[0]=='c':
-			models.drena = np.ones((1,self.ncells))*self.structure
-			models.nceldas = self.ncells
-			models.unit_type = np.ones((1,self.ncells))*unit_type
-			models.hill_long = np.ones((1,self.ncells))*hill_long
-			models.hill_slope = np.ones((1,self.ncells))*pend
-			models.stream_long = np.ones((1,self.ncells))*hill_long
-			models.stream_slope = np.ones((1,self.ncells))*pend
-			models.stream_width = np.ones((1,self.ncells))*stream_width
-			models.elem_area = np.ones((1,self.ncells))*cu.dxp**2.0
+			self.modelVars['drena'] = np.ones((1,self.ncells))*self.structure
+			self.modelVars['nceldas'] = self.ncells
+			self.modelVars['unit_type'] = np.ones((1,self.ncells))*unit_type
+			self.modelVars['hill_long'] = np.ones((1,self.ncells))*hill_long
+			self.modelVars['hill_slope'] = np.ones((1,self.ncells))*pend
+			self.modelVars['stream_long'] = np.ones((1,self.ncells))*hill_long
+			self.modelVars['stream_slope'] = np.ones((1,self.ncells))*pend
+			self.modelVars['stream_width'] = np.ones((1,self.ncells))*stream_width
+			self.modelVars['elem_area'] = np.ones((1,self.ncells))*cu.dxp**2.0
 		elif self.modelType[0]=='h':
 			N=self.hills.shape[1]
-			models.drena = np.ones((1,N))*self.hills[1]
-			models.nceldas = self.hills.shape[1]
-			models.unit_type = np.ones((1,N))*np.ones(N)*3
-			models.hill_long = np.ones((1,N))*sub_basin_long
-			models.hill_slope = np.ones((1,N))*self.Transform_Basin2Hills(pend) 				
-			models.stream_long = np.ones((1,N))*stream_long
-			models.stream_slope = np.ones((1,N))*stream_slope
-			models.stream_width = np.ones((1,N))*cu.basin_subbasin_map2subbasin(
+			self.modelVars['drena'] = np.ones((1,N))*self.hills[1]
+			self.modelVars['nceldas'] = self.hills.shape[1]
+			self.modelVars['unit_type'] = np.ones((1,N))*np.ones(N)*3
+			self.modelVars['hill_long'] = np.ones((1,N))*sub_basin_long
+			self.modelVars['hill_slope'] = np.ones((1,N))*self.Transform_Basin2Hills(pend) 				
+			self.modelVars['stream_long'] = np.ones((1,N))*stream_long
+			self.modelVars['stream_slope'] = np.ones((1,N))*stream_slope
+			self.modelVars['stream_width'] = np.ones((1,N))*cu.basin_subbasin_map2subbasin(
 				self.hills_own,stream_width,self.nhills,0,self.ncells,self.CellCauce)
-			models.elem_area = np.ones((1,N))*np.array([self.hills_own[self.hills_own==i].shape[0] for i in range(1,self.hills.shape[1]+1)])*cu.dxp**2.0			
-	def set_Speed_type(self,types=np.ones(3)):
+			self.modelVars['elem_area'] = np.ones((1,N))*np.array([self.hills_own[self.hills_own==i].shape[0] for i in range(1,self.hills.shape[1]+1)])*cu.dxp**2.0			
+		self.__TouchVars__(['drena','nceldas','unit_type','hill_long','hill_slope',
+			'stream_long','stream_slope','stream_width','elem_area'])
+	def set_Speed_type(self,types=np.ones(3),solver=1,tol=1e-4):
 		'Descripcion: Especifica el tipo de velocidad a usar en cada \n'\
 		'	nivel del modelo. \n'\
 		'\n'\
@@ -2187,17 +3929,52 @@ class SimuBasin(Basin):
 		'types : tipos de velocidad .\n'\
 		'	1. Velocidad tipo embalse lineal, no se especifica h_exp.\n'\
 		'	2. Velocidad onda cinematica, se debe especificar h_exp.\n'\
+		'solver : Solucion de la onda cinematica (tanques tipo 2 y cauce).\n'\
+		'	1. 4 iteraciones de punto fijo amortiguadas (defecto).\n'\
+		'	2. Newton desde la velocidad anterior hasta que el cambio relativo.\n'\
+		'		es menor a tol, por lo general 1 o 2 potencias por celda.\n'\
+		'tol : Tolerancia relativa de la velocidad para solver = 2.\n'\
 		'\n'\
 		'Retornos\n'\
 		'----------\n'\
-		'self : Con la variable models.speed_type especificada.\n'\
+		'self : Con la variable modelVars["speed_type"] especificada.\n'\
+		'	y modelVars["speed_solver"] y modelVars["speed_tol"].\n'\
 		#Especifica la ecuacion de velocidad a usar en cada nivel del modelo		
 		for c,i in enumerate(types):
 			if i==1 or i==2:
-				models.speed_type[c]=i
+				self.modelVars['speed_type'][c]=i
 			else:
-				models.speed_type[c]=1	
-	def set_PhysicVariables(self,modelVarName,var,pos,mask=None):
+				self.modelVars['speed_type'][c]=1	
+		#Solucion de la onda cinematica
+		if solver not in [1,2]:
+			raise ValueError('solver debe ser 1 (punto fijo) o 2 (Newton)')
+		self.modelVars['speed_solver'] = solver
+		self.modelVars['speed_tol'] = float(tol)
+		self.__TouchVars__(['speed_type','speed_solver','speed_tol'])
+	def set_Recession(self,tol=0.0):
+		'Descripcion: Activa la recesion rapida de los tanques no lineales (onda.\n'\
+		'	cinematica) y del cauce: en un intervalo sin lluvia sobre la celda, el.\n'\
+		'	tanque con menos de tol [mm] se vacia completo hacia aguas abajo en vez.\n'\
+		'	de resolver la onda cinematica. El volumen se conserva (el balance no.\n'\
+		'	cambia), el agua llega antes y el error en cada tanque es menor a tol.\n'\
+		'	Los tanques vacios siempre se resuelven sin calcular la velocidad, eso.\n'\
+		'	no cambia el resultado.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'self : Inicia las variables vacias.\n'\
+		'tol : Almacenamiento [mm] bajo el cual se vacia el tanque, 0 (defecto) es el.\n'\
+		'	modelo completo.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'self : Con la variable modelVars["recession_tol"] especificada.\n'\
+		#Tolerancia de la recesion rapida
+		if tol < 0:
+			raise ValueError('La tolerancia de la recesion no puede ser negativa')
+		self.modelVars['recession_tol'] = float(tol)
+		self.__TouchVars__(['recession_tol'])
+	def set_PhysicVariables(self,modelVarName,var,pos,mask=None,window=False):
 		'Descripcion: Coloca las variables fisicas en el modelo \n'\
 		'	Se debe assignarel nombre del tipo de variable, la variable\n'\
 		'	y la posicion en que esta va a ser insertada\n'\
@@ -2218,6 +3995,9 @@ class SimuBasin(Basin):
 		'	- Vector : Un vector con la informacion leida (1,ncells).\n'\
 		'pos : Posicion de insercion, aplica para : h_coef, v_coef,.\n'\
 		'	h_exp, v_exp.\n'\
+		'window : Si var es una ruta y window es True solo se lee la ventana del mapa.\n'\
+		'	que cubre la cuenca, el nodata se llena con la media de la ventana.\n'\
+		'	(defecto False, lee el mapa completo).\n'\
 		'\n'\
 		'Retornos\n'\
 		'----------\n'\
@@ -2233,7 +4013,7 @@ class SimuBasin(Basin):
 		isVec=False
 		if type(var) is str:
 			#Si es un string lee el mapa alojado en esa ruta 
-			Map,Pp = read_map_raster(var)
+			Map,Pp = read_map_raster(var,structure = self.structure if window else None)
 			Vec = self.Transform_Map2Basin(Map,Pp)
 			isVec=True
 		elif type(var) is int or float:
@@ -2247,17 +4027,18 @@ class SimuBasin(Basin):
 			Vec = self.Transform_Basin2Hills(Vec,mask=mask)
 		#finalmente mete la variable en el modelo
 		if modelVarName is 'h_coef':
-			models.h_coef[pos] = Vec
+			self.modelVars['h_coef'][pos] = Vec
 		elif modelVarName is 'h_exp':
-			models.h_exp[pos] = Vec
+			self.modelVars['h_exp'][pos] = Vec
 		elif modelVarName is 'v_coef':
-			models.v_coef[pos] = Vec
+			self.modelVars['v_coef'][pos] = Vec
 		elif modelVarName is 'v_exp':
-			models.v_exp[pos] = Vec
+			self.modelVars['v_exp'][pos] = Vec
 		elif modelVarName is 'capilar':
-			models.max_capilar[0] = Vec
+			self.modelVars['max_capilar'][0] = Vec
 		elif modelVarName is 'gravit':
-			models.max_gravita[0] = Vec
+			self.modelVars['max_gravita'][0] = Vec
+		self.__TouchVars__(['h_coef','h_exp','v_coef','v_exp','max_capilar','max_gravita'])
 	def set_Storage(self,var,pos):
 		'Descripcion: \n'\
 		'	Establece el almacenamiento inicial del modelo\n'\
@@ -2301,7 +4082,8 @@ class SimuBasin(Basin):
 			Vec = var
 			isVec=True
 		#Aloja ese almacenamiento en la cuenca 
-		models.storage[pos] = Vec
+		self.modelVars['storage'][pos] = Vec
+		self.__TouchVars__(['storage'])
 	def set_Control(self,coordXY,ids,tipo = 'Q'):
 		'Descripcion: \n'\
 		'	Establece los puntos deonde se va a realizar control del caudal\n'\
@@ -2316,8 +4098,8 @@ class SimuBasin(Basin):
 		'Retornos\n'\
 		'----------\n'\
 		'Define los puntos de control en las variables:\n'\
-		'	- models.control : control de caudal y sedimentos.\n'\
-		'	- models.control_h : control de la humedad del suelo.\n'\
+		'	- modelVars["control"] : control de caudal y sedimentos.\n'\
+		'	- modelVars["control_h"] : control de la humedad del suelo.\n'\
 		'IdsControl : El orden en que quedaron los puntos de control al interior.\n'\
 		'\n'\
 		'Mirar Tambien\n'\
@@ -2327,26 +4109,27 @@ class SimuBasin(Basin):
 		if tipo is 'Q':
 			xyNew, basinPts, order = self.Points_Points2Stream(coordXY,ids)
 			if self.modelType[0] is 'c':
-				models.control[0] = basinPts
+				self.modelVars['control'][0] = basinPts
 				IdsConvert = basinPts[basinPts<>0]
 			elif self.modelType[0] is 'h':
 				unitario = basinPts / basinPts
 				pos = self.hills_own * self.CellCauce * unitario
 				posGrande = self.hills_own * self.CellCauce * basinPts
 				IdsConvert = posGrande[posGrande<>0] / pos[pos<>0]
-				models.control[0][pos[pos<>0].astype(int).tolist()] = IdsConvert 			
+				self.modelVars['control'][0][pos[pos<>0].astype(int).tolist()] = IdsConvert 			
 		elif tipo is 'H':
 			xyNew = coordXY
 			basinPts, order = self.Points_Points2Basin(coordXY,ids)
 			if self.modelType is 'cells':
-				models.control_h[0] = basinPts
+				self.modelVars['control_h'][0] = basinPts
 				IdsConvert = basinPts[basinPts<>0]
 			elif self.modelType is 'hills':
 				unitario = basinPts / basinPts
 				pos = self.hills_own * unitario
 				posGrande = self.hills_own * basinPts
 				IdsConvert = posGrande[posGrande<>0] / pos[pos<>0]
-				models.control_h[0][pos[pos<>0].astype(int).tolist()] = IdsConvert 
+				self.modelVars['control_h'][0][pos[pos<>0].astype(int).tolist()] = IdsConvert 
+		self.__TouchVars__(['control','control_h'])
 		return IdsConvert,xyNew
 	
 	
@@ -2384,7 +4167,8 @@ class SimuBasin(Basin):
 			'DIR':ruta_dir,
 		    'modelType':self.modelType,'noData':self.nodata,'umbral':self.umbral,
 		    'ncells':self.ncells,'nhills':self.nhills,
-		    'dt':models.dt,'Nelem':N,'dxp':cu.dxp,'retorno':models.retorno}
+		    'dt':self.modelVars['dt'],'Nelem':N,'dxp':cu.dxp,
+		    'retorno':self.modelVars['retorno']}
 		#abre el archivo 
 		gr = netcdf.Dataset(ruta,'w',format='NETCDF4')
 		#Establece tamano de las variables 
@@ -2425,25 +4209,25 @@ class SimuBasin(Basin):
 		VarStruc[:] = self.structure
 		VarHills[:] = self.hills
 		VarHills_own[:] = self.hills_own
-		VarH_coef[:] = models.h_coef
-		VarV_coef[:] = models.v_coef
-		VarH_exp[:] = models.h_exp
-		VarV_exp[:] = models.v_exp
-		Var_H1max[:] = models.max_capilar
-		Var_H3max[:] = models.max_gravita
-		Control[:] = models.control
-		ControlH[:] = models.control_h
+		VarH_coef[:] = self.modelVars['h_coef']
+		VarV_coef[:] = self.modelVars['v_coef']
+		VarH_exp[:] = self.modelVars['h_exp']
+		VarV_exp[:] = self.modelVars['v_exp']
+		Var_H1max[:] = self.modelVars['max_capilar']
+		Var_H3max[:] = self.modelVars['max_gravita']
+		Control[:] = self.modelVars['control']
+		ControlH[:] = self.modelVars['control_h']
 		
-		drena[:] = models.drena
-		unitType[:] = models.unit_type
-		hill_long[:] = models.hill_long
-		hill_slope[:] = models.hill_slope
-		stream_long[:] = models.stream_long
-		stream_slope[:] = models.stream_slope
-		stream_width[:] = models.stream_width
-		elem_area[:] = models.elem_area
-		speed_type[:] = models.speed_type
-		storage[:] = models.storage
+		drena[:] = self.modelVars['drena']
+		unitType[:] = self.modelVars['unit_type']
+		hill_long[:] = self.modelVars['hill_long']
+		hill_slope[:] = self.modelVars['hill_slope']
+		stream_long[:] = self.modelVars['stream_long']
+		stream_slope[:] = self.modelVars['stream_slope']
+		stream_width[:] = self.modelVars['stream_width']
+		elem_area[:] = self.modelVars['elem_area']
+		speed_type[:] = self.modelVars['speed_type']
+		storage[:] = self.modelVars['storage']
 		
 		#asigna las prop a la cuenca 
 		gr.setncatts(Dict)
@@ -2456,7 +4240,9 @@ class SimuBasin(Basin):
 	# Ejecucion del modelo
 	#------------------------------------------------------	
 	def run_shia(self,Calibracion,
-		rain_rute, N_intervals, start_point = 1, ruta_storage = None):
+		rain_rute, N_intervals, start_point = 1, ruta_storage = None,
+		start_date = None, Nthreads = 1, checkpoint = None, checkpoint_every = None,
+		resume_from = None, sink = None, ruta_speed = None, profile = 0):
 		'Descripcion: Ejecuta el modelo una ves este es preparado\n'\
 		'	Antes de su ejecucion se deben tener listas todas las . \n'\
 		'	variables requeridas . \n'\
@@ -2483,12 +4269,299 @@ class SimuBasin(Basin):
 		'	que contiene fechas par aayudar a ubicar el punto de inicio deseado.\n'\
 		'ruta_storage : Ruta donde se guardan los estados del modelo en cada intervalo.\n'\
 		'	de tiempo, esta es opcional, solo se guardan si esta variable es asignada.\n'\
+		'start_date : Fecha (datetime) en la que inicia la simulacion, reemplaza a.\n'\
+		'	start_point, requiere el indice binario (.idx) de la lluvia.\n'\
+		'Nthreads : Hilos (OpenMP) con que se simulan en paralelo las laderas de la.\n'\
+		'	cuenca que no dependen entre si, el resultado es igual al de 1 hilo (defecto).\n'\
+		'checkpoint : Ruta donde se guarda el estado completo del modelo (almacenamiento,.\n'\
+		'	velocidades, flujos separados, retorno, sedimentos y deslizamientos) al final.\n'\
+		'	de la ejecucion, se lee con read_checkpoint.\n'\
+		'checkpoint_every : Si se da, el checkpoint tambien se actualiza cada tantos intervalos.\n'\
+		'resume_from : Ruta de un checkpoint desde el que continua la simulacion, con la misma.\n'\
+		'	calibracion el resultado es igual al de una sola ejecucion sin interrupcion.\n'\
+		'	Inicia en la fecha del checkpoint si la lluvia tiene fechas (.idx), si no en su.\n'\
+		'	intervalo, salvo que se de start_date.\n'\
+		'sink : ShiaWriter al que van las series y los estados a medida que se simulan,.\n'\
+		'	asi no se guardan completos en memoria (ver ShiaWriter), o SnapshotStore.\n'\
+		'	que guarda comprimidos los estados elegidos, o una lista de ellos.\n'\
+		'ruta_speed : Ruta donde se guardan las velocidades de cada intervalo (save_speed).\n'\
+		'profile : Mide donde se va el tiempo de la ejecucion, 0 no mide (defecto), 1.\n'\
+		'	lectura de lluvia, ciclo de celdas y escritura, 2 ademas separa el ciclo de.\n'\
+		'	celdas en flujo vertical, velocidad en ladera, canal y, si se simulan,.\n'\
+		'	sedimentos y deslizamientos (tomar la hora por celda hace mas lenta la.\n'\
+		'	ejecucion, con Nthreads las fases suman el tiempo de todos los hilos).\n'\
+		'Si existe el indice binario (.idx) junto al binario se usa en lugar del .hdr,.\n'\
+		'	con ambos el start_point k usa el registro k (antes el .hdr saltaba uno mas).\n'\
 		'\n'\
 		'Retornos\n'\
 		'----------\n'\
 		'Qsim : Caudal simulado en los puntos de control.\n'\
 		'Hsim : Humedad simulada en los puntos de control.\n'\
-		#genera las rutas 
+		'Profile : Con profile, tiempos [s] de cada fase (rain_read, cells, write,.\n'\
+		'	total y con profile 2 vertical, speed, channel, sediments, slides),.\n'\
+		'	cells_per_second, lecturas de lluvia y bytes (rain_reads, rain_bytes),.\n'\
+		'	escrituras (writes, con shia_v1 tambien write_bytes) e intervalos sin y.\n'\
+		'	con lluvia (dry_steps, wet_steps).\n'\
+		'Con sink solo se retorna Storage, las series quedan en los binarios del sink.\n'\
+		#Rutas de la lluvia y elementos de la cuenca
+		if profile:
+			t_ini = time.time()
+			Perfil = {}
+		else:
+			Perfil = None
+		rain_ruteBin,rain_ruteHdr,start_point = self.__RainRutes__(rain_rute,
+			start_point,start_date)
+		N,NcontrolQ,NcontrolH = self.__ControlSizes__()
+		V = self.modelVars
+		#Estado desde el que continua la simulacion
+		Estado = None
+		if resume_from is not None:
+			Estado,start_point = self.__ResumeState__(resume_from,N,rain_ruteHdr,
+				start_point,start_date)
+		#Sedimentos, deslizamientos y guardado de mapas usan las variables globales
+		#de models, lo demas se simula con shia_core sin tocar el modulo
+		if (V['sim_sediments'] == 1 or V['sim_slides'] == 1 or V['save_speed'] == 1
+			or V['save_storage'] == 1 or ruta_storage is not None or ruta_speed is not None):
+			Qsim,Qsed,Qseparated,Humedad,Balance,Alm = self.__RunShiaModule__(
+				Calibracion,rain_ruteBin,rain_ruteHdr,N_intervals,start_point,
+				ruta_storage,N,NcontrolQ,NcontrolH,Estado,checkpoint,checkpoint_every,sink,
+				ruta_speed,profile,Perfil)
+		else:
+			Resultados = self.__RunShiaCore__(np.reshape(Calibracion,(1,10)),
+				rain_ruteBin,rain_ruteHdr,N_intervals,start_point,N,NcontrolQ,NcontrolH,
+				Nthreads = Nthreads,Estado = Estado,checkpoint = checkpoint,
+				checkpoint_every = checkpoint_every,sink = sink,profile = profile,
+				Perfil = Perfil)
+			Qsim,Qseparated,Humedad,Balance,Alm = [r if r is None else r[0] for r in Resultados]
+		#Retorno de variables de acuerdo a lo simulado, con sink las series estan en disco
+		Retornos={'Storage' : Alm}
+		if profile:
+			Perfil['total'] = time.time() - t_ini
+			Perfil['cells_per_second'] = N*N_intervals/max(Perfil['cells'],1e-9)
+			Retornos.update({'Profile' : Perfil})
+		if sink is not None:
+			return Retornos
+		Retornos.update({'Qsim' : Qsim})
+		Retornos.update({'Balance' : Balance})
+		if np.count_nonzero(V['control_h'])>0:
+			Retornos.update({'Humedad' : Humedad})
+		if V['sim_sediments'] == 1:
+			Retornos.update({'Sediments' : Qsed})
+		if V['separate_fluxes'] == 1:
+			Retornos.update({'Fluxes' : Qseparated})
+		return Retornos
+	
+	def run_shia_ensemble(self,Calibraciones,rain_rute,N_intervals,start_point = 1,
+		start_date = None,Storages = None,Nthreads = 1,sink = None):
+		'Descripcion: Ejecuta varios miembros del modelo en una sola pasada, cada.\n'\
+		'	miembro tiene su calibracion y su almacenamiento inicial, la lluvia se.\n'\
+		'	lee una vez por intervalo y la topologia se recorre una vez para todos.\n'\
+		'	Sirve para calibracion e incertidumbre, cada miembro da lo mismo que.\n'\
+		'	run_shia con su calibracion.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'self : Cuenca a ejecutar con todo listo para ser ejecutada.\n'\
+		'Calibraciones : Matriz [Nmiembros,10] con un vector de calibracion por fila.\n'\
+		'	(ver run_shia), si es uno solo se usa para todos los miembros.\n'\
+		'rain_rute : Ruta donde se encuentra el archivo binario de lluvia.\n'\
+		'N_intervals : Numero de intervalos de tiempo.\n'\
+		'start_point : Punto donde comienza a usar registros de lluvia.\n'\
+		'start_date : Fecha (datetime) en la que inicia la simulacion (requiere .idx).\n'\
+		'Storages : Almacenamiento inicial [Nmiembros,5,N] (opcional), por defecto.\n'\
+		'	todos los miembros inician con el almacenamiento de la cuenca.\n'\
+		'Nthreads : Hilos (OpenMP) para simular en paralelo las laderas (ver run_shia).\n'\
+		'sink : ShiaWriter que recibe las salidas, cada registro tiene todos los miembros.\n'\
+		'	(ver run_shia).\n'\
+		'No simula sedimentos ni deslizamientos, ni guarda mapas de almacenamiento.\n'\
+		'	o de velocidad.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'Qsim : Caudal simulado [Nmiembros,Ncontrol,N_intervals].\n'\
+		'Balance : Balance de cada miembro [Nmiembros,N_intervals].\n'\
+		'Storage : Almacenamiento final de cada miembro [Nmiembros,5,N].\n'\
+		'Humedad : Humedad en los puntos de control (si hay).\n'\
+		'Fluxes : Flujos separados en los puntos de control (si se separan).\n'\
+		#Revisa que la cuenca no use lo que solo tiene shia_v1
+		V = self.modelVars
+		if (V['sim_sediments'] == 1 or V['sim_slides'] == 1 or V['save_speed'] == 1
+			or V['save_storage'] == 1):
+			raise ValueError('run_shia_ensemble no simula sedimentos ni deslizamientos ni guarda mapas')
+		rain_ruteBin,rain_ruteHdr,start_point = self.__RainRutes__(rain_rute,
+			start_point,start_date)
+		N,NcontrolQ,NcontrolH = self.__ControlSizes__()
+		#Miembros del ensamble
+		Calibraciones = np.atleast_2d(np.asarray(Calibraciones,dtype=np.float32))
+		if Storages is not None:
+			Storages = np.asarray(Storages,dtype=np.float32).reshape(-1,5,N)
+			if Calibraciones.shape[0] == 1:
+				Calibraciones = np.repeat(Calibraciones,Storages.shape[0],axis=0)
+			if Storages.shape[0] <> Calibraciones.shape[0]:
+				raise ValueError('Hay %d calibraciones y %d almacenamientos' % (
+					Calibraciones.shape[0],Storages.shape[0]))
+		#Ejecuta todos los miembros a la vez
+		Qsim,Qseparated,Humedad,Balance,Alm = self.__RunShiaCore__(Calibraciones,
+			rain_ruteBin,rain_ruteHdr,N_intervals,start_point,N,NcontrolQ,NcontrolH,
+			Storages,Nthreads,sink = sink)
+		Retornos={'Storage' : Alm}
+		if sink is not None:
+			return Retornos
+		Retornos.update({'Qsim' : Qsim})
+		Retornos.update({'Balance' : Balance})
+		if np.count_nonzero(V['control_h'])>0:
+			Retornos.update({'Humedad' : Humedad})
+		if V['separate_fluxes'] == 1:
+			Retornos.update({'Fluxes' : Qseparated})
+		return Retornos
+	
+	def advance(self,Rain,Calibracion = None,Nthreads = 1,reset = False):
+		'Descripcion: Avanza el modelo con lluvia en memoria, el estado queda en.\n'\
+		'	la cuenca entre llamados, asi en operacion cada nueva imagen de radar se.\n'\
+		'	simula sin escribir binarios ni volver a empezar. Varios llamados seguidos.\n'\
+		'	dan lo mismo que un run_shia con toda la lluvia.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'self : Cuenca a ejecutar con todo listo para ser ejecutada.\n'\
+		'Rain : Lluvia [mm] de un intervalo (vector [N]) o de varios (matriz.\n'\
+		'	[N,Nintervalos]).\n'\
+		'Calibracion : Parametros de calibracion (ver run_shia), se da en el primer.\n'\
+		'	llamado, o para cambiarla, o para tomar cambios en las variables de la.\n'\
+		'	cuenca (tipos de velocidad, puntos de control...), el estado se conserva.\n'\
+		'Nthreads : Hilos para simular en paralelo las laderas (ver run_shia).\n'\
+		'reset : Si es True vuelve a iniciar desde el almacenamiento de la cuenca.\n'\
+		'	(modelVars["storage"]), igual pasa en el primer llamado.\n'\
+		'No simula sedimentos ni deslizamientos, ni guarda mapas.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'Qsim : Caudal simulado en los puntos de control [Ncontrol,Nintervalos].\n'\
+		'Balance : Balance de cada intervalo.\n'\
+		'Humedad : Humedad en los puntos de control (si hay).\n'\
+		'Fluxes : Flujos separados en los puntos de control (si se separan).\n'\
+		'El estado queda en self.avance["estado"] (storage, speed, fluxes, retorned) y.\n'\
+		'	los intervalos simulados en self.avance["pasos"].\n'\
+		#Prepara los argumentos y el estado solo cuando cambian
+		V = self.modelVars
+		avance = getattr(self,'avance',None)
+		if avance is None or reset or Calibracion is not None or avance['Nthreads'] <> Nthreads:
+			if V['sim_sediments'] == 1 or V['sim_slides'] == 1:
+				raise ValueError('advance no simula sedimentos ni deslizamientos')
+			if Calibracion is None:
+				if avance is None:
+					raise ValueError('En el primer llamado de advance se debe dar la calibracion')
+				calib = avance['calib']
+			else:
+				calib = np.asarray(Calibracion,dtype=np.float32).reshape(1,10)
+			N,NcontrolQ,NcontrolH = self.__ControlSizes__()
+			if avance is None or reset:
+				estado = dict(zip(['storage','speed','fluxes','retorned'],
+					self.__CoreState__(calib,N)))
+				pasos = 0
+			else:
+				estado,pasos = avance['estado'],avance['pasos']
+			avance = {'calib' : calib,'calibT' : np.asfortranarray(calib.T),
+				'Nthreads' : Nthreads,'N' : N,'Args' : self.__CoreArgs__(N,Nthreads) +
+				[NcontrolQ,NcontrolH],'estado' : estado,'pasos' : pasos}
+			self.avance = avance
+		#Lluvia de los intervalos en el orden de Fortran
+		Rain = np.asarray(Rain,dtype=np.float32)
+		if Rain.ndim == 1:
+			Rain = Rain.reshape(-1,1)
+		if Rain.shape[0] <> avance['N']:
+			raise ValueError('La lluvia tiene %d elementos y la cuenca %d' % (Rain.shape[0],
+				avance['N']))
+		Rain = np.asfortranarray(Rain)
+		#Simula los intervalos desde el estado que quedo del llamado anterior
+		E = avance['estado']
+		Q,Qsep,Hum,Bal,MeanRain,Fases = models.shia_core(Rain,avance['calibT'],*(avance['Args'] +
+			[E['storage'],E['speed'],E['fluxes'],E['retorned']]))
+		avance['pasos'] += Rain.shape[1]
+		Retornos = {'Qsim' : Q[0],'Balance' : Bal[0]}
+		if np.count_nonzero(V['control_h'])>0:
+			Retornos.update({'Humedad' : Hum[0]})
+		if V['separate_fluxes'] == 1:
+			Retornos.update({'Fluxes' : Qsep[0]})
+		return Retornos
+	
+	def read_snapshot_step(self,ruta,paso):
+		'Descripcion: Lee de un SnapshotStore los estados guardados en un intervalo,.\n'\
+		'	solo descomprime los bloques de ese intervalo.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'self : Cuenca simulada.\n'\
+		'ruta : Ruta del binario del SnapshotStore.\n'\
+		'paso : Intervalo (contado desde el inicio del almacen, multiplo de cada).\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'Mapas : Diccionario {variable_tanque : vector [N]} (p.ej. Storage_3), las.\n'\
+		'	celdas que no se guardaron quedan en nan.\n'\
+		#Ubica el registro del intervalo
+		Info = __ReadSnapshotInfo__(ruta)
+		indice = Info['indice']
+		cada = Info['cada']
+		registro = paso / cada - 1
+		filas = indice[(indice['registro'] <= registro)
+			& (indice['registro'] + indice['Nregistros'] > registro)]
+		if paso % cada <> 0 or filas.size == 0:
+			raise ValueError('El intervalo %d no esta guardado en %s' % (paso,ruta))
+		#Descomprime los bloques de celdas de ese registro
+		Nfilas = len(Info['nombres'])
+		Ncells = Info['Ncells']
+		celdas = Info['celdas']
+		Mapas = np.zeros((Nfilas,Info['N']),dtype=np.float32) * np.nan
+		f = open(ruta,'rb')
+		for fila in filas:
+			datos = __ReadSnapshotBlock__(f,fila,Nfilas,Ncells,celdas.size)
+			b = fila['bloque']
+			Mapas[:,celdas[b*Ncells:(b+1)*Ncells]] = datos[registro - fila['registro']]
+		f.close()
+		return dict(zip(Info['nombres'],Mapas))
+	
+	def read_snapshot_series(self,ruta,celda):
+		'Descripcion: Lee de un SnapshotStore la serie de los estados de un.\n'\
+		'	elemento de la cuenca, solo descomprime los bloques de celdas que lo tienen.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'self : Cuenca simulada.\n'\
+		'ruta : Ruta del binario del SnapshotStore.\n'\
+		'celda : Elemento de la cuenca (indice desde 0 en el orden del modelo).\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'Series : DataFrame con una columna por variable_tanque, el indice es el.\n'\
+		'	intervalo (contado desde el inicio del almacen).\n'\
+		#Ubica la celda en los bloques
+		Info = __ReadSnapshotInfo__(ruta)
+		celdas = Info['celdas']
+		pos = np.nonzero(celdas == celda)[0]
+		if pos.size == 0:
+			raise ValueError('El elemento %d no se guardo en %s' % (celda,ruta))
+		Ncells = Info['Ncells']
+		b,j = divmod(pos[0],Ncells)
+		indice = Info['indice']
+		filas = indice[indice['bloque'] == b]
+		filas = filas[np.argsort(filas['registro'])]
+		#Descomprime solo los bloques de esa celda
+		Nfilas = len(Info['nombres'])
+		Nreg = 0
+		if filas.size > 0:
+			Nreg = filas['registro'][-1] + filas['Nregistros'][-1]
+		Datos = np.zeros((Nreg,Nfilas),dtype=np.float32)
+		f = open(ruta,'rb')
+		for fila in filas:
+			datos = __ReadSnapshotBlock__(f,fila,Nfilas,Ncells,celdas.size)
+			Datos[fila['registro']:fila['registro']+fila['Nregistros']] = datos[:,:,j]
+		f.close()
+		return pd.DataFrame(Datos,index = (np.arange(Nreg)+1)*Info['cada'],
+			columns = Info['nombres'])
+	
+	def __RainRutes__(self,rain_rute,start_point,start_date):
+		#Rutas del binario y de la tabla de la lluvia y punto de inicio
 		if rain_rute.endswith('.bin') is False and rain_rute.endswith('.hdr') is True:
 			rain_ruteBin = rain_rute[:-3] + 'bin'
 			rain_ruteHdr = rain_rute
@@ -2498,48 +4571,503 @@ class SimuBasin(Basin):
 		elif  rain_rute.endswith('.bin') is False and rain_rute.endswith('.hdr') is False:
 			rain_ruteBin = rain_rute[:-3] + 'bin'
 			rain_ruteHdr = rain_rute[:-3] + 'hdr'
-		# De acuerdo al tipo de modelo determina la cantidad de elementos
+		#Si existe el indice binario lo usa en lugar del .hdr
+		rain_ruteIdx = rain_ruteBin[:-3] + 'idx'
+		if os.path.exists(rain_ruteIdx):
+			rain_ruteHdr = rain_ruteIdx
+		#Si se da una fecha de inicio la ubica en el indice
+		if start_date is not None:
+			start_point = find_rain_index(rain_ruteIdx,start_date)
+		return rain_ruteBin,rain_ruteHdr,start_point
+	
+	def __ControlSizes__(self):
+		#Cantidad de elementos y de puntos de control de caudal y humedad
 		if self.modelType[0] is 'c':
 			N = self.ncells
 		elif self.modelType[0] is 'h':
 			N = self.nhills
-		#prepara variables globales
-		models.rain_first_point = start_point
-		#Prepara terminos para control
-		if np.count_nonzero(models.control) is 0 :
+		V = self.modelVars
+		if np.count_nonzero(V['control']) is 0 :
 			NcontrolQ = 1
 		else:
-			NcontrolQ = np.count_nonzero(models.control)+1
-		if np.count_nonzero(models.control_h) is 0 :
+			NcontrolQ = np.count_nonzero(V['control'])+1
+		if np.count_nonzero(V['control_h']) is 0 :
 			NcontrolH = 1
 		else:
-			NcontrolH = np.count_nonzero(models.control_h)
-		#Prepara variables de guardado de variables 
-		if ruta_storage is not None:
-			models.save_storage = 1
+			NcontrolH = np.count_nonzero(V['control_h'])
+		return N,NcontrolQ,NcontrolH
+	
+	def __TouchVars__(self,nombres=None):
+		#Aumenta la version de las variables de la cuenca que cambiaron (todas o las
+		#de nombres), la siguiente publicacion en models solo copia esas
+		versiones = self.__dict__.setdefault('modelVersions',{})
+		if nombres is None:
+			nombres = self.modelVars.keys()
+		for k in nombres:
+			versiones[k] = versiones.get(k,0) + 1
+	
+	def __SyncModels__(self,nombres=None):
+		#Copia en models las variables de la cuenca (todas o las de nombres) que
+		#cambiaron desde que se publicaron, o todas si models tiene las de otra
+		#cuenca. Se llama con __ModelsLock__ tomado
+		V = self.modelVars
+		versiones = self.__dict__.setdefault('modelVersions',{})
+		dueno = __ModelsDueno__['cuenca']
+		if dueno is None or dueno() is not self:
+			__ModelsDueno__['cuenca'] = weakref.ref(self)
+			__ModelsDueno__['versiones'] = {}
+		publicadas = __ModelsDueno__['versiones']
+		if nombres is None:
+			nombres = V.keys()
+		for k in nombres:
+			if k in V and hasattr(models,k):
+				#Un arreglo reemplazado en modelVars tambien cuenta como cambio
+				llave = (versiones.get(k,0),id(V[k]))
+				if publicadas.get(k) <> llave:
+					setattr(models,k,V[k])
+					publicadas[k] = llave
+	
+	def __PublishOutputs__(self,nombres):
+		#Si la cuenca es la publicada en models, deja alli tambien las salidas de
+		#la ejecucion (sin tomar el candado si no lo es)
+		self.__TouchVars__(nombres)
+		dueno = __ModelsDueno__['cuenca']
+		if dueno is None or dueno() is not self:
+			return
+		with __ModelsLock__:
+			dueno = __ModelsDueno__['cuenca']
+			if dueno is not None and dueno() is self:
+				self.__SyncModels__(nombres)
+	
+	def publish_models(self,nombres=None):
+		'Descripcion: Deja las variables de la cuenca en models (models.v_coef,.\n'\
+		'	models.storage...) para usar el modulo directamente, como antes de.\n'\
+		'	modelVars. Las simulaciones no lo necesitan, run_shia solo copia en.\n'\
+		'	models lo que usa shia_v1. Mientras la cuenca sea la publicada sus.\n'\
+		'	ejecuciones tambien dejan en models mean_rain, retorned y fluxes.\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'self : Cuenca a publicar.\n'\
+		'nombres : Variables que se cambiaron en su lugar en modelVars (p.ej..\n'\
+		'	modelVars["v_coef"][0] = ...), los set_* ya marcan lo que cambian.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'No hay retorno, solo se copian las variables que cambiaron desde la ultima.\n'\
+		'	publicacion (todas si models tenia las de otra cuenca).\n'\
+		#Marca lo que se cambio a mano y copia lo que cambio
+		with __ModelsLock__:
+			if nombres is not None:
+				self.__TouchVars__(nombres)
+			self.__SyncModels__()
+	
+	def pull_models(self,nombres=None):
+		'Descripcion: Toma en la cuenca las variables que se cambiaron directo en.\n'\
+		'	models despues de publish_models (p.ej. models.storage = Res["Storage"].\n'\
+		'	para continuar una simulacion, o models.v_coef[0] = ...).\n'\
+		'\n'\
+		'Parametros\n'\
+		'----------\n'\
+		'self : Cuenca publicada en models.\n'\
+		'nombres : Variables a tomar, por defecto todas las publicadas.\n'\
+		'\n'\
+		'Retornos\n'\
+		'----------\n'\
+		'No hay retorno, las variables quedan en modelVars.\n'\
+		#Solo la cuenca publicada puede tomar de models
+		V = self.modelVars
+		with __ModelsLock__:
+			dueno = __ModelsDueno__['cuenca']
+			if dueno is None or dueno() is not self:
+				raise ValueError('models no tiene las variables de esta cuenca, primero se usa publish_models')
+			publicadas = __ModelsDueno__['versiones']
+			if nombres is None:
+				nombres = publicadas.keys()
+			for k in nombres:
+				valor = getattr(models,k)
+				if valor is not None:
+					V[k] = valor.item() if np.ndim(valor) == 0 else np.array(valor)
+			#Lo tomado ya es igual en la cuenca y en models
+			self.__TouchVars__(nombres)
+			versiones = self.modelVersions
+			for k in nombres:
+				if k in V:
+					publicadas[k] = (versiones[k],id(V[k]))
+	
+	def __ResumeState__(self,ruta,N,rain_ruteHdr,start_point,start_date):
+		#Lee un checkpoint para continuar la simulacion y ubica el intervalo de inicio
+		Estado = read_checkpoint(ruta)
+		V = self.modelVars
+		if Estado['N'] <> N or Estado['storage'].shape[0] <> 1:
+			raise ValueError('El checkpoint %s no es de una simulacion de esta cuenca' % ruta)
+		if V['sim_sediments'] == 1 and 'vs' not in Estado:
+			raise ValueError('El checkpoint %s no tiene estado de sedimentos' % ruta)
+		if V['sim_slides'] == 1 and 'slideocurrence' not in Estado:
+			raise ValueError('El checkpoint %s no tiene estado de deslizamientos' % ruta)
+		if start_date is None:
+			if Estado['fecha'] >= 0 and __RainIndexEpoch__(rain_ruteHdr,1) >= 0:
+				start_point = find_rain_index(rain_ruteHdr,
+					np.datetime64(int(Estado['fecha']),'s'))
+			else:
+				start_point = int(Estado['intervalo'])
+		return Estado,start_point
+	
+	def __WriteCheckpoint__(self,ruta,Calibraciones,siguiente,rain_ruteHdr,Estado):
+		#Guarda el estado junto con el intervalo (y su fecha) en que continua
+		Estado.update({'version' : 1,
+			'N' : Estado['storage'].shape[2],
+			'modelType' : self.modelType,
+			'dt' : self.modelVars['dt'],
+			'intervalo' : siguiente,
+			'fecha' : __RainIndexEpoch__(rain_ruteHdr,siguiente),
+			'calibracion' : np.reshape(Calibraciones,(-1,10))})
+		write_checkpoint(ruta,Estado)
+	
+	def __ModuleState__(self,Alm,N):
+		#Estado de la ultima ejecucion de shia_v1 que queda en el modulo
+		V = self.modelVars
+		Estado = {'storage' : Alm[np.newaxis],
+			'speed' : np.copy(models.hspeed_estado)[np.newaxis],
+			'retorned' : np.zeros((1,N),dtype=np.float32),
+			'fluxes' : np.zeros((1,3,N),dtype=np.float32)}
+		if V['retorno'] == 1:
+			Estado['retorned'] = np.copy(models.retorned)
+		if V['separate_fluxes'] == 1:
+			Estado['fluxes'] = np.copy(models.fluxes)[np.newaxis]
+		if V['sim_sediments'] == 1:
+			for k in __EstadoSedimentos__:
+				Estado[k] = np.copy(getattr(models,k))
+		if V['sim_slides'] == 1:
+			for k in __EstadoDeslizamientos__:
+				Estado[k] = np.copy(getattr(models,k))
+		return Estado
+	
+	def __BlockCuts__(self,N_intervals,Nbloque,checkpoint_every,sink):
+		#Intervalos (desde 0) en que terminan los bloques de la simulacion: cada
+		#Nbloque, en cada checkpoint y donde el sink guarda estados
+		cortes = set(range(0,N_intervals,Nbloque)+[N_intervals])
+		if checkpoint_every is not None:
+			cortes.update(range(0,N_intervals,checkpoint_every))
+		for s in self.__Sinks__(sink):
+			cortes.update(s.__StateCuts__(N_intervals))
+		return sorted(cortes)
+	
+	def __Sinks__(self,sink):
+		#El sink puede ser uno solo o una lista
+		if sink is None:
+			return []
+		if isinstance(sink,(list,tuple)):
+			return list(sink)
+		return [sink]
+	
+	def __SinkBlock__(self,sink,Series,Nintervalos,Estados):
+		#Pasa a los sinks las series de un bloque que aplican a la simulacion y los
+		#estados al final del bloque
+		V = self.modelVars
+		if np.count_nonzero(V['control_h']) == 0:
+			Series.pop('Humedad',None)
+		if V['separate_fluxes'] <> 1:
+			Series.pop('Fluxes',None)
+			Estados.pop('Fluxes',None)
+		if V['sim_sediments'] <> 1:
+			Series.pop('Sediments',None)
+		for s in self.__Sinks__(sink):
+			s.write_block(Series,Nintervalos,Estados)
+	
+	def __ParallelSchedule__(self,N):
+		#Orden de ejecucion por niveles de laderas: cada ladera (hills_own) es un grupo,
+		#un grupo va en un nivel posterior a todos los grupos que le drenan, asi los
+		#grupos de un nivel son independientes. En el modelo por laderas cada ladera
+		#es un grupo. Entrega el orden de las celdas, el inicio de cada grupo y el
+		#primer grupo de cada nivel (indices de models, inician en 1)
+		drena = np.asarray(self.modelVars['drena'][0],dtype=int)
+		if self.modelType[0] is 'c':
+			grupo = np.asarray(self.hills_own,dtype=int)
 		else:
-			ruta_storage = 'no_guardo_nada.bin'
-		# Ejecuta el modelo 
-		Qsim,Qsed,Qseparated,Humedad,Balance,Alm = models.shia_v1(
-			rain_ruteBin,
-			rain_ruteHdr,
-			Calibracion,
-			N,
-			NcontrolQ,
-			NcontrolH,
-			N_intervals,
-			ruta_storage)
-		#Retorno de variables de acuerdo a lo simulado 
-		Retornos={'Qsim' : Qsim}
-		Retornos.update({'Balance' : Balance})
-		Retornos.update({'Storage' : Alm})
-		if np.count_nonzero(models.control_h)>0:
-			Retornos.update({'Humedad' : Humedad})
-		if models.sim_sediments == 1:
-			Retornos.update({'Sediments' : Qsed})
-		if models.separate_fluxes == 1:
-			Retornos.update({'Fluxes' : Qseparated})
-		return Retornos
+			grupo = np.arange(1,N+1)
+		celdas = np.arange(N)
+		fuente = celdas[drena <> 0]
+		destino = N - drena[fuente]
+		#Conexiones entre grupos diferentes
+		cruza = grupo[fuente] <> grupo[destino]
+		gOrigen = grupo[fuente[cruza]]
+		gDestino = grupo[destino[cruza]]
+		nivel = np.zeros(grupo.max()+1,dtype=int)
+		for i in range(nivel.size+1):
+			anterior = nivel.copy()
+			np.maximum.at(nivel,gDestino,nivel[gOrigen]+1)
+			if (nivel == anterior).all():
+				break
+		else:
+			#Los grupos no forman un arbol: una sola cola en serie
+			return celdas+1,np.array([1,N+1]),np.array([1,2])
+		#Celdas ordenadas por nivel, grupo y posicion
+		orden = np.lexsort((celdas,grupo,nivel[grupo]))
+		g = grupo[orden]
+		inicio = np.hstack([0,np.nonzero(np.diff(g))[0]+1])
+		niv = nivel[g[inicio]]
+		primero = np.hstack([0,np.nonzero(np.diff(niv))[0]+1])
+		return orden+1,np.hstack([inicio,N])+1,np.hstack([primero,inicio.size])+1
+	
+	def __RunShiaModule__(self,Calibracion,rain_ruteBin,rain_ruteHdr,N_intervals,
+		start_point,ruta_storage,N,NcontrolQ,NcontrolH,Estado=None,checkpoint=None,
+		checkpoint_every=None,sink=None,ruta_speed=None,profile=0,Perfil=None):
+		#Ejecuta models.shia_v1: carga las variables de la cuenca en el modulo,
+		#las demas cuencas esperan a que termine para usar el modulo. Con checkpoints
+		#o sink ejecuta por pedazos, cada pedazo continua con el estado del anterior
+		V = self.modelVars
+		with __ModelsLock__:
+			self.__SyncModels__()
+			models.continuar_estado = 0
+			#Si continua desde un checkpoint pone su estado en el modulo
+			if Estado is not None:
+				models.storage = Estado['storage'][0]
+				models.hspeed_estado = Estado['speed'][0]
+				models.retorned = Estado['retorned'][:1]
+				models.fluxes = Estado['fluxes'][0]
+				for k in __EstadoSedimentos__ + __EstadoDeslizamientos__:
+					if k in Estado:
+						setattr(models,k,Estado[k])
+				models.continuar_estado = 1
+			#Prepara variables de guardado de variables 
+			if ruta_storage is not None:
+				models.save_storage = 1
+			else:
+				ruta_storage = 'no_guardo_nada.bin'
+			#La ruta de las velocidades es un character*500 en models
+			if ruta_speed is not None:
+				models.save_speed = 1
+				models.rute_speed = ruta_speed.ljust(500)
+			elif models.save_speed == 1:
+				raise ValueError('Para guardar las velocidades (save_speed) se debe dar ruta_speed')
+			#Tiempos y conteos de shia_v1, se acumulan en todos los pedazos
+			models.medir_fases = int(profile)
+			models.fases_tiempo = np.zeros(9)
+			models.fases_conteo = np.zeros(6,dtype=np.int64)
+			#Con sink los pedazos son de maximo 128 MB de lluvia
+			Nbloque = N_intervals
+			if sink is not None:
+				Nbloque = max(1,min(N_intervals,2**25/N))
+			cortes = self.__BlockCuts__(N_intervals,Nbloque,checkpoint_every,sink)
+			Partes = []
+			Lluvia = []
+			try:
+				for i,j in zip(cortes[:-1],cortes[1:]):
+					models.rain_first_point = start_point+i
+					models.paso_inicio = i
+					# Ejecuta el modelo 
+					Resultados = models.shia_v1(
+						rain_ruteBin,
+						rain_ruteHdr,
+						Calibracion,
+						N,
+						NcontrolQ,
+						NcontrolH,
+						j-i,
+						ruta_storage)
+					Lluvia.append(np.copy(models.mean_rain))
+					if sink is None:
+						Partes.append(Resultados)
+					else:
+						Series = dict(zip(['Qsim','Sediments','Fluxes','Humedad','Balance'],
+							Resultados[:5]))
+						Series['MeanRain'] = Lluvia[-1][0]
+						Estados = {'Storage' : Resultados[5],'Speed' : models.hspeed_estado}
+						if V['separate_fluxes'] == 1:
+							Estados['Fluxes'] = models.fluxes
+						self.__SinkBlock__(sink,Series,j-i,Estados)
+					#El siguiente pedazo sigue desde el estado en que quedo este
+					models.storage = Resultados[5]
+					models.continuar_estado = 1
+					if checkpoint is not None and (j == N_intervals or
+						(checkpoint_every is not None and j % checkpoint_every == 0)):
+						self.__WriteCheckpoint__(checkpoint,Calibracion,start_point+j,
+							rain_ruteHdr,self.__ModuleState__(Resultados[5],N))
+			finally:
+				models.continuar_estado = 0
+				models.paso_inicio = 0
+				models.medir_fases = 0
+			if Perfil is not None:
+				Perfil.update(self.__ModuleProfile__(profile))
+			#Variables de la ejecucion que quedan en el modulo
+			V['mean_rain'] = np.hstack(Lluvia)
+			if V['retorno'] == 1:
+				V['retorned'] = np.copy(models.retorned)
+			if V['separate_fluxes'] == 1:
+				V['fluxes'] = np.copy(models.fluxes)
+			#Los deslizamientos cambian el tipo de unidad de las celdas
+			salidas = ['mean_rain','retorned','fluxes']
+			if V['sim_slides'] == 1:
+				V['unit_type'] = np.copy(models.unit_type)
+				salidas.append('unit_type')
+			#Lo que la ejecucion cambio en models (storage, save_storage, el estado
+			#de un checkpoint...) se vuelve a copiar en la siguiente publicacion, las
+			#salidas se publican de una vez
+			publicadas = __ModelsDueno__['versiones']
+			for k in (['storage','save_storage','save_speed','retorned','fluxes']
+				+ __EstadoSedimentos__ + __EstadoDeslizamientos__):
+				publicadas.pop(k,None)
+			self.__TouchVars__(salidas)
+			self.__SyncModels__(salidas)
+		if sink is not None:
+			return [None]*5 + [Resultados[5]]
+		if len(Partes) == 1:
+			return Resultados
+		return [np.concatenate([p[k] for p in Partes],axis=-1) for k in range(5)] + [Resultados[5]]
+	
+	def __ModuleProfile__(self,profile):
+		#Tiempos y conteos que dejo shia_v1 en el modulo
+		V = self.modelVars
+		tiempos = np.copy(models.fases_tiempo)
+		conteos = np.copy(models.fases_conteo)
+		Perfil = dict(zip(['rain_read','cells','write'],tiempos[[0,1,7]]))
+		if profile > 1:
+			Perfil.update(dict(zip(['vertical','speed','channel'],tiempos[2:5])))
+			if V['sim_sediments'] == 1:
+				Perfil['sediments'] = tiempos[5]
+			if V['sim_slides'] == 1:
+				Perfil['slides'] = tiempos[6]
+		Perfil.update(dict(zip(['rain_reads','rain_bytes','writes','write_bytes',
+			'dry_steps','wet_steps'],[int(c) for c in conteos])))
+		return Perfil
+	
+	def __Lap__(self,Perfil,fase,t):
+		#Suma a la fase del perfil el tiempo desde t, sin perfil no hace nada
+		if Perfil is None:
+			return None
+		ahora = time.time()
+		Perfil[fase] = Perfil.get(fase,0.0) + ahora - t
+		return ahora
+	
+	def __CoreArgs__(self,N,Nthreads):
+		#Argumentos de models.shia_core que solo dependen de la cuenca, ya con el
+		#tipo y orden de Fortran para que f2py no los copie en cada llamado
+		V = self.modelVars
+		drena = np.asarray(V['drena'][0],dtype=np.int32)
+		unidad = np.asarray(V['unit_type'][0],dtype=np.int32)
+		control = np.asarray(V['control'][0],dtype=np.int32)
+		control_h = np.asarray(V['control_h'][0],dtype=np.int32)
+		geo = np.array([V['hill_long'][0],V['stream_long'][0],V['stream_width'][0],
+			V['elem_area'][0]],dtype=np.float32,order='F')
+		coefs = [np.array(V[k],dtype=np.float32,order='F') for k in ['v_coef','h_coef','h_exp']]
+		Hmax = np.array([V['max_capilar'][0],V['max_gravita'][0]],dtype=np.float32,order='F')
+		tipos = np.array(list(V['speed_type'])+[V['retorno'],V['separate_fluxes'],
+			V['speed_solver']],dtype=np.int32)
+		tols = np.array([V['recession_tol'],V['speed_tol']],dtype=np.float32)
+		#Orden de las celdas: en serie o por niveles de laderas en paralelo
+		if Nthreads > 1:
+			orden,grupos,niveles = self.__ParallelSchedule__(N)
+		else:
+			orden,grupos,niveles = np.arange(1,N+1),np.array([1,N+1]),np.array([1,2])
+		orden,grupos,niveles = [np.asarray(x,dtype=np.int32) for x in [orden,grupos,niveles]]
+		return [drena,unidad,control,control_h,geo] + coefs + [Hmax,tipos,V['dt'],tols,
+			orden,grupos,niveles,Nthreads]
+	
+	def __CoreState__(self,calib,N,Storages=None,Estado=None):
+		#Estado inicial de cada miembro: almacenamiento, velocidades y flujos separados,
+		#o el estado de un checkpoint
+		V = self.modelVars
+		Nm = calib.shape[0]
+		if Storages is None:
+			Storages = np.asarray(V['storage'],dtype=np.float32).reshape(1,5,N)
+		Sto = np.zeros((Nm,5,N),dtype=np.float32,order='F')
+		Sto[:] = Storages
+		Speed = np.array(np.asarray(V['h_coef'],dtype=np.float32)[np.newaxis]
+			*calib[:,4:8,np.newaxis],order='F')
+		Flux = np.zeros((Nm,3,N),dtype=np.float32,order='F')
+		Ret = np.zeros((Nm,N),dtype=np.float32,order='F')
+		if Estado is not None:
+			Sto[:] = Estado['storage']
+			Speed[:] = Estado['speed']
+			Flux[:] = Estado['fluxes']
+			Ret[:] = Estado['retorned']
+		return Sto,Speed,Flux,Ret
+	
+	def __RunShiaCore__(self,Calibraciones,rain_ruteBin,rain_ruteHdr,N_intervals,
+		start_point,N,NcontrolQ,NcontrolH,Storages=None,Nthreads=1,Estado=None,
+		checkpoint=None,checkpoint_every=None,sink=None,profile=0,Perfil=None):
+		#Ejecuta models.shia_core por bloques de intervalos con el estado de la
+		#cuenca como argumento, no usa el modulo y libera el GIL mientras simula,
+		#cada fila de Calibraciones es un miembro y los resultados salen apilados.
+		#Con sink los resultados de cada bloque van al sink y no se retornan.
+		#Con Perfil (diccionario) mide la lectura, la simulacion y la escritura, con
+		#profile 2 shia_core tambien mide las fases de las celdas (suma de los hilos)
+		V = self.modelVars
+		Nm = Calibraciones.shape[0]
+		calib = np.asarray(Calibraciones,dtype=np.float32)
+		Args = self.__CoreArgs__(N,Nthreads)
+		Sto,Speed,Flux,Ret = self.__CoreState__(calib,N,Storages,Estado)
+		#Resultados
+		Qsim = Qseparated = Humedad = Balance = None
+		if sink is None:
+			Qsim = np.zeros((Nm,NcontrolQ,N_intervals),dtype=np.float32,order='F')
+			Qseparated = np.zeros((Nm,NcontrolQ,3,N_intervals),dtype=np.float32,order='F')
+			Humedad = np.zeros((Nm,NcontrolH,N_intervals),dtype=np.float32,order='F')
+			Balance = np.zeros((Nm,N_intervals),dtype=np.float32,order='F')
+		MeanRain = np.zeros(N_intervals,dtype=np.float32)
+		#La lluvia se lee por bloques de maximo 128 MB, los bloques tambien cortan
+		#en los intervalos de checkpoint y donde el sink guarda estados
+		Nbloque = max(1,min(N_intervals,2**25/N))
+		cortes = self.__BlockCuts__(N_intervals,Nbloque,checkpoint_every,sink)
+		lector = RainReader(rain_ruteBin,rain_ruteHdr,N)
+		escrituras = 0
+		t = None
+		medir = 0
+		if Perfil is not None:
+			Perfil.update({'rain_read' : 0.0,'cells' : 0.0,'write' : 0.0})
+			if profile > 1:
+				medir = 1
+				Perfil.update({'vertical' : 0.0,'speed' : 0.0,'channel' : 0.0})
+			t = time.time()
+		try:
+			for i,j in zip(cortes[:-1],cortes[1:]):
+				Rain = lector.read(start_point+i,j-i)
+				t = self.__Lap__(Perfil,'rain_read',t)
+				Bloque = models.shia_core(Rain,calib.T,*(Args + [NcontrolQ,NcontrolH,
+					Sto,Speed,Flux,Ret]),medir = medir)
+				t = self.__Lap__(Perfil,'cells',t)
+				if medir == 1:
+					for fase,tiempo in zip(['vertical','speed','channel'],Bloque[5]):
+						Perfil[fase] += tiempo
+				MeanRain[i:j] = Bloque[4]
+				if sink is None:
+					Qsim[:,:,i:j],Qseparated[:,:,:,i:j],Humedad[:,:,i:j],Balance[:,i:j] = Bloque[:4]
+				else:
+					#Con un solo miembro las salidas no tienen la dimension de los miembros
+					Series = dict(zip(['Qsim','Fluxes','Humedad','Balance'],
+						[b[0] if Nm == 1 else b for b in Bloque[:4]]))
+					Series['MeanRain'] = Bloque[4]
+					Estados = {'Storage' : Sto,'Speed' : Speed,'Fluxes' : Flux}
+					if Nm == 1:
+						Estados = dict([(k,v[0]) for k,v in Estados.iteritems()])
+					self.__SinkBlock__(sink,Series,j-i,Estados)
+					escrituras += 1
+				if checkpoint is not None and (j == N_intervals or
+					(checkpoint_every is not None and j % checkpoint_every == 0)):
+					self.__WriteCheckpoint__(checkpoint,calib,start_point+j,rain_ruteHdr,
+						{'storage' : Sto,'speed' : Speed,'fluxes' : Flux,'retorned' : Ret})
+					escrituras += 1
+				t = self.__Lap__(Perfil,'write',t)
+		finally:
+			lector.close()
+		if Perfil is not None:
+			Perfil.update({'rain_reads' : lector.lecturas,'rain_bytes' : lector.bytes,
+				'writes' : escrituras,'dry_steps' : int(np.count_nonzero(MeanRain == 0)),
+				'wet_steps' : int(np.count_nonzero(MeanRain))})
+		#Variables de la ejecucion, quedan en la cuenca (y en models si la cuenca
+		#esta publicada) como las deja shia_v1, el retorno y los flujos de un
+		#ensamble solo estan en los resultados
+		V['mean_rain'] = MeanRain.reshape(1,N_intervals)
+		salidas = ['mean_rain']
+		if V['retorno'] == 1 and Nm == 1:
+			V['retorned'] = np.array(Ret)
+			salidas.append('retorned')
+		if V['separate_fluxes'] == 1 and Nm == 1:
+			V['fluxes'] = np.array(Flux[0])
+			salidas.append('fluxes')
+		self.__PublishOutputs__(salidas)
+		return Qsim,Qseparated,Humedad,Balance,Sto
 		
 class Stream:
 	#------------------------------------------------------